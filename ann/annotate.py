@@ -12,8 +12,15 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import file_utils as fu
 import utils as u
+import vcf_record as vr
+import contigs
+import prefilter as pf
+import intervals as iv
+import sources as src
+import lookups as lk
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
+cnvTables = src.CNV_TABLES
 
 def collapseGeneNames(row, indices, region, cnt):
     names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
@@ -107,48 +114,173 @@ def getComplementary(nuc):
         return compNuc
 
 
+"""REF and ALT of a record; pileup has them one column earlier
+"""
+def getAlleles(record, format='vcf'):
+    if (format != 'vcf'):
+        return record.id, record.ref
+    return record.ref, record.alt
+
+
+"""Whether a variant changes the length of the sequence: an indel, or a
+structural variant given as a symbolic ALT such as <DEL>
+"""
+def isIndel(ref, alt):
+    for allele in alt.split(','):
+        if len(allele) != len(ref):
+            return True
+    return False
+
+
+"""Reference bases a variant spans, as (start, end) with both inclusive
+END in INFO is used if present, then SVLEN (except for insertions, which
+span no reference bases); otherwise it is the span of REF.
+"""
+def getSpan(record, format='vcf'):
+    start = record.pos
+    ref, alt = getAlleles(record, format=format)
+    end = start + max(len(ref.strip()), 1) - 1
+
+    info = str(record.info)
+    if (format == 'vcf') and ('END=' in info or 'SVLEN=' in info):
+        values = {}
+        for entry in info.split(';'):
+            key, sep, value = entry.partition('=')
+            if sep and key not in values:
+                values[key] = value
+        try:
+            if 'END' in values:
+                end = max(end, int(values['END']))
+            elif 'SVLEN' in values and values.get('SVTYPE') != 'INS':
+                end = max(end,
+                    start + abs(int(values['SVLEN'].split(',')[0])))
+        except ValueError:
+            pass
+    return start, end
+
+
+"""Runs a stage over a file: reads <vcf><tmpextin>, writes <vcf><tmpextout>
+and appends its counts to <vcf>.count.log (logmode='w' starts a new log).
+Stages are generators over records (see vcf_record), with header lines
+passed through as strings, so they can also be chained in memory. lines,
+if given, are read instead of <vcf><tmpextin> (e.g. converted as they are
+read, see pileup2vcf.pileup2vcf_lines). before, if given, is a stage run
+ahead of stage in the same pass (e.g. filterRecordsLines).
+"""
+def annotateFile(stage, vcf, tmpextin, tmpextout, logmode='a', sep='\t',
+    lines=None, before=None, **kwargs):
+    fh = open(vcf + tmpextin) if lines is None else None
+    fh_out = open(vcf + tmpextout, "w")
+    fh_log = open(vcf + '.count.log', logmode)
+    conn = u.db_connect()
+    cursor = conn.cursor()
+
+    records = vr.read_records(fh if lines is None else lines, sep=sep)
+    if before is not None:
+        records = before(records, cursor, fh_log,
+            format=kwargs.get('format', 'vcf'))
+    for record in stage(records, cursor, fh_log, **kwargs):
+        fh_out.write(vr.format_record(record) + '\n')
+
+    fh_log.close()
+    conn.close()
+    if fh is not None:
+        fh.close()
+    fh_out.close()
+
+
+"""Ids of the contigs named (in any spelling, see contigs.contig_id)
+"""
+def allowedContigs(names):
+    return frozenset(contigs.contig_id(name.strip()) for name in names)
+
+
+"""Whether filterRecordsLines keeps a record: header lines, and records on
+an allowed contig (see allowedContigs) whose ALT is not REF
+"""
+def passesFilter(record, allowed, format='vcf'):
+    if type(record) is str:
+        return record.startswith('#') or record.startswith('CHROM')
+    ref, alt = getAlleles(record, format=format)
+    return record.contig in allowed and alt != ref
+
+
+"""Drops what no stage should spend a lookup on: records with ALT equal
+to REF, records on contigs other than allowed_contigs (names; by default
+1 - 22, X, Y and MT, so no decoys or unplaced scaffolds) and lines that
+are not records. Runs ahead of the first stage; cursor is not used.
+"""
+def filterRecordsLines(records, cursor, fh_log, format='vcf',
+    allowed_contigs=None):
+    if allowed_contigs is None:
+        allowed_contigs = contigs.CANONICAL
+    allowed = allowedContigs(allowed_contigs)
+    dropped = 0
+    total = 0
+
+    for record in records:
+        if type(record) is str and (record.startswith('#') or
+            record.startswith('CHROM')):
+            yield record
+            continue
+        total = total + 1
+        if passesFilter(record, allowed, format=format):
+            yield record
+        else:
+            dropped = dropped + 1
+
+    fh_log.write(f"Filtered out: {str(dropped)} of {str(total)} records " +
+        "(other contigs, ALT equal to REF or not a record)\n")
+
+
+"""Runs filterRecordsLines on a stage file
+"""
+def filterRecords(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    allowed_contigs=None, sep='\t'):
+    annotateFile(filterRecordsLines, vcf, tmpextin, tmpextout, logmode='w',
+        format=format, allowed_contigs=allowed_contigs, sep=sep)
+
+
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
 """ 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
+def getSnpsFromDbSnpLines(records, cursor, fh_log, format='vcf',
+    varclass='SNV'):
     var_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
+    # Positions not in dbSNP at all need no query
+    bloom = pf.table_filter('dbSNP')
+    bloom_start = pf.snapshot(bloom)
+
+    def lookup(record):
+        if type(record) is str:
+            return None
+        if bloom is not None and not bloom.may_contain(record.contig,
+            record.pos):
+            return None
+        chr = contigs.ensembl_name(record.contig)
+
+        pos = record.pos
+        ref, alt = getAlleles(record, format=format)
+        ref = clean_mysql_chars(ref).strip()
+
+        compRef = getComplementary(ref)
+
+        sql = 'select * from dbSNP where CHR="' + str(chr) + \
+            '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+            '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
+            varclass + '" ;'
+        return lk.fetch_all(sql)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
+    for record, rows in lk.pipelined(records, lookup, cursor, name='dbSNP'):
+        if type(record) is not str:
+            if rows is None:
+                rows = []
+
+            ## reset rsid to "." - in case there was annotation from old release of dbSNP
+            record.id = '.'
             rsids = []
             mafs = []
             if (len(rows) > 0):
@@ -162,34 +294,34 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
                     maf_str = ';' + ';'.join([str(x) for x in mafs])
 
                 var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
+                if (str(record.info) == '.'):
+                    record.info.set('DB' + maf_str)
                 else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+                    record.info.append(';DB;VC=' + varclass + maf_str)
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+                record.id = str(';'.join(rsids))
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+            yield record
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + '\n')
+            yield record
 
+    pf.report('dbSNP', bloom, bloom_start)
     ratioInDbSnp = (var_count / float(linenum)) * 100
     fh_log.write("## Please notice that all Isoforms were counted\n")
     fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
     fh_log.write(f"Total: {str(linenum)}\n")
     fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+"""Runs getSnpsFromDbSnpLines on a stage file
+"""
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
+    annotateFile(getSnpsFromDbSnpLines, vcf, tmpextin, tmpextout, logmode='w',
+        format=format, varclass=varclass, sep=sep)
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -197,123 +329,80 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+def getBigRefGeneLines(records, cursor, fh_log, format='vcf'):
+    # The two exact-position tables are prefiltered
+    blooms = [pf.table_filter('chrom_pos_equal_base'),
+        pf.table_filter('chrom_pos_equal_nobase'), None]
+    bloom_starts = [pf.snapshot(bloom) for bloom in blooms]
+
+    def lookup(record):
+        if type(record) is str:
+            return None
+        chr = contigs.ensembl_name(record.contig)
+
+        pos = record.pos
+        ref, alt = getAlleles(record, format=format)
+        ref = clean_mysql_chars(ref).strip()
+        alt = clean_mysql_chars(alt).strip()
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + \
+            ' AND ((haplotypeReference="' + str(ref) + \
+            '" AND haplotypeAlternate ="' + str(alt) + \
+            '") OR (haplotypeReference="' + str(compRef) + \
+            '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+
+        sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
+            str(chr) + '" AND start = ' + str(pos) + ';'
+
+        sql3 = 'select * from chrom_pos_unequal where CHR="' + \
+            str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= end ;'
+
+        # Tables the prefilters rule out are not queried
+        return lk.first_with_rows([sql for sql, bloom in
+            zip((sql1, sql2, sql3), blooms) if bloom is None or
+            bloom.may_contain(record.contig, pos)])
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
     vcf_linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
-
+    for record, rows in lk.pipelined(records, lookup, cursor,
+        name='BigRefGene'):
+        if type(record) is not str:
             if (len(rows) > 0):
-                keep_going = False
                 m = set([])
                 for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+                record.info.append(';' + ';'.join(m))
+                if (record.info.startswith(".;")):
+                    record.info.set(str(record.info).replace('.;', '', 1))
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
+            yield record
 
             vcf_linenum = vcf_linenum + 1
 
         else:
-            fh_out.write(line + '\n')
+            yield record
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    pf.report('chrom_pos_equal_base', blooms[0], bloom_starts[0])
+    pf.report('chrom_pos_equal_nobase', blooms[1], bloom_starts[1])
 
 
-"""Get information about location in gene structures
+"""Runs getBigRefGeneLines on a stage file
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    annotateFile(getBigRefGeneLines, vcf, tmpextin, tmpextout,
+        format=format, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+
+"""Get information about location in gene structures
+"""
+def getGenesLines(records, cursor, fh_log, format='vcf', table='refGene',
+    promoter_offset=500):
 
     interGenic_count = 0
     cds_count = 0
@@ -325,25 +414,17 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     non_coding_exonic_count = 0
     promoter_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
+    for record in records:
+        if type(record) is not str:
+            chr = contigs.ucsc_name(record.contig)
 
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
+            pos = record.pos
+            ref, alt = getAlleles(record, format=format)
+            ref = clean_mysql_chars(ref).strip()
+            alt = clean_mysql_chars(alt).strip()
+            info_field = clean_mysql_chars(str(record.info)).strip()
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
@@ -351,8 +432,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                 str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
                 str(promoter_offset) +');'
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            rows = lk.cached(lk.fetch_all(sql), cursor)
             info = []
 
             if (len(rows) > 0):
@@ -388,7 +468,6 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
-                    pos = int(pos)
                     exons = []
                     exonsSt = exonStarts.split(',')
                     exonsEn = exonEnds.split(',')
@@ -421,8 +500,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                             'cpgIslandExt where chrom="' + str(chr) + \
                             '" AND (chromStart <= ' + str(pos) + \
                             ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = lk.cached(lk.fetch_one(sql), cursor)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -434,9 +512,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                             'cpgIslandExt where chrom="' + str(chr) + \
                             '" AND (chromStart <= ' + str(pos) + \
                             ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
+                        rows = lk.cached(lk.fetch_one(sql), cursor)
                         if (rows is not None):
                             region = 'putativePromoterRegion=' +  \
                                 "".join(str(rows[3]).split())
@@ -452,18 +528,18 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                     cnt = cnt + 1
 
                 str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                record.info.append(';' + str_info)
+                yield record
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
+                record.info.append(";positionType=interGenic")
+                yield record
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + '\n')
+            yield record
 
     print("Variants located:")
     fh_log.write("Variants located:\n")
@@ -495,24 +571,59 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     print(f"In Putative Promoter Region {str(promoter_count)}")
     fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
 
+"""Runs getGenesLines on a stage file
+"""
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    annotateFile(getGenesLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, promoter_offset=promoter_offset, sep=sep)
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
+
+"""Location in gene structures of every variant: SNVs through getGenesLines
+and indels through getExonsEtAlLines, each with its own counts. Both give
+back one record for every record they take, so each is fed one at a time.
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+def getGenesAndExonsLines(records, cursor, fh_log, format='vcf',
+    table='refGene', promoter_offset=500):
+    snvs = vr.RecordFeed()
+    indels = vr.RecordFeed()
+    snv_stage = getGenesLines(snvs, cursor, fh_log, format=format,
+        table=table, promoter_offset=promoter_offset)
+    indel_stage = getExonsEtAlLines(indels, cursor, fh_log, format=format,
+        table=table, promoter_offset=promoter_offset, title='Indels located:')
+
+    for record in records:
+        if type(record) is str:
+            yield record
+            continue
+        ref, alt = getAlleles(record, format=format)
+        if isIndel(ref.strip(), alt.strip()):
+            indels.append(record)
+            yield next(indel_stage)
+        else:
+            snvs.append(record)
+            yield next(snv_stage)
+
+    # Nothing left to feed them, so both finish and write their counts
+    for stage in (snv_stage, indel_stage):
+        for record in stage:
+            yield record
+
+
+"""Runs getGenesAndExonsLines on a stage file
+"""
+def getGenesAndExons(vcf, format='vcf', table='refGene', promoter_offset=500,
     tmpextin='.2', tmpextout='.3', sep='\t'):
+    annotateFile(getGenesAndExonsLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, promoter_offset=promoter_offset, sep=sep)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+title heads its counts in the log
+"""
+def getExonsEtAlLines(records, cursor, fh_log, format='vcf', table='refGene',
+    promoter_offset=500, title='Variants located:'):
 
     interGenic_count = 0
     cds_count = 0
@@ -524,33 +635,24 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     non_coding_exonic_count = 0
     promoter_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
+    for record in records:
+        if type(record) is not str:
+            chr = contigs.ucsc_name(record.contig)
+
+            pos = record.pos
+            ref, alt = getAlleles(record, format=format)
+            ref = clean_mysql_chars(ref).strip()
+            alt = clean_mysql_chars(alt).strip()
+            info_field = clean_mysql_chars(str(record.info)).strip()
             this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
 
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
                 '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
                 str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
                 str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            rows = lk.cached(lk.fetch_all(sql), cursor)
             info = []
             if (len(rows) > 0):
                 cnt = 1
@@ -568,7 +670,6 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                     promoter_plus = txtStart - int(promoter_offset)
                     promoter_minus = txtEnd + int(promoter_offset)
                     region = ""
-                    pos = int(pos)
                     exons = []
                     exonsSt = exonStarts.split(',')
                     exonsEn = exonEnds.split(',')
@@ -610,12 +711,12 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                         region = 'positionType=utr5'
 
                     elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
+                        (cdsStart < cdsEnd) and (strand == "+")):
                         utr3_count = utr3_count + 1
                         region = 'positionType=utr3'
 
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
+                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                        (cdsStart < cdsEnd) and (strand == "-")):
                         utr5_count = utr5_count + 1
                         region = 'positionType=utr5'
 
@@ -630,8 +731,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                             'from cpgIslandExt where chrom="' + str(chr) +  \
                             '" AND (chromStart <= ' + str(pos) + ' AND ' + \
                             str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = lk.cached(lk.fetch_one(sql), cursor)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -644,8 +744,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                             'from cpgIslandExt where chrom="' + str(chr) + \
                             '" AND (chromStart <= ' + str(pos) + ' AND ' + \
                             str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+                        rows = lk.cached(lk.fetch_one(sql), cursor)
 
                         if (rows is not None):
                             region = 'putativePromoterRegion=' + \
@@ -663,21 +762,21 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                     cnt = cnt + 1
 
                 str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+                record.info.append(';' + str_info)
+                yield record
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
+                record.info.append(";positionType=interGenic")
+                yield record
                 interGenic_count = interGenic_count + 1
 
             linenum = linenum + 1
 
         else:
-            fh_out.write(line + '\n')
+            yield record
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+    print(title)
+    fh_log.write(title + "\n")
 
     print(f"In interGenic {str(interGenic_count)}")
     fh_log.write(f"In interGenic {str(interGenic_count)}\n")
@@ -706,698 +805,329 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     print(f"In Putative Promoter Region {str(promoter_count)}")
     fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
 
-
-"""Overlap with tfbsConsSites
+"""Runs getExonsEtAlLines on a stage file
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
+    annotateFile(getExonsEtAlLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, promoter_offset=promoter_offset, sep=sep)
+
+
+"""Overlap with an annotation source (see sources.py)
+source is an AnnotationSource or the name of a registered one, and table
+reads it from another table with the same layout. Lookups are resolved in
+blocks of batch_size from an interval index of each contig (see
+intervals.py) when batching is on, and per variant otherwise, with
+exact-position lookups prefiltered (see prefilter.py) where a filter is
+loaded and kept in flight together where a lookup pool is (see lookups.py).
+Variants spanning more than one base are looked up per variant.
+"""
+def addOverlapWithSourceLines(records, cursor, fh_log, format='vcf',
+    source=None, table=None, batch_size=None):
 
-    allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
-        '14','15','16','17','18','19','20','21','22','X','Y']
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    if type(source) is str:
+        source = src.source(source, table)
+    else:
+        source = source.with_table(table)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+    regions = iv.IntervalTable(cursor, source.select,
+        start_column=source.start_column, end_column=source.end_column)
+    if batch_size is None:
+        batch_size = iv.default_batch_size()
+    bloom = None
+    if source.match == 'position':
+        bloom = pf.table_filter(source.table)
+    bloom_start = pf.snapshot(bloom)
+
+    def span(record):
+        if source.match == 'span':
+            return getSpan(record, format=format)
+        return record.pos, record.pos
+
+    # Variants the interval index has not resolved are looked up one by one
+    def lookup(pair):
+        record, overlapping = pair
+        if type(record) is str:
+            return None
+        start, end = span(record)
+        if overlapping is not None and start == end:
+            return None
+        sql = source.lookup(record.contig, start, end)
+        if sql is None or (bloom is not None and
+            not bloom.may_contain(record.contig, start)):
+            return None
+        return lk.fetch_all(sql)
+
+    for (record, overlapping), rows in lk.pipelined(
+        iv.overlapping_rows(records, regions, batch_size), lookup, cursor,
+        name=source.table):
+        if type(record) is str:
+            yield record
+            continue
+
+        start, end = span(record)
+        if overlapping is not None and start == end:
+            rows = overlapping
+        elif rows is None:
+            rows = []
+
+        if (len(rows) > 0):
+            line_count = line_count + 1
+            if source.first_row:
+                var_count = var_count + 1
+            else:
+                var_count = var_count + len(rows)
+            annotation = source.annotation(source, rows, start, end)
+            if record.info.endswith(';') and not source.always_separate:
+                record.info.append(annotation)
+            else:
+                record.info.append(';' + annotation)
+            if source.record_sep is not None:
+                record.sep = source.record_sep
+        yield record
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+    pf.report(source.table, bloom, bloom_start)
+    fh_log.write(f"In {str(source.name)}: {str(var_count)} in " + \
+        f"{str(line_count)} variants\n")
 
-                    fh_out.write('\t'.join(fields) + '\n')
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+"""Runs addOverlapWithSourceLines on a stage file
+"""
+def addOverlapWithSource(vcf, source, format='vcf', table=None, tmpextin='',
+    tmpextout='.1', sep='\t', batch_size=None):
+    annotateFile(addOverlapWithSourceLines, vcf, tmpextin, tmpextout,
+        format=format, source=source, table=table, sep=sep,
+        batch_size=batch_size)
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
 
-        linenum = linenum + 1
+"""Overlap with tfbsConsSites
+"""
+def addOverlapWithTfbsConsSitesLines(records, cursor, fh_log, format='vcf',
+    table='tfbsConsSites', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='tfbsConsSites', table=table, batch_size=batch_size)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Runs addOverlapWithTfbsConsSitesLines on a stage file
+"""
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t', batch_size=None):
+    annotateFile(addOverlapWithTfbsConsSitesLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, batch_size=batch_size)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+def addOverlapWithGadAllLines(records, cursor, fh_log, format='vcf',
+    table='gadAll', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='gadAll', table=table, batch_size=batch_size)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Runs addOverlapWithGadAllLines on a stage file
+"""
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t', batch_size=None):
+    annotateFile(addOverlapWithGadAllLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, batch_size=batch_size)
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+def addOverlapWithGwasCatalogLines(records, cursor, fh_log, format='vcf',
+    table='gwasCatalog', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='gwasCatalog', table=table, batch_size=batch_size)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Runs addOverlapWithGwasCatalogLines on a stage file
+"""
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', batch_size=None):
+    annotateFile(addOverlapWithGwasCatalogLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, batch_size=batch_size)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def addOverlapWitHUGOGeneNomenclatureLines(records, cursor, fh_log,
+    format='vcf', table='hugo', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='hugo', table=table, batch_size=batch_size)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Runs addOverlapWitHUGOGeneNomenclatureLines on a stage file
+"""
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t', batch_size=None):
+    annotateFile(addOverlapWitHUGOGeneNomenclatureLines, vcf, tmpextin,
+        tmpextout, format=format, table=table, sep=sep, batch_size=batch_size)
 
 
 """Overlap with segdup regions genomicSuperDups
+Variants that span more than one base (indels, SVs) are matched by range,
+and get how many of their bases the segdups cover and what percentage.
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def addOverlapWithGenomicSuperDupsLines(records, cursor, fh_log, format='vcf',
+    table='genomicSuperDups', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='genomicSuperDups', table=table, batch_size=batch_size)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Runs addOverlapWithGenomicSuperDupsLines on a stage file
+"""
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    batch_size=None):
+    annotateFile(addOverlapWithGenomicSuperDupsLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, batch_size=batch_size)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = 'name'
-    name2 = 'name2'
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+def addOverlapWithRefGeneLines(records, cursor, fh_log, format='vcf',
+    table='refGene', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='refGene', table=table, batch_size=batch_size)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Runs addOverlapWithRefGeneLines on a stage file
+"""
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
+    tmpextin='', tmpextout='.1', sep='\t', batch_size=None):
+    annotateFile(addOverlapWithRefGeneLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, batch_size=batch_size)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
-
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+def addOverlapWithCytobandLines(records, cursor, fh_log, format='vcf',
+    table='cytoBand', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='cytoBand', table=table, batch_size=batch_size)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+"""Runs addOverlapWithCytobandLines on a stage file
+"""
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t', batch_size=None):
+    annotateFile(addOverlapWithCytobandLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, batch_size=batch_size)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+"""Method to find overlap with CNV tables
+"""
+def addOverlapWithCnvDatabaseLines(records, cursor, fh_log, format='vcf',
+    table='dgv_Cnv', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='dgv_Cnv', table=table, batch_size=batch_size)
 
 
-"""Method to find overlap with CNV tables
+"""Runs addOverlapWithCnvDatabaseLines on a stage file
 """
 def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    tmpextin='', tmpextout='.1', sep='\t', batch_size=None):
+    annotateFile(addOverlapWithCnvDatabaseLines, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, batch_size=batch_size)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+"""Method to find overlap with several CNV tables in one pass
+A single query per variant answers every table, and the flags and log
+lines are those of addOverlapWithCnvDatabaseLines run once per table.
+Variants that span more than one base (indels, SVs) are matched by range
+and also get, per table, how many of their bases it covers and what
+percentage.
+"""
+def addOverlapWithCnvDatabasesLines(records, cursor, fh_log, format='vcf',
+    tables=cnvTables):
+
+    var_counts = [0] * len(tables)
+    line_counts = [0] * len(tables)
+
+    def lookup(record):
+        if type(record) is str:
+            return None
+        chr = contigs.ucsc_name(record.contig)
+
+        start, end = getSpan(record, format=format)
+        if start == end:
+            return lk.fetch_one('select ' + ', '.join(['exists (select 1 ' + \
+                'from ' + table + ' where chrom="' + str(chr) + \
+                '" AND (chromStart <= ' + str(start) + ' AND ' + \
+                str(start) + ' <= chromEnd))' for table in tables]) + ';')
+        # Every overlapping region, tagged with its table's index
+        return lk.fetch_all(' union all '.join(['select ' + str(i) + \
+            ', chromStart, chromEnd from ' + tables[i] + \
+            ' where chrom="' + str(chr) + '" AND (chromStart <= ' + \
+            str(end) + ' AND ' + str(start) + ' <= chromEnd)'
+            for i in range(len(tables))]) + ';')
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
+    for record, rows in lk.pipelined(records, lookup, cursor,
+        name='CNV databases'):
+        if type(record) is not str:
+            start, end = getSpan(record, format=format)
+            if start == end:
+                flags = rows
+                regions = None
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
+                regions = [[] for table in tables]
+                for i, chromStart, chromEnd in rows:
+                    regions[int(i)].append((int(chromStart), int(chromEnd)))
+                flags = [len(overlapping) > 0 for overlapping in regions]
+
+            for i in range(len(tables)):
+                if flags[i]:
+                    line_counts[i] = line_counts[i] + 1
+                    var_counts[i] = var_counts[i] + 1
                     isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
+                    if record.info.endswith(";"):
+                        record.info.append(str(tables[i]) + '=' + \
+                            str(isOverlap))
                     else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+                        record.info.append(';' + str(tables[i]) + \
+                            '=' + str(isOverlap))
+                    if regions is not None:
+                        record.info.append(';' + str(tables[i]) + \
+                            'Overlap=' + \
+                            str(u.coveredLength(start, end, regions[i])) + \
+                            ';' + str(tables[i]) + 'PctOverlap=' + \
+                            str(u.proportionCovered(start, end, regions[i])))
+            yield record
 
             linenum = linenum + 1
         else:
-            fh_out.write(line + '\n')
+            yield record
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    for i in range(len(tables)):
+        fh_log.write(f"In {str(tables[i])}: {str(var_counts[i])} in " + \
+            f"{str(line_counts[i])} variants\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
-
-"""Method to find overlap with targetScanS tables
+"""Runs addOverlapWithCnvDatabasesLines on a stage file
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+def addOverlapWithCnvDatabases(vcf, format='vcf', tables=cnvTables,
     tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    annotateFile(addOverlapWithCnvDatabasesLines, vcf, tmpextin, tmpextout,
+        format=format, tables=tables, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+"""Method to find overlap with targetScanS tables
+"""
+def addOverlapWithMiRNALines(records, cursor, fh_log, format='vcf',
+    table='targetScanS', batch_size=None):
+    return addOverlapWithSourceLines(records, cursor, fh_log, format=format,
+        source='targetScanS', table=table, batch_size=batch_size)
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
-
-### EOF
\ No newline at end of file
+"""Runs addOverlapWithMiRNALines on a stage file
+"""
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t', batch_size=None):
+    annotateFile(addOverlapWithMiRNALines, vcf, tmpextin, tmpextout,
+        format=format, table=table, sep=sep, batch_size=batch_size)
@@ -1,9 +1,16 @@
 import boto3
 from botocore.exceptions import ClientError
 import subprocess
+import signal
 import sys
 import json
 import os
+import contigs
+import job_lease
+import lookups
+import reference
+import jobs
+import result_cache
 
 # Get configuration
 from configparser import SafeConfigParser
@@ -24,6 +31,32 @@ except Exception as e:
     print("Error has occured accessing the s3 client:", str(e))
     sys.exit(1)
 
+# Records the interval stages resolve per batch (see intervals.py); run.py
+# inherits ANN_BATCH_SIZE
+os.environ['ANN_BATCH_SIZE'] = config['code']['IntervalBatchSize']
+# Queries the per-variant stages keep in flight (see lookups.py); run.py
+# inherits ANN_LOOKUP_CONCURRENCY
+os.environ['ANN_LOOKUP_CONCURRENCY'] = config['code']['LookupConcurrency']
+# Size and save pace of the lookup cache (see lookups.py); its file comes
+# with the reference version
+os.environ['ANN_LOOKUP_CACHE_ENTRIES'] = config['lookupcache']['MaxEntries']
+os.environ['ANN_LOOKUP_CACHE_INTERVAL'] = \
+    config['lookupcache']['SaveInterval']
+
+# Reference version new jobs run against, with its prefilters and interval
+# index snapshots (see reference.py); a newly published version is loaded
+# in the background and taken up without a restart
+references = reference.ReferenceManager(s3, config, job_directory)
+
+# Start with the lookups earlier annotators on this instance cached for the
+# current version; the cache is saved as jobs run and when this process is
+# stopped (SIGTERM on scale-in exits through atexit)
+lookups.shared_cache(references.current.lookup_cache_file)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+# run.py processes still running, with the reference version of each
+running_jobs = []
+
 # Connect to the dynamoDB client
 try:
     dynamo = boto3.resource('dynamodb')
@@ -51,6 +84,15 @@ except Exception as e:
 
 # Poll the message queue in a loop
 while True:
+    # Hand back the reference versions of finished jobs, and look for a new
+    # version
+    for job, version in list(running_jobs):
+        if job.poll() is not None:
+            running_jobs.remove((job, version))
+            references.release(version)
+    references.poll()
+    lookups.flush_cache(due_only=True)
+
     # Attempt to read a message from the queue
     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html#
     # Use long polling - DO NOT use sleep() to wait between polls
@@ -60,6 +102,7 @@ while True:
             QueueUrl=request_queue_url,
             MaxNumberOfMessages=1,
             WaitTimeSeconds=20,
+            AttributeNames=['ApproximateReceiveCount'],
         )
     except Exception as e:
         print(f"Error has occured while recieveing message from {request_queue_url}", str(e))
@@ -87,8 +130,104 @@ while True:
         user_name = user_profile['name']
         user_email = user_profile['email']
         user_role = user_profile['role']
+        # Annotation profile the job asked for (see [profiles]); an unknown
+        # one is annotated with the default profile rather than failed
+        annotation_profile = data.get('annotation_profile') or ''
+        try:
+            jobs.job_stages(annotation_profile)
+        except ValueError as e:
+            print(f"{str(e)} for job_id: {job_id}, using the default profile")
+            annotation_profile = ''
+        # BED file of the regions of interest in the inputs bucket, if any
+        s3_key_regions_file = data.get('s3_key_regions_file') or ''
+        # 'input' to get the results in input order if inputs are sorted
+        output_order = data.get('output_order') or ''
     
         print(f"message for job id: {job_id} recieved")
+
+        # Keep the message hidden while the input is downloaded; run.py
+        # keeps extending this for as long as the job is running
+        try:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility.html
+            sqs.change_message_visibility(
+                QueueUrl=request_queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=int(config['code']['MessageVisibilityTimeout'])
+            )
+        except ClientError as e:
+            print(f"Error extending visibility of message for job_id: {job_id}", str(e))
+
+        # Claim the job before any download or compute, so that duplicate
+        # deliveries of the request are dropped right away. A RUNNING job
+        # whose lease ran out lost its worker and is taken over here.
+        lease_seconds = int(config['code']['JobLeaseSeconds'])
+        try:
+            lease_token = job_lease.claim_job(table, job_id, lease_seconds)
+        except ClientError as e:
+            print(f"Error has occured claiming job_id: {job_id}", str(e))
+            continue # The message becomes visible again and is retried
+
+        if lease_token is None:
+            try:
+                status, remaining = job_lease.lease_state(table, job_id)
+                if status in ('COMPLETED', 'FAILED', None):
+                    # Done with already, or there is no such job to run
+                    sqs.delete_message(
+                        QueueUrl=request_queue_url,
+                        ReceiptHandle=receipt_handle
+                    )
+                    print(f"Dropped duplicate request for job {job_id}")
+                elif remaining > 0:
+                    # Another worker holds the job; look again once its lease
+                    # would have run out in case that worker dies
+                    sqs.change_message_visibility(
+                        QueueUrl=request_queue_url,
+                        ReceiptHandle=receipt_handle,
+                        VisibilityTimeout=min(remaining + 1, 43200)
+                    )
+                    print(f"Job {job_id} is held by another worker, skipping")
+                else:
+                    # The lease ran out since the claim was tried (its worker
+                    # died); the request is claimed again on its next receive
+                    sqs.change_message_visibility(
+                        QueueUrl=request_queue_url,
+                        ReceiptHandle=receipt_handle,
+                        VisibilityTimeout=0
+                    )
+                    print(f"Lease on job {job_id} just ran out, retrying")
+            except ClientError as e:
+                print(f"Error handling duplicate request for job_id: {job_id}", str(e))
+            continue
+
+        print("Table Updated to RUNNING")
+
+        # Small inputs are annotated right here, in memory, by this already
+        # running process; spawning run.py and staging files on disk would
+        # cost more than the annotation itself. Only on their first delivery
+        # though: one that failed here goes through run.py instead, so it
+        # cannot hold up this loop again and again
+        receive_count = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+        try:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+            input_size = s3.head_object(Bucket=s3_inputs_bucket, Key=s3_key_input_file)['ContentLength']
+        except ClientError as e:
+            print(f"Error has occured reading the size of the inputfile: {input_file_name} job_id: {job_id}", str(e))
+            input_size = None
+
+        if input_size is not None and input_size <= int(config['code']['InMemoryMaxBytes']) and receive_count == 1:
+            version = references.acquire()
+            version.activate()
+            try:
+                jobs.run_small_job(s3_inputs_bucket, s3_key_input_file, input_file_name, user_id, job_id, user_name, user_email, user_role, request_queue_url, receipt_handle, lease_token, annotation_profile, s3_key_regions_file, output_order)
+                print(f"Annotated job_id: {job_id} in memory")
+            except Exception as e:
+                # The job is retried through run.py once its lease and the
+                # message's visibility timeout run out
+                print(f"Error has occured annotating job_id: {job_id} in memory", str(e))
+            references.release(version)
+            # Scaffold names of the job's input are not kept between jobs
+            contigs.release_others()
+            continue
             
         # Use a local directory structure that makes it easy to organize
         # multiple running annotation jobs
@@ -112,40 +251,38 @@ while True:
             sys.exit(1) # If cannot read messages critical
             
         print(f"Downloaded file {s3_key_input_file} from {s3_inputs_bucket}")
-        
-        # Update Table to Running
+
+        regions_file_path = ''
+        if s3_key_regions_file:
+            regions_file_path = job_id_directory + 'regions.bed'
+            try:
+                s3.download_file(s3_inputs_bucket, s3_key_regions_file, regions_file_path)
+            except Exception as e:
+                print(f"Error has occured downloading the regions file of job_id: {job_id} from the s3 client:", str(e))
+                sys.exit(1) # If cannot read messages critical
+
+        # Hash the input so identical inputs can reuse earlier results
+        input_hash = result_cache.hash_file(filepath)
         try:
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
             table.update_item(
                 Key={'job_id': job_id},
-                UpdateExpression='SET job_status = :running',
-                ConditionExpression= 'job_status = :pending',
-                ExpressionAttributeValues={":running": "RUNNING", ":pending": "PENDING"}
-        )
-        except Exception as e:
-            print(f"Error has occured updating the table item to running for job_id: {job_id}", str(e))
-            sys.exit(1) # If cannot read messages critical
-        
-        print("Table Updated to RUNNING")
+                UpdateExpression='SET input_hash = :input_hash',
+                ExpressionAttributeValues={":input_hash": input_hash}
+            )
+        except ClientError as e:
+            print(f"Error has occured recording the input hash for job_id: {job_id}", str(e))
         
         # Launch annotation job as a background process
+        # run.py deletes the message once the job is complete
         file_name_without_extension = input_file_name.split('.')[0]
         try:
-            command = ['python', 'run.py', filepath, file_name_without_extension, job_id_directory, user_id, job_id, user_name, user_email, user_role]
-            job = subprocess.Popen(command)
+            command = ['python', 'run.py', filepath, file_name_without_extension, job_id_directory, user_id, job_id, user_name, user_email, user_role, request_queue_url, receipt_handle, lease_token, input_hash, annotation_profile, regions_file_path, output_order]
+            version = references.acquire()
+            job = subprocess.Popen(command,
+                env=version.environment(os.environ))
+            running_jobs.append((job, version))
         except Exception as e:
             print(f"Error has occured launching the annotation job for job_id: {job_id}", str(e))
             sys.exit(1) # If cannot read messages critical
-            
-        # Delete the message from the queue, if job was successfully submitted
-        if job:
-            try:
-                sqs.delete_message(
-                    QueueUrl=request_queue_url,
-                    ReceiptHandle=receipt_handle
-                )
-            except botocore.exceptions.ClientError as e:
-                print(f"Error when deleting message with Receipt Handle: {receipt_handle}", str(e))
-                sys.exit(1) # Critical error if we cannot delete messages. Exit program
-        
-        print("Delete of message complete")
\ No newline at end of file
+
+        print(f"Launched annotation job for job_id: {job_id}")
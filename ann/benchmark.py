@@ -0,0 +1,211 @@
+# benchmark.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Throughput benchmark of the annotation pipeline against a local
+# reference fixture
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import io
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+
+import reference_fixture
+import vcf_synth
+
+"""Cursor that counts the statements it executes
+"""
+class CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter['queries'] = self.counter['queries'] + 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""Connection whose cursors count the statements they execute
+"""
+class CountingConnection(object):
+    def __init__(self, conn, counter):
+        self.conn = conn
+        self.counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self.conn.cursor(*args, **kwargs), self.counter)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+"""Number of variant records (non-header lines) in a VCF file
+"""
+def count_variants(vcf):
+    count = 0
+    fh = open(vcf)
+    for line in fh:
+        if line.strip() and not line.startswith('#'):
+            count = count + 1
+    fh.close()
+    return count
+
+
+"""Prefilter hits and skips between two prefilter.counters() results,
+for the tables whose filters were used
+"""
+def prefilter_delta(before, after):
+    delta = {}
+    for table, counts in after.items():
+        previous = before.get(table, {'hits': 0, 'skips': 0})
+        hits = counts['hits'] - previous['hits']
+        skips = counts['skips'] - previous['skips']
+        if hits or skips:
+            delta[table] = {'hits': hits, 'skips': skips}
+    return delta
+
+
+"""Annotates one input with driver.run and measures it
+Runs in a fresh worker process (see benchmark) so that the peak resident
+set size belongs to this input alone.
+"""
+def benchmark_file(vcf, fixture):
+    os.environ['ANN_REFERENCE_DB'] = fixture
+    import utils
+    import driver
+    import prefilter
+
+    counter = {'queries': 0}
+    db_connect = utils.db_connect
+    utils.db_connect = lambda: CountingConnection(db_connect(), counter)
+
+    work_directory = tempfile.mkdtemp(prefix='ann-bench-')
+    infile = os.path.join(work_directory, os.path.basename(vcf))
+    shutil.copy(vcf, infile)
+    variants = count_variants(infile)
+
+    stages = []
+    last = {'time': time.perf_counter(), 'queries': 0, 'prefilter': {}}
+    def on_stage_complete(stage, path):
+        now = time.perf_counter()
+        counts = prefilter.counters()
+        stages.append({'stage': driver.STAGES[stage - 1][0],
+                       'seconds': now - last['time'],
+                       'queries': counter['queries'] - last['queries'],
+                       'prefilter': prefilter_delta(last['prefilter'], counts)})
+        last['time'] = now
+        last['queries'] = counter['queries']
+        last['prefilter'] = counts
+
+    start = time.perf_counter()
+    # The stages print their progress and counts
+    with contextlib.redirect_stdout(io.StringIO()):
+        driver.run(infile, 'vcf', on_stage_complete=on_stage_complete)
+    seconds = time.perf_counter() - start
+    shutil.rmtree(work_directory, ignore_errors=True)
+
+    return {
+        'input': os.path.basename(vcf),
+        'variants': variants,
+        'seconds': seconds,
+        'variants_per_second': variants / seconds if seconds > 0 else None,
+        # Kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'queries': counter['queries'],
+        'stages': stages
+    }
+
+
+"""Benchmarks every input against the fixture, repeat times each
+Every run gets its own worker process.
+"""
+def benchmark(inputs, fixture, repeat=1):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for vcf in inputs:
+        for i in range(repeat):
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                result = pool.apply(benchmark_file, (vcf, fixture))
+            result['run'] = i + 1
+            results.append(result)
+            print(f"{result['input']} run {result['run']}: "
+                f"{result['variants']} variants in {result['seconds']:.2f}s "
+                f"({result['variants_per_second']:.0f} variants/s), "
+                f"{result['queries']} queries, "
+                f"peak RSS {result['peak_rss_kb'] / 1024:.0f} MB",
+                file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark driver.run against a local reference fixture')
+    parser.add_argument('inputs', nargs='*',
+        help='VCF files to annotate (default: the bundled data/*.vcf)')
+    parser.add_argument('--synthetic', type=int, action='append', default=[],
+        metavar='N', help='also annotate a synthetic input of N records')
+    parser.add_argument('--fixture',
+        help='reference fixture to use (built in a temporary file if absent)')
+    parser.add_argument('--seed', type=int, default=7,
+        help='seed of the reference fixture and synthetic inputs (default: 7)')
+    parser.add_argument('--repeat', type=int, default=1,
+        help='runs per input (default: 1)')
+    parser.add_argument('--label', default='',
+        help='free-form label stored with the results, e.g. a commit')
+    parser.add_argument('--output', help='write the results JSON here')
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix='ann-bench-')
+    fixture = args.fixture
+    if fixture is None or not os.path.exists(fixture):
+        fixture = reference_fixture.build_fixture(
+            fixture or os.path.join(scratch, 'reference.db'), seed=args.seed)
+
+    inputs = args.inputs or sorted(glob.glob(
+        os.path.join(reference_fixture.DATA_DIRECTORY, '*.vcf')))
+    if args.synthetic:
+        profile = vcf_synth.default_profile()
+    for n in args.synthetic:
+        inputs.append(vcf_synth.generate(profile, n,
+            os.path.join(scratch, f"synthetic_{n}.vcf"), seed=args.seed))
+
+    import driver
+    report = {
+        'label': args.label,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'pipeline_version': driver.PIPELINE_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'fixture_seed': args.seed,
+        'results': benchmark(inputs, fixture, repeat=args.repeat)
+    }
+    shutil.rmtree(scratch, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,121 @@
+# checkpoint.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Per-stage checkpoints of running annotation jobs
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import os
+import logging
+from botocore.exceptions import ClientError
+
+"""S3 keys of the checkpoint objects for a completed stage
+Keys carry the stage number so that a new checkpoint never overwrites the
+one currently recorded on the job item
+"""
+def checkpoint_keys(prefix, file_name, stage):
+    stage_key = f"{prefix}/checkpoint/{file_name}.{stage}"
+    log_key = f"{prefix}/checkpoint/{file_name}.{stage}.count.log"
+    return stage_key, log_key
+
+
+"""Uploads the output of a completed stage and the count log so far, then
+records the checkpoint on the job item. The previous checkpoint objects are
+removed only once the job item points at the new ones. stage_name is kept
+with the stage number so a checkpoint is not resumed by a pipeline whose
+stages are laid out differently, and reference_version and pipeline (see
+driver.pipeline_version) so it is not resumed against other reference data
+or by a pipeline that filters, prunes or sorts differently.
+"""
+def save_checkpoint(s3, table, bucket, prefix, job_id, infile, stage,
+    previous_stage=0, lease_token=None, stage_name='', reference_version='',
+    pipeline=''):
+
+    file_name = os.path.basename(infile)
+    stage_key, log_key = checkpoint_keys(prefix, file_name, stage)
+
+    s3.upload_file(infile + '.' + str(stage), bucket, stage_key)
+    s3.upload_file(infile + '.count.log', bucket, log_key)
+
+    condition = 'job_status = :running'
+    values = {":stage": stage,
+              ":stage_name": stage_name,
+              ":reference_version": reference_version,
+              ":pipeline": pipeline,
+              ":stage_key": stage_key,
+              ":log_key": log_key,
+              ":running": "RUNNING"}
+    # Only the worker holding the lease may move the checkpoint
+    if lease_token is not None:
+        condition = condition + ' AND lease_token = :lease_token'
+        values[":lease_token"] = lease_token
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+    table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET checkpoint_stage = :stage, checkpoint_stage_name = :stage_name, checkpoint_reference_version = :reference_version, checkpoint_pipeline = :pipeline, s3_key_checkpoint_file = :stage_key, s3_key_checkpoint_log = :log_key',
+        ConditionExpression=condition,
+        ExpressionAttributeValues=values
+    )
+
+    if previous_stage > 0:
+        delete_checkpoint(s3, bucket, prefix, file_name, previous_stage)
+
+
+"""Restores the latest checkpoint recorded on the job item into the job
+directory. Returns the stage to resume from (0 if there is nothing to resume)
+stage_names are the names of the stages that will run, which must match
+the stage the checkpoint was taken after; reference_version and pipeline,
+if given, must match those the checkpoint was taken with.
+"""
+def load_checkpoint(s3, bucket, item, infile, stage_names=None,
+    reference_version=None, pipeline=None):
+    stage = int(item.get('checkpoint_stage', 0))
+    if stage == 0:
+        return 0
+    if stage_names is not None and (stage > len(stage_names) or
+        item.get('checkpoint_stage_name') != stage_names[stage - 1]):
+        print(f"Checkpoint for stage {stage} is from another stage layout, "
+            "starting over")
+        return 0
+    if reference_version is not None and \
+        item.get('checkpoint_reference_version') != reference_version:
+        print(f"Checkpoint for stage {stage} is from another reference "
+            "version, starting over")
+        return 0
+    if pipeline is not None and item.get('checkpoint_pipeline') != pipeline:
+        print(f"Checkpoint for stage {stage} is from another pipeline, "
+            "starting over")
+        return 0
+
+    try:
+        s3.download_file(bucket, item['s3_key_checkpoint_file'],
+            infile + '.' + str(stage))
+        s3.download_file(bucket, item['s3_key_checkpoint_log'],
+            infile + '.count.log')
+    except ClientError as e:
+        print(f"Unable to restore checkpoint for stage {stage}, starting over")
+        logging.error(e)
+        return 0
+
+    return stage
+
+
+"""Removes the checkpoint objects of a stage
+"""
+def delete_checkpoint(s3, bucket, prefix, file_name, stage):
+    stage_key, log_key = checkpoint_keys(prefix, file_name, stage)
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/delete_objects.html
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': stage_key}, {'Key': log_key}]}
+        )
+    except ClientError as e:
+        print(f"Failed to delete checkpoint objects for stage {stage}")
+        logging.error(e)
+
+### EOF
@@ -0,0 +1,89 @@
+# contigs.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Canonical contig dictionary and packed genomic position keys
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+# Canonical (GRCh37) names, in karyotype order; a contig's id is its
+# position in this list plus one
+CANONICAL = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+# Contigs the reference has per-chromosome tables for (e.g. tfbsConsSites1)
+NUCLEAR_CONTIGS = len(CANONICAL) - 1
+
+POS_BITS = 32
+POS_MASK = (1 << POS_BITS) - 1
+
+# id -> name as the dbSNP/gadAll tables spell it, and as UCSC tables do
+ENSEMBL_NAMES = [None] + CANONICAL
+UCSC_NAMES = [None] + ['chr' + name for name in CANONICAL[:-1]] + ['chrM']
+
+# Every spelling seen in inputs -> id
+CONTIG_IDS = {}
+for contig, name in enumerate(CANONICAL, start=1):
+    CONTIG_IDS[name] = contig
+    CONTIG_IDS['chr' + name] = contig
+CONTIG_IDS['M'] = CONTIG_IDS['chrM'] = CONTIG_IDS['MT']
+
+
+"""Id of a contig from any of its spellings (1/chr1, MT/M/chrM, ...)
+Contigs outside the canonical set (unplaced scaffolds, haplotypes) get the
+next free id the first time they are seen, so their ids are only stable
+until release_others; anything persisted stores names alongside ids.
+"""
+def contig_id(name):
+    contig = CONTIG_IDS.get(name)
+    if contig is None:
+        bare = name[3:] if name.startswith('chr') else name
+        contig = CONTIG_IDS.get(bare)
+        if contig is None:
+            contig = len(ENSEMBL_NAMES)
+            ENSEMBL_NAMES.append(bare)
+            UCSC_NAMES.append('chr' + bare)
+            CONTIG_IDS[bare] = contig
+        CONTIG_IDS[name] = contig
+    return contig
+
+
+"""Forgets the contigs outside the canonical set seen so far and gives
+their ids out again, so a long-running process (annotator.py, between
+in-memory jobs) keeps only the names of the job at hand rather than every
+scaffold name its inputs ever had. Call it only when nothing still holds
+such ids (records, region sets, interval tables).
+"""
+def release_others():
+    del ENSEMBL_NAMES[len(CANONICAL) + 1:]
+    del UCSC_NAMES[len(CANONICAL) + 1:]
+    for name in [name for name, contig in CONTIG_IDS.items()
+        if contig > len(CANONICAL)]:
+        del CONTIG_IDS[name]
+
+
+"""Name of a contig without the chr prefix (1, X, MT)
+"""
+def ensembl_name(contig):
+    return ENSEMBL_NAMES[contig]
+
+
+"""Name of a contig in UCSC style (chr1, chrX, chrM)
+"""
+def ucsc_name(contig):
+    return UCSC_NAMES[contig]
+
+
+"""Packs a contig id and position into one 64-bit key
+Keys sort by contig (in karyotype order) and then by position.
+"""
+def pack(contig, pos):
+    return (contig << POS_BITS) | pos
+
+
+"""Splits a packed key back into (contig id, position)
+"""
+def unpack(key):
+    return (key >> POS_BITS, key & POS_MASK)
+
+### EOF
@@ -0,0 +1,587 @@
+# delta.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Incremental re-annotation of stored results after a reference update:
+# only the records that touch rows that changed are annotated again
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import io
+import os
+import re
+import sys
+import gzip
+import json
+import array
+import shutil
+import posixpath
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+import collections
+
+import contigs
+import prefilter
+import sources
+import intervals as iv
+import lookups as lk
+import vcf_record as vr
+
+FORMAT_VERSION = 1
+
+# Reference tables of the stages that do not read an annotation source:
+# (table, contig column, start column, end column, bases a lookup reaches
+# beyond the row). The refGene stage looks promoter_offset bases past each
+# transcript.
+STAGE_TABLES = [
+    ('dbSNP', 'CHR', 'POS', 'POS', 0),
+    ('chrom_pos_equal_base', 'CHR', 'start', 'start', 0),
+    ('chrom_pos_equal_nobase', 'CHR', 'start', 'start', 0),
+    ('chrom_pos_unequal', 'CHR', 'start', 'end', 0),
+    ('refGene', 'chrom', 'txStart', 'txEnd', 500),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd', 0),
+]
+
+
+"""Every reference table the stages read, as in STAGE_TABLES, with those
+of the annotation sources taken from the registry (see sources.py)
+"""
+def delta_tables():
+    tables = list(STAGE_TABLES)
+    listed = set(table[0] for table in tables)
+    for source in sources.SOURCES.values():
+        if source.per_contig:
+            names = [source.table_name(contig)
+                for contig in range(1, contigs.NUCLEAR_CONTIGS + 1)]
+        else:
+            names = [source.table]
+        for name in names:
+            if name not in listed:
+                listed.add(name)
+                tables.append((name, source.chrom_column,
+                    source.start_column, source.end_column, 0))
+    return tables
+
+
+"""Connection to a reference snapshot: a SQLite file (see
+reference_fixture.py) or the name of a database on the reference server
+"""
+def connect(snapshot):
+    if os.path.exists(snapshot):
+        return sqlite3.connect(snapshot)
+    import utils
+    return utils.db_connect(snapshot)
+
+
+"""Contig names a table has rows for, or None if the snapshot lacks it
+"""
+def table_contigs(conn, table, chrom_column):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"select distinct {chrom_column} from {table}")
+        return set(str(row[0]) for row in cursor.fetchall())
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+
+
+"""Rows of one contig of a table as (start, rows) groups, in start order
+"""
+def position_groups(conn, table, chrom_column, start_column, chrom):
+    cursor = prefilter.streaming_cursor(conn)
+    cursor.execute(f"select * from {table} where {chrom_column} = " +
+        f"'{chrom}' order by {start_column}")
+    start_index = [column[0] for column in cursor.description].index(
+        start_column)
+    group = []
+    rows = cursor.fetchmany(10000)
+    while rows:
+        for row in rows:
+            if group and row[start_index] != group[0][start_index]:
+                yield int(group[0][start_index]), group
+                group = []
+            group.append(tuple(row))
+        rows = cursor.fetchmany(10000)
+    if group:
+        yield int(group[0][start_index]), group
+    cursor.close()
+
+
+"""Rows in only one of two start-ordered group streams, as many times as
+they are missing from the other
+"""
+def changed_rows(old_groups, new_groups):
+    old = next(old_groups, None)
+    new = next(new_groups, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            for row in old[1]:
+                yield row
+            old = next(old_groups, None)
+        elif old is None or new[0] < old[0]:
+            for row in new[1]:
+                yield row
+            new = next(new_groups, None)
+        else:
+            counts = collections.Counter(old[1])
+            counts.subtract(collections.Counter(new[1]))
+            for row, count in counts.items():
+                if count != 0:
+                    yield row
+            old = next(old_groups, None)
+            new = next(new_groups, None)
+
+
+"""Diffs two reference snapshots into the regions whose annotations can
+differ between them, by contig name. Both snapshots are streamed one
+contig of one table at a time.
+"""
+def build_delta(old_conn, new_conn, tables=None):
+    if tables is None:
+        tables = delta_tables()
+    regions = collections.defaultdict(list)
+    changed = {}
+    for table, chrom_column, start_column, end_column, reach in tables:
+        old_contigs = table_contigs(old_conn, table, chrom_column)
+        new_contigs = table_contigs(new_conn, table, chrom_column)
+        if old_contigs is None and new_contigs is None:
+            continue
+
+        changed[table] = 0
+        for chrom in sorted((old_contigs or set()) | (new_contigs or set())):
+            groups = [position_groups(conn, table, chrom_column,
+                start_column, chrom) if names is not None and chrom in names
+                else iter(()) for conn, names in
+                ((old_conn, old_contigs), (new_conn, new_contigs))]
+            name = contigs.ensembl_name(contigs.contig_id(chrom))
+            columns = None
+            for row in changed_rows(groups[0], groups[1]):
+                if columns is None:
+                    columns = table_columns(old_conn if old_contigs is not None
+                        else new_conn, table)
+                    start_index = columns.index(start_column)
+                    end_index = columns.index(end_column)
+                changed[table] = changed[table] + 1
+                regions[name].append((int(row[start_index]) - reach,
+                    int(row[end_index]) + reach))
+
+    return {'version': FORMAT_VERSION, 'tables': changed,
+        'regions': dict((name, iv.merge_intervals(intervals))
+            for name, intervals in regions.items())}
+
+
+"""Column names of a table
+"""
+def table_columns(conn, table):
+    cursor = conn.cursor()
+    cursor.execute(f"select * from {table} limit 1")
+    columns = [column[0] for column in cursor.description]
+    cursor.fetchall()
+    cursor.close()
+    return columns
+
+
+"""Writes a delta as gzipped JSON
+"""
+def save_delta(delta, path):
+    with open(path, 'wb') as fh:
+        fh.write(gzip.compress(json.dumps(delta,
+            separators=(',', ':')).encode('utf-8')))
+
+
+def load_delta(path):
+    with open(path, 'rb') as fh:
+        return json.loads(gzip.decompress(fh.read()))
+
+
+"""Count log with the counts of removed taken away and those of added
+added on, line by line. The three logs must come from the same stages.
+A percentage on a line (In dbSNP: n (p%)) is worked out again from the
+line's count and the Total.
+"""
+def rebase_count_log(log, removed, added):
+    lines = []
+    total = None
+    for line, line_removed, line_added in zip(log.splitlines(),
+        removed.splitlines(), added.splitlines()):
+        parts = re.split(r'(\d+(?:\.\d+)?)', line)
+        parts_removed = re.split(r'(\d+(?:\.\d+)?)', line_removed)
+        parts_added = re.split(r'(\d+(?:\.\d+)?)', line_added)
+        if not len(parts) == len(parts_removed) == len(parts_added) or \
+            not parts[0::2] == parts_removed[0::2] == parts_added[0::2]:
+            raise ValueError(f"Count logs do not match at: {line}")
+        for i in range(1, len(parts), 2):
+            if '.' in parts[i]:
+                # Same expression as the stage, so the digits match
+                parts[i] = str((int(parts[1]) / float(total)) * 100)
+            else:
+                parts[i] = str(int(parts[i]) - int(parts_removed[i]) +
+                    int(parts_added[i]))
+        if line.startswith('Total:'):
+            total = int(parts[1])
+        lines.append(''.join(parts))
+    return ''.join(line + '\n' for line in lines)
+
+
+"""Drops the reference version line (see driver.reference_line)
+"""
+def without_reference_line(log):
+    return ''.join(line for line in log.splitlines(True)
+        if not line.startswith('## Reference version:'))
+
+
+"""Annotates records held in memory, with the stage output kept quiet
+Lookups go to conn itself, not to the pool of the reference in use (see
+lookups.sequential).
+"""
+def annotate_lines(lines, conn, stages=None, regions=None,
+    allowed_contigs=None):
+    import driver
+    with contextlib.redirect_stdout(io.StringIO()), lk.sequential():
+        annotated, count_log = driver.run_in_memory(
+            ''.join(line + '\n' for line in lines), conn, stages=stages,
+            regions=regions, allowed_contigs=allowed_contigs)
+    return annotated, without_reference_line(count_log)
+
+
+"""Brings an annotated result and its count log up to date with the new
+snapshot of a delta. input_path is the file the result was annotated
+from; a result line is annotated again (against new_conn) only if its
+input record touches a changed region. Count log lines are adjusted by
+what the same records counted against old_conn and count against
+new_conn. stages are those the result was annotated with (by default
+all), and regions the regions of interest it was pruned to (see
+roi.RegionFilter), if any, and allowed_contigs the contigs it was
+filtered to (see annotate.filterRecordsLines). Records are annotated
+chunk_size at a time. Returns the number of records annotated again.
+"""
+def reannotate(delta, input_path, result_path, log_path, old_conn, new_conn,
+    reference_version=None, stages=None, chunk_size=10000, regions=None,
+    allowed_contigs=None):
+    import annotate
+    import driver
+    changed = iv.RegionSet(delta['regions'])
+    with open(log_path) as fh:
+        count_log = without_reference_line(fh.read())
+
+    # Pass 1: annotate the affected records again, in order, aside
+    affected = array.array('q')
+    annotated_path = result_path + '.delta'
+    fh_annotated = open(annotated_path, 'w')
+    chunk = []
+    # Lines filtered or pruned so far and left out of the result
+    dropped = 0
+    allowed = None
+    if allowed_contigs is not None:
+        allowed = annotate.allowedContigs(allowed_contigs)
+    with open(input_path) as fh:
+        for number, line in enumerate(fh):
+            line = line.strip()
+            if line.startswith('#') or line.startswith('CHROM'):
+                continue
+            record = vr.parse_record(line)
+            if allowed is not None and not annotate.passesFilter(record,
+                allowed):
+                dropped = dropped + 1
+                continue
+            if type(record) is str:
+                continue
+            if regions is not None and not regions.keeps(record):
+                if not regions.keep_pruned:
+                    dropped = dropped + 1
+                continue
+            start, end = annotate.getSpan(record)
+            if not changed.touches(record.contig, start, end):
+                continue
+            affected.append(number - dropped)
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                count_log = reannotate_chunk(chunk, count_log, old_conn,
+                    new_conn, fh_annotated, stages, regions, allowed_contigs)
+                chunk = []
+    if chunk:
+        count_log = reannotate_chunk(chunk, count_log, old_conn, new_conn,
+            fh_annotated, stages, regions, allowed_contigs)
+    fh_annotated.close()
+
+    # Pass 2: splice them into the result in place of the old lines
+    fh_annotated = open(annotated_path)
+    fh_out = open(result_path + '.tmp', 'w')
+    i = 0
+    with open(result_path) as fh:
+        for number, line in enumerate(fh):
+            if i < len(affected) and number == affected[i]:
+                line = fh_annotated.readline()
+                i = i + 1
+            fh_out.write(line)
+    fh_out.close()
+    fh_annotated.close()
+    os.remove(annotated_path)
+    if i != len(affected):
+        os.remove(result_path + '.tmp')
+        raise ValueError(f"{result_path} has fewer lines than {input_path}")
+    os.replace(result_path + '.tmp', result_path)
+
+    if reference_version is not None:
+        count_log = driver.reference_line(reference_version) + count_log
+    with open(log_path + '.tmp', 'w') as fh:
+        fh.write(count_log)
+    os.replace(log_path + '.tmp', log_path)
+    return len(affected)
+
+
+"""Annotates one chunk of affected records against both snapshots,
+writes the new lines and returns the count log rebased on the chunk
+"""
+def reannotate_chunk(chunk, count_log, old_conn, new_conn, fh_annotated,
+    stages=None, regions=None, allowed_contigs=None):
+    old_annotated, old_log = annotate_lines(chunk, old_conn, stages, regions,
+        allowed_contigs)
+    new_annotated, new_log = annotate_lines(chunk, new_conn, stages, regions,
+        allowed_contigs)
+    fh_annotated.write(new_annotated)
+    return rebase_count_log(count_log, old_log, new_log)
+
+
+"""S3 key of a job's file as annotated against to_version: under a
+directory named for the version, next to where run.py (or an earlier
+delta, from_version) put it. Stored results never change in place, as
+web/helpers.load_result_index caches them by key.
+"""
+def versioned_key(key, from_version, to_version):
+    directory, name = posixpath.split(key)
+    if posixpath.basename(directory) == from_version:
+        directory = posixpath.dirname(directory)
+    return posixpath.join(directory, to_version, name)
+
+
+"""Re-annotates the stored result of a completed job with a delta
+The new result, log and index are uploaded under new keys (see
+versioned_key), the job item is switched to them, and only then are the
+old ones deleted. Jobs annotated against another version than the delta
+starts from, or by another pipeline version, or whose results are
+archived, are skipped, as are jobs whose item changed meanwhile.
+Returns whether the job was updated.
+"""
+def reannotate_job(delta, job_id, config, old_conn, new_conn):
+    import boto3
+    from botocore.exceptions import ClientError
+    import roi
+    import driver
+    import vcf_sort
+    import pileup2vcf
+    import vcf_index
+    import result_cache
+
+    s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+    table = boto3.resource('dynamodb',
+        region_name=config['aws']['AwsRegionName']).Table(
+        config['gas']['DynamoTable'])
+    item = table.get_item(Key={'job_id': job_id}).get('Item')
+
+    from_version = delta['from']['version']
+    if item is None or item.get('job_status') != 'COMPLETED':
+        print(f"Job {job_id} is not completed, skipping")
+        return False
+    if 'results_file_archive_id' in item:
+        print(f"Results of job {job_id} are archived, skipping")
+        return False
+    if item.get('reference_version',
+        config['cache']['ReferenceVersion']) != from_version:
+        print(f"Job {job_id} was not annotated against {from_version}, "
+            "skipping")
+        return False
+    # Annotated again with the stages it ran (see run.complete_job), the
+    # regions of interest it came with, the filter and in the order of its
+    # result, and the stored result must be what this pipeline gives for
+    # the old snapshot
+    stages = driver.profile_stages(','.join(item.get('annotation_stages', [])))
+    regions = None
+    if item.get('s3_key_regions_file'):
+        response = s3.get_object(Bucket=item['s3_inputs_bucket'],
+            Key=item['s3_key_regions_file'])
+        regions = roi.RegionFilter.from_bed(
+            response['Body'].read().decode('utf-8').splitlines(),
+            keep_pruned=config['regions']['Outside'] == 'keep')
+    sorter = None
+    if config.getboolean('sort', 'Enabled'):
+        sorter = vcf_sort.VcfSorter(int(config['sort']['MemoryBytes']),
+            directory=config['sort']['Directory'] or None,
+            restore_order=item.get('output_order') == 'input')
+    allowed_contigs = driver.filter_contigs(config)
+    if item.get('result_cache_key') != result_cache.cache_key(
+        item.get('input_hash'), from_version,
+        driver.pipeline_version(stages, regions, sorter, allowed_contigs)):
+        print(f"Job {job_id} was annotated by another pipeline version, "
+            "skipping")
+        return False
+
+    directory = tempfile.mkdtemp(prefix='ann-delta-')
+    try:
+        input_path = os.path.join(directory, 'input.vcf')
+        result_path = os.path.join(directory, 'result.vcf')
+        log_path = os.path.join(directory, 'result.count.log')
+        index_path = os.path.join(directory, 'result.index.json.gz')
+        if driver.input_format(item['input_file_name']) == 'pileup':
+            # Results of a pileup are annotated from its conversion to VCF
+            pileup_path = os.path.join(directory, 'input.pileup')
+            s3.download_file(item['s3_inputs_bucket'],
+                item['s3_key_input_file'], pileup_path)
+            pileup2vcf.filter_pileup(pileup_path, input_path)
+        else:
+            s3.download_file(item['s3_inputs_bucket'],
+                item['s3_key_input_file'], input_path)
+        s3.download_file(item['s3_results_bucket'],
+            item['s3_key_result_file'], result_path)
+        s3.download_file(item['s3_results_bucket'], item['s3_key_log_file'],
+            log_path)
+        if sorter is not None and not sorter.restore_order:
+            # The result is in sort order; so is the input it is matched to
+            sorter.sort_file(input_path)
+
+        to_version = delta['to']['version']
+        count = reannotate(delta, input_path, result_path, log_path,
+            old_conn, new_conn, reference_version=to_version, stages=stages,
+            regions=regions, allowed_contigs=allowed_contigs)
+        vcf_index.index_vcf(result_path, index_path,
+            block_size=int(config['code']['IndexBlockSize']))
+
+        # A job whose index failed to upload has none recorded; it gets
+        # one under the name run.py gives it
+        old_objects = {'result': item['s3_key_result_file'],
+                       'log': item['s3_key_log_file'],
+                       'index': item.get('s3_key_index_file',
+                           item['s3_key_result_file'] + '.idx')}
+        job_objects = {role: versioned_key(key, from_version, to_version)
+            for role, key in old_objects.items()}
+        s3.upload_file(result_path, item['s3_results_bucket'],
+            job_objects['result'])
+        s3.upload_file(log_path, item['s3_results_bucket'],
+            job_objects['log'])
+        s3.upload_file(index_path, item['s3_results_bucket'],
+            job_objects['index'])
+
+        cache_key = result_cache.cache_key(item['input_hash'], to_version,
+            driver.pipeline_version(stages, regions, sorter, allowed_contigs))
+        result_cache.store(s3, item['s3_results_bucket'],
+            config['cache']['Prefix'], cache_key, job_objects)
+        try:
+            table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression='SET reference_version = :to_version, ' +
+                    'result_cache_key = :cache_key, ' +
+                    's3_key_result_file = :result, ' +
+                    's3_key_log_file = :log, s3_key_index_file = :index',
+                ConditionExpression='(reference_version = :from_version OR ' +
+                    'attribute_not_exists(reference_version)) AND ' +
+                    's3_key_result_file = :old_result',
+                ExpressionAttributeValues={':to_version': to_version,
+                                           ':from_version': from_version,
+                                           ':cache_key': cache_key,
+                                           ':result': job_objects['result'],
+                                           ':log': job_objects['log'],
+                                           ':index': job_objects['index'],
+                                           ':old_result':
+                                               old_objects['result']})
+        except ClientError as e:
+            # The item still points at the old objects; the new ones are
+            # not needed
+            for key in job_objects.values():
+                s3.delete_object(Bucket=item['s3_results_bucket'], Key=key)
+            if e.response['Error']['Code'] != \
+                'ConditionalCheckFailedException':
+                raise e
+            print(f"Job {job_id} changed while it was annotated again, "
+                "skipping")
+            return False
+
+        for role, key in old_objects.items():
+            if key != job_objects[role]:
+                s3.delete_object(Bucket=item['s3_results_bucket'], Key=key)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"Job {job_id}: {count} records annotated again")
+    return True
+
+
+def main(argv=None):
+    from configparser import ConfigParser
+    config = ConfigParser(os.environ)
+    config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+        'ann_config.ini'))
+
+    parser = argparse.ArgumentParser(
+        description='Re-annotate stored results after a reference update, '
+                    'annotating again only the records it can change')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build',
+        help='diff two reference snapshots into a delta')
+    build.add_argument('old', help='old snapshot: database name or SQLite file')
+    build.add_argument('new', help='new snapshot: database name or SQLite file')
+    build.add_argument('--from-version', required=True)
+    build.add_argument('--to-version', required=True)
+    build.add_argument('-o', '--output', required=True)
+
+    apply = commands.add_parser('apply',
+        help='bring an annotated file and its count log up to date')
+    apply.add_argument('delta')
+    apply.add_argument('input', help='the file the result was annotated from')
+    apply.add_argument('result')
+    apply.add_argument('log')
+    apply.add_argument('--stages',
+        help='profile or comma-separated stages the result was annotated '
+             'with (default: all)')
+    apply.add_argument('--contigs',
+        help='comma-separated contigs the input was filtered to (default: '
+             'not filtered)')
+
+    jobs = commands.add_parser('jobs',
+        help='bring the stored results of completed jobs up to date')
+    jobs.add_argument('delta')
+    jobs.add_argument('job_id', nargs='+')
+    args = parser.parse_args(argv)
+
+    # Prefilters and index snapshots belong to one version; the delta
+    # queries both snapshots directly
+    for name in ('ANN_PREFILTERS', 'ANN_INDEX_SNAPSHOTS', 'ANN_REFERENCE_DB'):
+        os.environ.pop(name, None)
+
+    if args.command == 'build':
+        old_conn = connect(args.old)
+        new_conn = connect(args.new)
+        delta = build_delta(old_conn, new_conn)
+        delta['from'] = {'version': args.from_version, 'snapshot': args.old}
+        delta['to'] = {'version': args.to_version, 'snapshot': args.new}
+        save_delta(delta, args.output)
+        print(f"{sum(delta['tables'].values())} rows changed in " +
+            f"{sum(len(regions) for regions in delta['regions'].values())} " +
+            "regions", file=sys.stderr)
+        return
+
+    delta = load_delta(args.delta)
+    old_conn = connect(delta['from']['snapshot'])
+    new_conn = connect(delta['to']['snapshot'])
+    if args.command == 'apply':
+        import driver
+        count = reannotate(delta, args.input, args.result, args.log,
+            old_conn, new_conn, reference_version=delta['to']['version'],
+            stages=driver.profile_stages(args.stages,
+                driver.profile_presets(config)),
+            allowed_contigs=args.contigs.split(',') if args.contigs else None)
+        print(f"{count} records annotated again", file=sys.stderr)
+    else:
+        for job_id in args.job_id:
+            reannotate_job(delta, job_id, config, old_conn, new_conn)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -12,103 +12,255 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import io
+import collections
+import functools
 import file_utils as fu
 import annotate as ann
+import vcf_record as vr
+import contigs
+import pileup2vcf as p2v
 
-def run(infile, format):
+"""Version of the annotation pipeline, part of the result cache key
+Bump this whenever a change to the stages changes their output
+"""
+PIPELINE_VERSION = '4'
+
+"""Annotation stages in the order they are applied
+Stage i reads <infile>.i (the input itself for the first stage) and
+writes <infile>.(i+1), so a run can be resumed from any completed stage.
+Each stage is a generator over records (see annotate.annotateFile); the
+overlap stages each read one annotation source (see sources.py)
+"""
+STAGES = [
+    ('dbSNP', ann.getSnpsFromDbSnpLines, {}),
+    ('BigRefGene', ann.getBigRefGeneLines, {}),
+    ('refGene', ann.getGenesAndExonsLines,
+        {'table': 'refGene', 'promoter_offset': 500}),
+    ('Cytoband', ann.addOverlapWithSourceLines, {'source': 'cytoBand'}),
+    ('gadAll', ann.addOverlapWithSourceLines, {'source': 'gadAll'}),
+    ('GwasCatalog', ann.addOverlapWithSourceLines, {'source': 'gwasCatalog'}),
+    ('miRNA', ann.addOverlapWithSourceLines, {'source': 'targetScanS'}),
+    ('HUGO Gene Nomenclature Committee', ann.addOverlapWithSourceLines,
+        {'source': 'hugo'}),
+    ('CNV databases', ann.addOverlapWithCnvDatabasesLines,
+        {'tables': ann.cnvTables}),
+    ('genomicSuperDups', ann.addOverlapWithSourceLines,
+        {'source': 'genomicSuperDups'}),
+    ('addOverlapWithTfbsConsSites', ann.addOverlapWithSourceLines,
+        {'source': 'tfbsConsSites'}),
+]
+
+
+"""Stages of an annotation profile, in pipeline order
+profile names one of presets (lower-case name -> stage list) or is itself
+a comma-separated list of stage names (see STAGES, any case); 'all', or no
+profile, is every stage. Raises ValueError for unknown names.
+"""
+def profile_stages(profile, presets={}):
+    if not profile:
+        return list(STAGES)
+    spec = presets.get(profile.strip().lower(), profile)
+    if spec.strip().lower() == 'all':
+        return list(STAGES)
+
+    names = set(name.strip().lower() for name in spec.split(',')
+        if name.strip())
+    stages = [entry for entry in STAGES if entry[0].lower() in names]
+    unknown = names - set(entry[0].lower() for entry in stages)
+    if unknown or not stages:
+        raise ValueError(f"Unknown annotation profile or stages: {profile}")
+    return stages
+
+
+"""Presets of a config's [profiles] section, for profile_stages
+"""
+def profile_presets(config):
+    return dict((name, config['profiles'][name])
+        for name in config.options('profiles') if name not in config.defaults())
+
+
+"""Contigs a config's [filter] section allows records on, or None if it
+filters nothing
+"""
+def filter_contigs(config):
+    names = [name.strip() for name in config['filter']['Contigs'].split(',')
+        if name.strip()]
+    return names or None
+
+
+"""Pipeline version of a run of some stages, part of the result cache key
+A run of every stage, filtered to the canonical contigs (the default
+[filter] Contigs, in any spelling), is PIPELINE_VERSION itself. A run
+pruned to regions of interest (see roi.RegionFilter) is told apart by
+their digest, one whose results stay in sort order (see
+vcf_sort.VcfSorter) by ':sorted', one that filters to other contigs by the
+contigs allowed, and one that does not filter by ':unfiltered'.
+"""
+def pipeline_version(stages, regions=None, sorter=None,
+    allowed_contigs=None):
+    version = PIPELINE_VERSION
+    if len(stages) != len(STAGES):
+        version = version + ':' + ','.join(name for name, stage, kwargs
+            in stages)
+    if regions is not None:
+        version = version + ':roi=' + regions.digest()
+    if sorter is not None and not sorter.restore_order:
+        version = version + ':sorted'
+    if allowed_contigs is None:
+        version = version + ':unfiltered'
+    elif ann.allowedContigs(allowed_contigs) != \
+        ann.allowedContigs(contigs.CANONICAL):
+        version = version + ':filter=' + ','.join(allowed_contigs)
+    return version
+
+
+"""Format of an input by its file name: 'pileup' for samtools variant
+pileup (.pileup), otherwise 'vcf'
+"""
+def input_format(file_name):
+    if file_name.endswith('.pileup'):
+        return 'pileup'
+    return 'vcf'
+
+
+"""Path the stage files, count log and results of an input are named
+after: the input itself, or <name>.vcf for a pileup
+"""
+def stage_input(infile, format='vcf'):
+    if format == 'pileup':
+        return os.path.splitext(infile)[0] + '.vcf'
+    return infile
+
+
+"""Name of the intermediate file written by a stage
+"""
+def stage_file(infile, stage):
+    if stage == 0:
+        return infile
+    return infile + '.' + str(stage)
+
+
+"""Line naming the reference version at the top of a count log
+"""
+def reference_line(reference_version):
+    return f"## Reference version: {reference_version}\n"
+
+
+"""Lines of an input as the stages read them: a pileup is converted to VCF
+"""
+def input_lines(fh, path, format='vcf'):
+    if format == 'pileup':
+        return p2v.pileup2vcf_lines(fh, path)
+    return fh
+
+
+"""Writes the input at source to infile as the first stage would read it:
+converted from pileup, and with allowed_contigs filtered (see
+annotate.filterRecordsLines). Returns the count log line of the filter.
+"""
+def write_input(source, infile, format='vcf', allowed_contigs=None):
+    fh_log = io.StringIO()
+    with open(source) as fh, open(infile, 'w') as fh_out:
+        records = vr.read_records(input_lines(fh, source, format))
+        if allowed_contigs is not None:
+            records = ann.filterRecordsLines(records, None, fh_log,
+                allowed_contigs=allowed_contigs)
+        for record in records:
+            fh_out.write(vr.format_record(record) + '\n')
+    return fh_log.getvalue()
+
+
+"""Runs the annotation stages on infile
+start_stage skips stages whose output (<infile>.start_stage and the
+.count.log written so far) is already in place, e.g. restored from a
+checkpoint. on_stage_complete(stage, path) is called after every stage.
+reference_version, if given, is recorded in the count log, and stages
+done against another version are run again. stages (by default all of
+STAGES) are the ones to run, e.g. those of a profile (see profile_stages).
+With allowed_contigs, records on other contigs (and other junk, see
+annotate.filterRecordsLines) are dropped as the first stage reads them.
+With regions (a roi.RegionFilter), only the records in the regions of
+interest go through the stages. With sorter (a vcf_sort.VcfSorter), they
+go through in coordinate order. A pileup (format 'pileup') is converted to
+VCF as the first stage reads it, and annotated as VCF; its results are
+named as for <name>.vcf (see stage_input).
+"""
+def run(infile, format, start_stage=0, on_stage_complete=None,
+    reference_version=None, stages=None, regions=None, sorter=None,
+    allowed_contigs=None):
 
     print("Running . . .")
+    if stages is None:
+        stages = STAGES
+
+    # What the first stage reads instead of infile, if anything: a pileup
+    source = None
+    if format == 'pileup':
+        source = infile
+        infile = stage_input(infile, format)
+    # Count log lines of what runs ahead of the stages
+    preamble = ''
+    # The input as it came, if infile is rewritten
+    unfiltered = None
+    if (sorter is not None or regions is not None) and \
+        (source is not None or allowed_contigs is not None):
+        # Sorting and pruning rewrite the input; they get it converted and
+        # filtered as the first stage would
+        if source is None:
+            unfiltered = infile + '.unfiltered'
+            os.replace(infile, unfiltered)
+            source = unfiltered
+        preamble = write_input(source, infile, format, allowed_contigs)
+        source = None
+        allowed_contigs = None
+    format = 'vcf'
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    if sorter is not None:
+        # Sorted again on a restart, into the same order
+        sorter.sort_file(infile)
+    if regions is not None:
+        # Split again on a restart; the count log already has the line
+        preamble = preamble + regions.split_file(infile, format)
+
+    if reference_version is not None and start_stage > 0:
+        with open(infile + '.count.log') as fh:
+            if fh.readline() != reference_line(reference_version):
+                print("Earlier stages used another reference version, "
+                    "starting over")
+                start_stage = 0
+    if reference_version is not None:
+        preamble = reference_line(reference_version) + preamble
+    if start_stage == 0 and preamble:
+        with open(infile + '.count.log', 'w') as fh:
+            fh.write(preamble)
+
+    before = None
+    if allowed_contigs is not None:
+        before = functools.partial(ann.filterRecordsLines,
+            allowed_contigs=allowed_contigs)
+
+    for i in range(start_stage, len(stages)):
+        name, stage, kwargs = stages[i]
+        tmpextin = '' if i == 0 else '.' + str(i)
+        tmpextout = '.' + str(i + 1)
+        # The first stage starts a new count log
+        logmode = 'w' if i == 0 and not preamble else 'a'
+        if i == 0 and source is not None:
+            with open(source) as fh:
+                ann.annotateFile(stage, infile, tmpextin, tmpextout,
+                    logmode=logmode, lines=p2v.pileup2vcf_lines(fh, source),
+                    before=before, format=format, **kwargs)
+        else:
+            ann.annotateFile(stage, infile, tmpextin, tmpextout,
+                logmode=logmode, before=before if i == 0 else None,
+                format=format, **kwargs)
+        print(f"{name} - done.")
+
+        if on_stage_complete is not None:
+            on_stage_complete(i + 1, stage_file(infile, i + 1))
+
+    tmpextin = len(stages)
 
     ## Cleanup
     for i in range(1, tmpextin):
@@ -117,5 +269,55 @@ def run(infile, format):
     os.rename(infile + '.' + str(tmpextin), infile + '.annot')
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
     os.rename(infile + '.annot', finalout)
+    if regions is not None:
+        regions.merge_file(infile, finalout, format)
+    if sorter is not None:
+        dropped = regions is not None and not regions.keep_pruned
+        sorter.restore_file(infile, finalout,
+            keeps=regions.keeps_line if dropped else None)
+    if unfiltered is not None:
+        os.replace(unfiltered, infile)
+
+
+"""Runs the annotation stages on VCF text held in memory
+The stages are chained as generators over a single open connection, so no
+intermediate files are written and each line is parsed into a record once
+and written out once. Returns the annotated text and the count log.
+A pileup is converted to VCF as it is read; file_name names it in the
+VCF header. Records are filtered, sorted and pruned as by run.
+"""
+def run_in_memory(text, conn, format='vcf', reference_version=None,
+    stages=None, regions=None, sorter=None, file_name='pileup',
+    allowed_contigs=None):
+    if stages is None:
+        stages = STAGES
+    fh_log = io.StringIO()
+    if reference_version is not None:
+        fh_log.write(reference_line(reference_version))
+    records = vr.read_records(input_lines(io.StringIO(text), file_name,
+        format))
+    format = 'vcf'
+    if allowed_contigs is not None:
+        records = ann.filterRecordsLines(records, None, fh_log,
+            allowed_contigs=allowed_contigs)
+    if sorter is not None:
+        records, places = sorter.sort(records)
+        if regions is not None and not regions.keep_pruned:
+            places = [place for place, record in zip(places, records)
+                if regions.keeps(record, format=format)]
+    if regions is not None:
+        order = collections.deque()
+        records = regions.prune(records, order, fh_log, format=format)
+    for name, stage, kwargs in stages:
+        records = stage(records, conn.cursor(), fh_log, format=format,
+            **kwargs)
+    if regions is not None:
+        records = regions.restore(records, order)
+    if sorter is not None:
+        records = sorter.restore(records, places)
+
+    annotated = ''.join(vr.format_record(record) + '\n'
+        for record in records)
+    return annotated, fh_log.getvalue()
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,274 @@
+# equivalence.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Differential check of annotation engines against each other
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import io
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import itertools
+import contextlib
+import collections
+
+import reference_fixture
+
+"""Name driver.run gives the annotated version of infile
+"""
+def annotated_name(infile):
+    return (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+
+
+"""Annotates infile with the file-based stage chain (driver.run)
+Returns the paths of the annotated file and its count log.
+"""
+def run_file_engine(infile):
+    import driver
+    driver.run(infile, 'vcf')
+    return (annotated_name(infile), infile + '.count.log')
+
+
+"""Annotates infile with the stages chained in memory (driver.run_in_memory)
+"""
+def run_memory_engine(infile):
+    import utils
+    import driver
+    conn = utils.db_connect()
+    with open(infile) as fh:
+        annotated, count_log = driver.run_in_memory(fh.read(), conn)
+    conn.close()
+    outfile = annotated_name(infile)
+    with open(outfile, 'w') as fh:
+        fh.write(annotated)
+    with open(infile + '.count.log', 'w') as fh:
+        fh.write(count_log)
+    return (outfile, infile + '.count.log')
+
+
+# Engines that can be checked against each other, by name
+ENGINES = {
+    'file': run_file_engine,
+    'memory': run_memory_engine,
+}
+
+
+"""INFO entries of a record as (key, value) pairs, in order
+"""
+def info_entries(info):
+    entries = []
+    for entry in info.split(';'):
+        key, sep, value = entry.partition('=')
+        entries.append((key, value if sep else None))
+    return entries
+
+
+"""INFO entry text of a (key, value) pair
+"""
+def entry_text(entry):
+    key, value = entry
+    return key if value is None else key + '=' + value
+
+
+"""Describes how two differing records differ: which columns, and for INFO
+which entries were added or removed, which keys changed value, or whether
+only their order did. Keys may repeat (BigRefGene adds name, name2, ...
+once per gene), so entries are compared as multisets.
+"""
+def diff_records(line_a, line_b):
+    fields_a = line_a.rstrip('\n').split('\t')
+    fields_b = line_b.rstrip('\n').split('\t')
+    diff = {'columns': [i for i in range(max(len(fields_a), len(fields_b)))
+        if fields_a[i:i + 1] != fields_b[i:i + 1]]}
+
+    if 7 in diff['columns'] and len(fields_a) > 7 and len(fields_b) > 7:
+        entries_a = info_entries(fields_a[7])
+        entries_b = info_entries(fields_b[7])
+        counts_a = collections.Counter(entries_a)
+        counts_b = collections.Counter(entries_b)
+        added = list((counts_b - counts_a).elements())
+        removed = list((counts_a - counts_b).elements())
+        # A key with entries on both sides changed value
+        changed = set(key for key, value in added) & \
+            set(key for key, value in removed)
+        diff['info'] = {
+            'added': [entry_text(entry) for entry in added
+                if entry[0] not in changed],
+            'removed': [entry_text(entry) for entry in removed
+                if entry[0] not in changed],
+            'changed': [key for key in dict.fromkeys(key
+                for key, value in entries_a) if key in changed],
+            'order_only': counts_a == counts_b
+        }
+    return diff
+
+
+"""Compares two annotated files record by record, streaming both, so that
+memory does not grow with the files. Keeps the first max_divergences
+divergences in full and counts the rest.
+"""
+def compare_outputs(path_a, path_b, max_divergences=10):
+    result = {'lines': 0, 'divergent': 0, 'divergences': []}
+    fh_a = open(path_a)
+    fh_b = open(path_b)
+    for number, (line_a, line_b) in enumerate(
+        itertools.zip_longest(fh_a, fh_b), start=1):
+        result['lines'] = number
+        if line_a == line_b:
+            continue
+        result['divergent'] = result['divergent'] + 1
+        if len(result['divergences']) >= max_divergences:
+            continue
+        divergence = {'line': number, 'a': line_a, 'b': line_b}
+        if line_a is None or line_b is None:
+            divergence['missing'] = 'a' if line_a is None else 'b'
+        elif not line_a.startswith('#') and not line_b.startswith('#'):
+            divergence.update(diff_records(line_a, line_b))
+        result['divergences'].append(divergence)
+    fh_a.close()
+    fh_b.close()
+    return result
+
+
+"""Parses a count log into (statistic, values) pairs
+The statistic is the text before its first number, e.g. 'In dbSNP:'
+"""
+def parse_count_log(path):
+    stats = []
+    fh = open(path)
+    for line in fh:
+        line = line.strip()
+        if not line or line.startswith('##'):
+            continue
+        match = re.match(r'^(\D*?)\s*(-?\d.*)?$', line)
+        stats.append((match.group(1), match.group(2) or ''))
+    fh.close()
+    return stats
+
+
+"""Statistics whose values differ between two count logs
+"""
+def compare_count_logs(path_a, path_b):
+    stats_a = parse_count_log(path_a)
+    stats_b = parse_count_log(path_b)
+    mismatches = []
+    for (name_a, values_a), (name_b, values_b) in itertools.zip_longest(
+        stats_a, stats_b, fillvalue=(None, None)):
+        if (name_a, values_a) != (name_b, values_b):
+            mismatches.append({'a': [name_a, values_a],
+                               'b': [name_b, values_b]})
+    return mismatches
+
+
+"""Runs one engine on a private copy of infile in work_directory
+"""
+def run_engine(engine, infile, work_directory):
+    os.makedirs(work_directory)
+    copy = os.path.join(work_directory, os.path.basename(infile))
+    shutil.copy(infile, copy)
+    # The stages print their progress and counts
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ENGINES[engine](copy)
+
+
+"""Annotates infile with two engines against the same reference and
+compares what they produce
+"""
+def check(infile, engine_a='file', engine_b='memory', fixture=None,
+    max_divergences=10):
+    if fixture is not None:
+        os.environ['ANN_REFERENCE_DB'] = fixture
+    work_directory = tempfile.mkdtemp(prefix='ann-equivalence-')
+    try:
+        output_a, log_a = run_engine(engine_a, infile,
+            os.path.join(work_directory, 'a'))
+        output_b, log_b = run_engine(engine_b, infile,
+            os.path.join(work_directory, 'b'))
+        report = compare_outputs(output_a, output_b, max_divergences)
+        report['count_log'] = compare_count_logs(log_a, log_b)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+    report['engines'] = [engine_a, engine_b]
+    report['equivalent'] = report['divergent'] == 0 and not report['count_log']
+    return report
+
+
+"""Human readable summary of a report
+"""
+def format_report(report):
+    lines = [f"{report['lines']} lines compared, "
+        f"{report['divergent']} divergent, "
+        f"{len(report['count_log'])} count log mismatches"]
+    for divergence in report['divergences']:
+        lines.append(f"line {divergence['line']}:")
+        if 'missing' in divergence:
+            lines.append(f"  missing from {divergence['missing']}")
+        if 'columns' in divergence:
+            lines.append(f"  columns {divergence['columns']}")
+        if 'info' in divergence:
+            info = divergence['info']
+            if info['order_only']:
+                lines.append("  INFO: same entries, different order")
+            for change in ('added', 'removed', 'changed'):
+                if info[change]:
+                    lines.append(f"  INFO {change}: {', '.join(info[change])}")
+        lines.append(f"  a: {(divergence['a'] or '').rstrip()[:200]}")
+        lines.append(f"  b: {(divergence['b'] or '').rstrip()[:200]}")
+    for mismatch in report['count_log']:
+        lines.append(f"count log: {mismatch['a']} != {mismatch['b']}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check that two annotation engines give identical output')
+    parser.add_argument('input', nargs='+',
+        help='VCF to annotate, or with --outputs: annotated A, annotated B '
+             '(and optionally count log A, count log B)')
+    parser.add_argument('-a', '--engine-a', default='file',
+        choices=sorted(ENGINES))
+    parser.add_argument('-b', '--engine-b', default='memory',
+        choices=sorted(ENGINES))
+    parser.add_argument('--fixture',
+        help='reference fixture (built in a temporary file if absent); '
+             'default: ANN_REFERENCE_DB, else the fixture')
+    parser.add_argument('--outputs', action='store_true',
+        help='compare existing annotated files instead of running engines')
+    parser.add_argument('--max-divergences', type=int, default=10)
+    parser.add_argument('--json', action='store_true',
+        help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.outputs:
+        report = compare_outputs(args.input[0], args.input[1],
+            args.max_divergences)
+        report['count_log'] = compare_count_logs(args.input[2],
+            args.input[3]) if len(args.input) > 3 else []
+        report['equivalent'] = report['divergent'] == 0 and \
+            not report['count_log']
+    else:
+        scratch = tempfile.mkdtemp(prefix='ann-equivalence-')
+        fixture = args.fixture or os.environ.get('ANN_REFERENCE_DB')
+        if fixture is None or not os.path.exists(fixture):
+            fixture = reference_fixture.build_fixture(
+                fixture or os.path.join(scratch, 'reference.db'))
+        report = check(args.input[0], args.engine_a, args.engine_b, fixture,
+            args.max_divergences)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    sys.exit(0 if report['equivalent'] else 1)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,325 @@
+# intervals.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Batched point-in-interval lookups against reference tables held in memory
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import os
+import mmap
+import json
+import pickle
+import struct
+import bisect
+import hashlib
+
+import contigs
+
+MAGIC = b'ANNIVIDX'
+FORMAT_VERSION = 1
+# Arrays of a snapshot, all little-endian int64, in file order
+SNAPSHOT_ARRAYS = ('starts', 'ends', 'max_ends', 'order', 'offsets')
+
+"""Intervals of one contig of a table, for point lookups
+Intervals are sorted by start, with the largest end seen so far (max_ends)
+alongside, so nested and overlapping intervals are all found. Matches come
+back in the order the rows were loaded (order), as the per-variant queries
+return them. The rows are held as a list, or for an index mapped from a
+snapshot as pickled bytes that are decoded only when they match.
+"""
+class IntervalIndex(object):
+    def __init__(self, starts, ends, max_ends, order, rows=None,
+        offsets=None, payload=None):
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = max_ends
+        self.order = order
+        self.rows = rows
+        self.offsets = offsets
+        self.payload = payload
+
+    @classmethod
+    def from_rows(cls, rows, start_column, end_column):
+        import numpy as np
+        order = sorted(range(len(rows)), key=lambda i: rows[i][start_column])
+        rows = [rows[i] for i in order]
+        ends = np.array([int(row[end_column]) for row in rows],
+            dtype=np.int64)
+        return cls(np.array([int(row[start_column]) for row in rows],
+                dtype=np.int64),
+            ends,
+            np.maximum.accumulate(ends) if rows else ends,
+            np.array(order, dtype=np.int64),
+            rows=rows)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def row(self, i):
+        if self.rows is not None:
+            return self.rows[i]
+        return pickle.loads(self.payload[self.offsets[i]:self.offsets[i + 1]])
+
+    """Rows containing each of positions (start <= pos <= end), as one
+    list per position
+    """
+    def lookup(self, positions):
+        import numpy as np
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(self) == 0:
+            return [[] for pos in positions]
+
+        # Intervals [0, candidates) start at or before each position; as
+        # max_ends never decreases, those before firsts all end before it,
+        # so only [firsts, candidates) can hold it
+        candidates = np.searchsorted(self.starts, positions, side='right')
+        firsts = np.searchsorted(self.max_ends, positions, side='left')
+
+        ends = self.ends
+        matches = []
+        for pos, first, last in zip(positions.tolist(), firsts.tolist(),
+            candidates.tolist()):
+            if first >= last:
+                matches.append([])
+                continue
+            found = first + np.flatnonzero(ends[first:last] >= pos)
+            found = found[np.argsort(self.order[found], kind='stable')]
+            matches.append([self.row(i) for i in found.tolist()])
+        return matches
+
+
+"""Writes an index to a snapshot file: magic, header length, JSON header,
+the arrays, then the pickled rows. The file is written aside and renamed
+into place, so processes mapping it never see it half written.
+"""
+def save_snapshot(index, path):
+    import numpy as np
+    payload = [pickle.dumps(tuple(index.row(i)), protocol=4)
+        for i in range(len(index))]
+    offsets = np.zeros(len(payload) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(row) for row in payload])
+    arrays = {'starts': index.starts, 'ends': index.ends,
+        'max_ends': index.max_ends, 'order': index.order, 'offsets': offsets}
+
+    header = {'version': FORMAT_VERSION, 'count': len(index)}
+    encoded = json.dumps(header).encode('utf-8')
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as fh:
+        fh.write(MAGIC + struct.pack('<I', len(encoded)) + encoded)
+        # Arrays start on an 8-byte boundary
+        fh.write(b'\0' * (-fh.tell() % 8))
+        for name in SNAPSHOT_ARRAYS:
+            fh.write(np.ascontiguousarray(arrays[name], dtype='<i8').tobytes())
+        for row in payload:
+            fh.write(row)
+    os.replace(tmp, path)
+    return path
+
+
+"""Maps a snapshot file read-only
+The arrays are views on the mapping, so every process that maps the same
+snapshot shares one copy of it in the page cache.
+"""
+def load_snapshot(path):
+    if path in load_snapshot.loaded:
+        return load_snapshot.loaded[path]
+
+    import numpy as np
+    with open(path, 'rb') as fh:
+        mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapping[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not an interval index snapshot")
+    length = struct.unpack('<I', mapping[len(MAGIC):len(MAGIC) + 4])[0]
+    offset = len(MAGIC) + 4
+    header = json.loads(mapping[offset:offset + length].decode('utf-8'))
+    offset = offset + length
+    offset = offset + (-offset % 8)
+
+    count = header['count']
+    arrays = {}
+    for name in SNAPSHOT_ARRAYS:
+        size = count + 1 if name == 'offsets' else count
+        arrays[name] = np.frombuffer(mapping, dtype='<i8', count=size,
+            offset=offset)
+        offset = offset + 8 * size
+
+    index = IntervalIndex(arrays['starts'], arrays['ends'],
+        arrays['max_ends'], arrays['order'], offsets=arrays['offsets'],
+        payload=memoryview(mapping)[offset:])
+    load_snapshot.loaded[path] = index
+    return index
+
+load_snapshot.loaded = {}
+
+
+"""Directory of the snapshots of the reference in use, if any
+annotator.py points ANN_INDEX_SNAPSHOTS at one directory per reference
+version, so workers on an instance share the snapshots the first of them
+writes.
+"""
+def snapshot_directory():
+    return os.environ.get('ANN_INDEX_SNAPSHOTS')
+
+
+"""A reference table loaded into one IntervalIndex per contig, as the
+contigs are first needed
+query(contig) gives the SQL that selects the rows of a contig, or None if
+the table has nothing for it. With a snapshot directory (snapshots, by
+default that of the reference in use), the index of a contig is mapped
+from its snapshot, which is written by whichever process loads the contig
+first.
+"""
+class IntervalTable(object):
+    def __init__(self, cursor, query, start_column='chromStart',
+        end_column='chromEnd', snapshots=None):
+        self.cursor = cursor
+        self.query = query
+        self.start_column = start_column
+        self.end_column = end_column
+        self.snapshots = snapshots
+        self.indexes = {}
+
+    def index(self, contig):
+        if contig not in self.indexes:
+            sql = self.query(contig)
+            index = None
+            if sql is not None:
+                index = self.load(sql)
+            self.indexes[contig] = index
+        return self.indexes[contig]
+
+    def load(self, sql):
+        directory = self.snapshots or snapshot_directory()
+        path = None
+        if directory is not None:
+            key = '\0'.join([sql, self.start_column, self.end_column])
+            path = os.path.join(directory,
+                hashlib.sha1(key.encode('utf-8')).hexdigest() + '.idx')
+            if os.path.exists(path):
+                return load_snapshot(path)
+
+        self.cursor.execute(sql)
+        rows = self.cursor.fetchall()
+        columns = [column[0] for column in self.cursor.description]
+        index = IntervalIndex.from_rows(rows,
+            columns.index(self.start_column), columns.index(self.end_column))
+        if path is None:
+            return index
+        os.makedirs(directory, exist_ok=True)
+        return load_snapshot(save_snapshot(index, path))
+
+
+"""Sorts intervals and merges the ones that overlap or touch
+"""
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+"""Regions by contig, for testing whether a span touches any of them
+intervals maps contig names (any spelling, see contigs.contig_id) to
+(start, end) pairs, both inclusive.
+"""
+class RegionSet(object):
+    def __init__(self, intervals):
+        self.starts = {}
+        self.ends = {}
+        self.regions = {}
+        for name, pairs in intervals.items():
+            contig = contigs.contig_id(name)
+            merged = merge_intervals(list(pairs) +
+                self.regions.get(contig, []))
+            self.regions[contig] = merged
+            self.starts[contig] = [start for start, end in merged]
+            self.ends[contig] = [end for start, end in merged]
+
+    def __len__(self):
+        return sum(len(merged) for merged in self.regions.values())
+
+    """Whether contig:start-end overlaps a region
+    """
+    def touches(self, contig, start, end):
+        ends = self.ends.get(contig)
+        if ends is None:
+            return False
+        # Merged regions do not overlap, so their ends are sorted too
+        i = bisect.bisect_left(ends, start)
+        return i < len(ends) and self.starts[contig][i] <= end
+
+
+"""Reads the regions of a BED file
+BED intervals are 0-based and half-open; they are held 1-based and
+inclusive like VCF positions. Blank, comment, track and browser lines are
+skipped; a line without a start and end raises ValueError.
+"""
+def read_bed(lines):
+    intervals = {}
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0].startswith('#') or \
+            fields[0] in ('track', 'browser'):
+            continue
+        try:
+            start, end = int(fields[1]), int(fields[2])
+        except (IndexError, ValueError):
+            raise ValueError(f"Not a BED line: {line.strip()}")
+        if end > start:
+            intervals.setdefault(fields[0], []).append((start + 1, end))
+    return RegionSet(intervals)
+
+
+"""Number of records a stage resolves at once; 0 queries every record
+ANN_BATCH_SIZE sets it (annotator.py takes it from ann_config.ini).
+"""
+def default_batch_size():
+    return int(os.environ.get('ANN_BATCH_SIZE', 0))
+
+
+"""Pairs every record with the rows of table that contain its position
+Consecutive records on one contig are resolved as a block of up to
+batch_size. Header lines, records on contigs the table has nothing for,
+and every record when batch_size is 0, are paired with None, which leaves
+the lookup to the stage.
+"""
+def overlapping_rows(records, table, batch_size):
+    if not batch_size:
+        for record in records:
+            yield record, None
+        return
+
+    block = []
+    for record in records:
+        if type(record) is not str and (not block or
+            (record.contig == block[0].contig and len(block) < batch_size)):
+            block.append(record)
+            continue
+        for pair in resolve_block(block, table):
+            yield pair
+        if type(record) is str:
+            block = []
+            yield record, None
+        else:
+            block = [record]
+    for pair in resolve_block(block, table):
+        yield pair
+
+
+"""Looks up a block of records that are all on one contig
+"""
+def resolve_block(block, table):
+    if not block:
+        return []
+    index = table.index(block[0].contig)
+    if index is None:
+        return [(record, None) for record in block]
+    return zip(block, index.lookup([record.pos for record in block]))
+
+### EOF
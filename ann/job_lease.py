@@ -0,0 +1,78 @@
+# job_lease.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Leases that make annotation jobs run at most once at a time
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import time
+import uuid
+import socket
+from botocore.exceptions import ClientError
+
+"""Atomically claims a job for this worker before any download or compute
+A job can be claimed when it is PENDING, or when it is RUNNING under a lease
+that has expired (its worker died). Returns the lease token, or None if the
+job is COMPLETED or held by a live lease.
+"""
+def claim_job(table, job_id, lease_seconds):
+    token = str(uuid.uuid4())
+    now = int(time.time())
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :running, lease_token = :token, lease_owner = :owner, lease_expires = :expires',
+            ConditionExpression='job_status = :pending OR (job_status = :running AND (attribute_not_exists(lease_expires) OR lease_expires < :now))',
+            ExpressionAttributeValues={":running": "RUNNING",
+                                       ":pending": "PENDING",
+                                       ":token": token,
+                                       ":owner": socket.gethostname(),
+                                       ":expires": now + lease_seconds,
+                                       ":now": now}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise e
+    return token
+
+
+"""Status of a job (None if there is no such job) and the seconds until
+its current lease runs out, 0 when it is not held by a live lease (e.g. it
+is COMPLETED, or RUNNING under a lease that has just expired)
+"""
+def lease_state(table, job_id):
+    response = table.get_item(Key={'job_id': job_id}, ConsistentRead=True)
+    item = response.get('Item')
+    if not item:
+        return None, 0
+    if item.get('job_status') != 'RUNNING':
+        return item.get('job_status'), 0
+    return item['job_status'], \
+        max(0, int(item.get('lease_expires', 0)) - int(time.time()))
+
+
+"""Extends a lease that this worker still holds
+Returns False if the lease was taken over by another worker
+"""
+def renew_lease(table, job_id, token, lease_seconds):
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET lease_expires = :expires',
+            ConditionExpression='job_status = :running AND lease_token = :token',
+            ExpressionAttributeValues={":running": "RUNNING",
+                                       ":token": token,
+                                       ":expires": int(time.time()) + lease_seconds}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise e
+    return True
+
+### EOF
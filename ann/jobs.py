@@ -0,0 +1,491 @@
+# jobs.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Helpers shared by run.py and annotator.py to run, checkpoint and complete
+# annotation jobs. Importing this module does no I/O: AWS clients and SNS
+# topics are set up on first use.
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import io
+import os
+import sys
+import time
+import json
+import logging
+import functools
+import threading
+import boto3
+from botocore.exceptions import ClientError
+
+import driver
+import utils
+import vcf_index
+import checkpoint
+import job_lease
+import result_cache
+import reference
+import roi
+import vcf_sort
+
+# Get configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
+
+results_bucket = config['gas']['ResultsBucket']
+
+"""AWS clients and SNS topic ARNs of the jobs, each created when first used
+"""
+class AwsClients(object):
+    def __init__(self, config):
+        self.config = config
+
+    @functools.cached_property
+    def s3(self):
+        return boto3.client('s3', region_name=self.config['aws']['AwsRegionName'])
+
+    @functools.cached_property
+    def table(self):
+        return boto3.resource('dynamodb',
+            region_name=self.config['aws']['AwsRegionName']).Table(
+            self.config['gas']['DynamoTable'])
+
+    @functools.cached_property
+    def sqs(self):
+        return boto3.client('sqs', region_name=self.config['aws']['AwsRegionName'])
+
+    @functools.cached_property
+    def sns(self):
+        return boto3.client('sns', region_name=self.config['aws']['AwsRegionName'])
+
+    # https://stackoverflow.com/questions/36721014/aws-sns-how-to-get-topic-arn-by-topic-name
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/create_topic.html
+    # This should just get the topic_arn since we already create the sns topic
+    @functools.cached_property
+    def results_topic_arn(self):
+        return self.sns.create_topic(
+            Name=self.config['gas']['SNSResultsTopicName'])['TopicArn']
+
+    @functools.cached_property
+    def glacier_archive_topic_arn(self):
+        return self.sns.create_topic(
+            Name=self.config['gas']['SNSGlacierArchiveTopicName'])['TopicArn']
+
+aws = AwsClients(config)
+
+"""A rudimentary timer for coarse-grained profiling
+"""
+class Timer(object):
+  def __init__(self, verbose=True):
+    self.verbose = verbose
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.end = time.time()
+    self.secs = self.end - self.start
+    if self.verbose:
+      print(f"Approximate runtime: {self.secs:.2f} seconds")
+
+"""Keeps the job request message hidden from other annotators and renews
+this worker's lease on the job while it runs. If this process dies, the
+message becomes visible again once the timeout passes, the lease runs out,
+and the job is picked up again from its last checkpoint.
+"""
+class JobHeartbeat(threading.Thread):
+    def __init__(self, job_id, lease_token, queue_url, receipt_handle,
+        timeout, lease_seconds):
+        threading.Thread.__init__(self, daemon=True)
+        self.job_id = job_id
+        self.lease_token = lease_token
+        self.queue_url = queue_url
+        self.receipt_handle = receipt_handle
+        self.timeout = timeout
+        self.lease_seconds = lease_seconds
+        self.lease_lost = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(min(self.timeout, self.lease_seconds) / 3):
+            try:
+                if not job_lease.renew_lease(aws.table, self.job_id,
+                    self.lease_token, self.lease_seconds):
+                    print(f"Lease on job {self.job_id} was taken over by another worker")
+                    self.lease_lost = True
+                    return
+            except ClientError as e:
+                print("Failed to renew the lease on the job")
+                logging.error(e)
+            try:
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility.html
+                aws.sqs.change_message_visibility(
+                    QueueUrl=self.queue_url,
+                    ReceiptHandle=self.receipt_handle,
+                    VisibilityTimeout=self.timeout
+                )
+            except ClientError as e:
+                print("Failed to extend the visibility of the job request message")
+                logging.error(e)
+
+    def stop(self):
+        self.stopped.set()
+
+"""Checkpoints completed stages to the results bucket, at most once every
+interval seconds. The final stage is never checkpointed since the job
+completes right after it. Checkpoints record the reference version and
+pipeline (see driver.pipeline_version) the stages ran with.
+"""
+class StageCheckpointer(object):
+    def __init__(self, job_id, infile, prefix, interval, heartbeat,
+        stages, last_stage=0, reference_version='', pipeline=''):
+        self.job_id = job_id
+        self.stages = stages
+        self.reference_version = reference_version
+        self.pipeline = pipeline
+        self.heartbeat = heartbeat
+        self.infile = infile
+        self.prefix = prefix
+        self.interval = interval
+        self.last_stage = last_stage
+        self.last_time = time.time()
+
+    def __call__(self, stage, path):
+        if self.heartbeat.lease_lost:
+            # Another worker owns the job now; stop spending compute on it
+            sys.exit(1)
+        if stage >= len(self.stages):
+            return
+        if time.time() - self.last_time < self.interval:
+            return
+        try:
+            checkpoint.save_checkpoint(aws.s3, aws.table, results_bucket, self.prefix,
+                self.job_id, self.infile, stage, previous_stage=self.last_stage,
+                lease_token=self.heartbeat.lease_token,
+                stage_name=self.stages[stage - 1][0],
+                reference_version=self.reference_version,
+                pipeline=self.pipeline)
+        except ClientError as e:
+            print(f"Failed to checkpoint stage {stage} for job id: {self.job_id}")
+            logging.error(e)
+            return
+        print(f"Checkpointed stage {stage}")
+        self.last_stage = stage
+        self.last_time = time.time()
+
+# Delete all files within a directory
+def delete_all_files_in_directory(directory_path):
+    try:
+        files = os.listdir(directory_path)
+        for file in files:
+            file_path = os.path.join(directory_path, file)
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+    except OSError:
+        print("Error occured while deleting files")
+
+# Prefix of a job's objects in the results bucket
+def job_object_prefix(user_id, job_id):
+    return f"{config['gas']['OwnerName']}/{user_id}/{job_id}"
+
+# Names of the result, log and index files of a job
+def result_file_names(file_name_without_extension):
+    annotated_file = f'{file_name_without_extension}.annot.vcf'
+    log_file = f'{file_name_without_extension}.vcf.count.log'
+    index_file = f'{annotated_file}.idx'
+    return annotated_file, log_file, index_file
+
+# S3 keys of a job's result files, by file role (result, log, index)
+def result_object_names(job_prefix, file_name_without_extension):
+    annotated_file, log_file, index_file = result_file_names(
+        file_name_without_extension)
+    return {'result': f"{job_prefix}/{annotated_file}",
+            'log': f"{job_prefix}/{log_file}",
+            'index': f"{job_prefix}/{index_file}"}
+
+# Copy cached results to the job's keys; returns the cache manifest or None
+# Roles the entry has no file for (an index that failed to build) are
+# taken out of job_objects
+def reuse_cached_results(cache_key, job_objects):
+    cache_root = config['cache']['Prefix']
+    try:
+        cached = result_cache.lookup(aws.s3, results_bucket, cache_root, cache_key)
+        if cached is not None:
+            result_cache.fetch(aws.s3, results_bucket, cached, job_objects)
+            for role in list(job_objects):
+                if role not in cached:
+                    del job_objects[role]
+            print(f"Reused cached results {cache_key}")
+        return cached
+    except ClientError as e:
+        print("Failed to reuse cached results, annotating instead")
+        logging.error(e)
+        return None
+
+# Add the results of a job to the cache for identical inputs
+def store_cached_results(cache_key, job_objects):
+    try:
+        result_cache.store(aws.s3, results_bucket, config['cache']['Prefix'],
+            cache_key, job_objects)
+    except ClientError as e:
+        print("Failed to add results to the result cache")
+        logging.error(e)
+
+# Stages a job runs for the annotation profile it asked for (see [profiles]
+# in ann_config.ini); raises ValueError if the profile does not exist
+def job_stages(profile):
+    return driver.profile_stages(profile or 'default',
+        driver.profile_presets(config))
+
+# Regions of interest a job came with, read from the lines of its BED file
+# (see [regions] in ann_config.ini), or None to annotate every variant
+def job_regions(lines):
+    if lines is None:
+        return None
+    return roi.RegionFilter.from_bed(lines,
+        keep_pruned=config['regions']['Outside'] == 'keep')
+
+# Sorts a job's input into coordinate order, if sorting is enabled (see
+# [sort] in ann_config.ini), or None; output_order 'input' asks for the
+# results in the order of the input
+def job_sorter(output_order):
+    if not config.getboolean('sort', 'Enabled'):
+        return None
+    return vcf_sort.VcfSorter(int(config['sort']['MemoryBytes']),
+        directory=config['sort']['Directory'] or None,
+        restore_order=output_order == 'input')
+
+# Mark the job COMPLETED, provided this worker still holds its lease, and
+# record the stages it ran. The index key is recorded only if job_objects
+# has one, i.e. the index was uploaded; region queries need it in place
+# Returns the completion time; raises ClientError if the update fails
+def complete_job(job_id, lease_token, job_objects, cache_key, cache_hit,
+    stages):
+    timestamp = int(time.time())
+    values = {":running": "RUNNING",
+              ":lease_token": lease_token,
+              ":complete": "COMPLETED",
+              ":s3_results_bucket":results_bucket,
+              ":s3_key_result_file":job_objects['result'],
+              ":s3_key_log_file":job_objects['log'],
+              ":cache_key":cache_key,
+              ":cache_hit":cache_hit,
+              ":reference_version":reference.job_version(config),
+              ":annotation_stages":[name for name, stage, kwargs in stages],
+              ":complete_time":timestamp
+              }
+    if 'index' in job_objects:
+        set_index = 's3_key_index_file = :s3_key_index_file, '
+        remove_index = ''
+        values[":s3_key_index_file"] = job_objects['index']
+    else:
+        set_index = ''
+        remove_index = 's3_key_index_file, '
+    print("Update table item")
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
+    aws.table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET job_status = :complete, s3_results_bucket = :s3_results_bucket, s3_key_result_file = :s3_key_result_file, s3_key_log_file = :s3_key_log_file, ' + set_index + 'result_cache_key = :cache_key, result_cache_hit = :cache_hit, reference_version = :reference_version, annotation_stages = :annotation_stages, complete_time = :complete_time REMOVE ' + remove_index + 'checkpoint_stage, checkpoint_stage_name, checkpoint_reference_version, checkpoint_pipeline, s3_key_checkpoint_file, s3_key_checkpoint_log, lease_token, lease_owner, lease_expires',
+        ConditionExpression= 'job_status = :running AND lease_token = :lease_token',
+        ExpressionAttributeValues=values
+    )
+    return timestamp
+
+# Errors of an input that no retry can annotate: a malformed pileup or
+# VCF line, a bad BED file, text that is not UTF-8
+INPUT_ERRORS = (ValueError,)
+
+# Mark the job FAILED with the reason, provided this worker still holds its
+# lease; its request should then be deleted like that of a completed job
+# Raises ClientError if the update fails
+def fail_job(job_id, lease_token, reason):
+    aws.table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET job_status = :failed, failure_message = :reason, complete_time = :complete_time REMOVE checkpoint_stage, checkpoint_stage_name, checkpoint_reference_version, checkpoint_pipeline, s3_key_checkpoint_file, s3_key_checkpoint_log, lease_token, lease_owner, lease_expires',
+        ConditionExpression='job_status = :running AND lease_token = :lease_token',
+        ExpressionAttributeValues={":running": "RUNNING",
+                                   ":lease_token": lease_token,
+                                   ":failed": "FAILED",
+                                   ":reason": reason,
+                                   ":complete_time": int(time.time())}
+    )
+
+# Fail a job whose input no retry can annotate, and drop its request
+def reject_input(job_id, lease_token, request_queue_url, receipt_handle,
+    error):
+    print(f"Input of job_id: {job_id} cannot be annotated:", str(error))
+    fail_job(job_id, lease_token, str(error))
+    delete_request_message(request_queue_url, receipt_handle)
+
+# Delete the job request message once the job is done with
+def delete_request_message(request_queue_url, receipt_handle):
+    try:
+        aws.sqs.delete_message(
+            QueueUrl=request_queue_url,
+            ReceiptHandle=receipt_handle
+        )
+    except ClientError as e:
+        print(f"Error when deleting message with Receipt Handle: {receipt_handle}", str(e))
+
+# Publish a notification message to the SNS topics
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
+def notify_job_complete(job_id, name, email, role, timestamp):
+    try:
+        print("Sending Message to Results Topic")
+        # Send to Results topic
+        data = {
+            "job_id": job_id,
+            "name": name,
+            "email": email,
+            "role": role,
+            "status": "completed",
+            "message": f"Job {job_id} has been completed successfully. Annotated results and log files are available in S3."
+        }
+        aws.sns.publish(
+            TopicArn=aws.results_topic_arn,
+            Message=json.dumps(data)
+        )
+    except Exception as e:
+        print(f"Error publishing notification message to Results SNS topic: {str(e)}")
+        logging.error(e)
+
+    if role == 'free_user':
+        try:
+            print("Sending Message to Glacier Topic")
+            # Send to Glacier Archive topic
+            data = {
+                "job_id": job_id,
+                "complete_time": timestamp,
+            }
+            aws.sns.publish(
+                TopicArn=aws.glacier_archive_topic_arn,
+                Message=json.dumps(data)
+            )
+        except Exception as e:
+            print(f"Error publishing notification message to Glacier Archive SNS topic: {str(e)}")
+            logging.error(e)
+
+# Reference database connection kept open between in-memory jobs, and the
+# reference version it was opened for
+reference_conn = None
+reference_conn_version = None
+
+# Open connection to the reference database, reused while it is alive and
+# jobs stay on the same reference version
+def reference_connection():
+    global reference_conn, reference_conn_version
+    version = reference.job_version(config)
+    if reference_conn is not None and reference_conn_version == version:
+        try:
+            reference_conn.ping(reconnect=True)
+            return reference_conn
+        except Exception:
+            pass
+    if reference_conn is not None:
+        try:
+            reference_conn.close()
+        except Exception:
+            pass
+    reference_conn = utils.db_connect()
+    reference_conn_version = version
+    return reference_conn
+
+"""Runs a small job entirely in memory, inside the calling (annotator)
+process: the input is read straight from S3, annotated over a warm reference
+database connection and the result, log and index are uploaded from memory.
+No job directory, no run.py process, no checkpoints; a heartbeat renews the
+lease and the request's visibility meanwhile. If this process dies the job
+is retried once its lease runs out, like any other. An input that cannot be
+annotated fails the job (see fail_job).
+"""
+def run_small_job(s3_inputs_bucket, s3_key_input_file, input_file_name,
+    user_id, job_id, name, email, role, request_queue_url, receipt_handle,
+    lease_token, profile=None, s3_key_regions_file=None, output_order=None):
+    # The lease and the request stay ours while the job runs
+    heartbeat = JobHeartbeat(job_id, lease_token, request_queue_url,
+        receipt_handle, int(config['code']['MessageVisibilityTimeout']),
+        int(config['code']['JobLeaseSeconds']))
+    heartbeat.start()
+    try:
+        timestamp = annotate_small_job(s3_inputs_bucket, s3_key_input_file,
+            input_file_name, user_id, job_id, lease_token, profile,
+            s3_key_regions_file, output_order)
+    except INPUT_ERRORS as e:
+        heartbeat.stop()
+        reject_input(job_id, lease_token, request_queue_url, receipt_handle,
+            e)
+        return
+    finally:
+        heartbeat.stop()
+    delete_request_message(request_queue_url, receipt_handle)
+    notify_job_complete(job_id, name, email, role, timestamp)
+
+# Annotates a small job's input in memory, uploads its results and
+# completes it; returns the completion time
+def annotate_small_job(s3_inputs_bucket, s3_key_input_file, input_file_name,
+    user_id, job_id, lease_token, profile, s3_key_regions_file, output_order):
+    stages = job_stages(profile)
+    sorter = job_sorter(output_order)
+    regions = None
+    if s3_key_regions_file:
+        response = aws.s3.get_object(Bucket=s3_inputs_bucket,
+            Key=s3_key_regions_file)
+        regions = job_regions(response['Body'].read().decode('utf-8')
+            .splitlines())
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
+    response = aws.s3.get_object(Bucket=s3_inputs_bucket, Key=s3_key_input_file)
+    data = response['Body'].read()
+    print(f"Read {len(data)} bytes of {s3_key_input_file} into memory")
+
+    input_hash = result_cache.hash_bytes(data)
+    try:
+        aws.table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET input_hash = :input_hash',
+            ExpressionAttributeValues={":input_hash": input_hash}
+        )
+    except ClientError as e:
+        print(f"Error has occured recording the input hash for job_id: {job_id}", str(e))
+
+    file_name_without_extension = input_file_name.split('.')[0]
+    job_objects = result_object_names(job_object_prefix(user_id, job_id),
+        file_name_without_extension)
+    cache_key = result_cache.cache_key(input_hash,
+        reference.job_version(config),
+        driver.pipeline_version(stages, regions, sorter,
+            driver.filter_contigs(config)))
+    cached = reuse_cached_results(cache_key, job_objects)
+
+    if cached is None:
+        with Timer():
+            annotated, count_log = driver.run_in_memory(data.decode('utf-8'),
+                reference_connection(),
+                format=driver.input_format(input_file_name),
+                file_name=input_file_name,
+                reference_version=reference.job_version(config),
+                stages=stages, regions=regions, sorter=sorter,
+                allowed_contigs=driver.filter_contigs(config))
+        annotated = annotated.encode('utf-8')
+        index = vcf_index.index_lines(io.BytesIO(annotated),
+            block_size=int(config['code']['IndexBlockSize']))
+
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/put_object.html
+        aws.s3.put_object(Bucket=results_bucket, Key=job_objects['result'],
+            Body=annotated)
+        aws.s3.put_object(Bucket=results_bucket, Key=job_objects['log'],
+            Body=count_log.encode('utf-8'))
+        aws.s3.put_object(Bucket=results_bucket, Key=job_objects['index'],
+            Body=vcf_index.encode_index(index))
+
+        store_cached_results(cache_key, job_objects)
+
+    return complete_job(job_id, lease_token, job_objects, cache_key,
+        cached is not None, stages)
+
+### EOF
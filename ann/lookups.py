@@ -0,0 +1,451 @@
+# lookups.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Pipelined reference lookups: queries of the per-variant stages are kept in
+# flight on a pool of connections instead of waiting one round trip each,
+# and their results cached on local disk per reference version
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import os
+import time
+import zlib
+import fcntl
+import pickle
+import struct
+import atexit
+import asyncio
+import hashlib
+import threading
+import contextlib
+import collections
+import concurrent.futures
+
+import utils as u
+
+# Records a stage may be ahead of the one it yields, per pool connection
+READAHEAD = 4
+
+CACHE_MAGIC = b'ANNLKCHE'
+CACHE_FORMAT_VERSION = 1
+# Result of a lookup that is not in the cache (None is a result)
+MISSING = object()
+
+
+"""Number of pool connections, and so of queries in flight at once; 0 runs
+every lookup on the stage's own cursor, one after the other
+ANN_LOOKUP_CONCURRENCY sets it (annotator.py takes it from ann_config.ini).
+"""
+def default_concurrency():
+    return int(os.environ.get('ANN_LOOKUP_CONCURRENCY', 0))
+
+
+"""Connections to the reference database that run lookups for every stage
+of a process, at most concurrency at a time
+A lookup is a function of a cursor (see fetch_all). It is run by a worker
+thread on that thread's own connection (see utils.db_connect); an asyncio
+loop in a thread of its own hands lookups to the workers and holds the ones
+over concurrency back, so stages chained in memory share one bound on the
+queries in flight.
+"""
+class LookupPool(object):
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.local = threading.local()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='ann-lookup')
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+            name='ann-lookups', daemon=True)
+        self.thread.start()
+        self.slots = asyncio.run_coroutine_threadsafe(self.make_slots(),
+            self.loop).result()
+
+    async def make_slots(self):
+        return asyncio.Semaphore(self.concurrency)
+
+    """Starts a lookup; returns a concurrent.futures.Future of its result
+    """
+    def submit(self, lookup):
+        return asyncio.run_coroutine_threadsafe(self.run(lookup), self.loop)
+
+    async def run(self, lookup):
+        async with self.slots:
+            return await self.loop.run_in_executor(self.executor,
+                self.execute, lookup)
+
+    def execute(self, lookup):
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None:
+            self.local.conn = u.db_connect()
+            cursor = self.local.cursor = self.local.conn.cursor()
+        return lookup(cursor)
+
+    """Closes the connection of the worker running it, once every worker
+    runs one (so each closes its own; SQLite connections can only be closed
+    by the thread that opened them)
+    """
+    def disconnect(self, barrier):
+        barrier.wait()
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        barrier = threading.Barrier(self.concurrency)
+        for i in range(self.concurrency):
+            self.executor.submit(self.disconnect, barrier)
+        self.executor.shutdown()
+
+
+"""The pool of this process for the reference database in use, or None when
+lookups are not pipelined (or inside sequential)
+A pool opened for another database (see reference.py) or concurrency is
+closed and replaced.
+"""
+def shared_pool(concurrency=None):
+    if sequential.depth > 0:
+        return None
+    if concurrency is None:
+        concurrency = default_concurrency()
+    key = (concurrency, os.environ.get('ANN_REFERENCE_DB'),
+        os.environ.get('ANN_REFERENCE_DATABASE'))
+    if shared_pool.key != key and shared_pool.pool is not None:
+        shared_pool.pool.close()
+        shared_pool.pool = None
+    if shared_pool.pool is None and concurrency > 0:
+        shared_pool.pool = LookupPool(concurrency)
+    shared_pool.key = key
+    return shared_pool.pool
+
+shared_pool.pool = None
+shared_pool.key = None
+
+
+"""Stages started inside run their lookups on their own cursor, uncached,
+as for stages given a connection to another database than the one the
+pool connects to (utils.db_connect), e.g. a snapshot in delta.py
+"""
+@contextlib.contextmanager
+def sequential():
+    sequential.depth = sequential.depth + 1
+    try:
+        yield
+    finally:
+        sequential.depth = sequential.depth - 1
+
+sequential.depth = 0
+
+
+"""Pairs every record with the result of its lookup, in record order
+lookup(record) gives the lookup of a record (a function of a cursor), or
+None for a record that needs none (header lines, certain misses), which is
+paired with None. Lookups found in the cache (see shared_cache) are not
+run. With a pool, the others are started as records come in and up to
+READAHEAD per connection are held in a reorder buffer until the ones ahead
+of them are done; without one, each is run on cursor in turn. name, if
+given, labels the cache hit rate printed once records runs out.
+"""
+def pipelined(records, lookup, cursor, pool=None, name=None):
+    if pool is None:
+        pool = shared_pool()
+    cache = shared_cache()
+    # Hits and misses of this stage
+    counts = [0, 0]
+
+    window = 1 if pool is None else READAHEAD * pool.concurrency
+    buffered = collections.deque()
+    try:
+        for record in records:
+            buffered.append(start(record, lookup(record), cursor, pool, cache,
+                counts))
+            if len(buffered) >= window:
+                yield finish(buffered.popleft(), cache)
+        while buffered:
+            yield finish(buffered.popleft(), cache)
+    finally:
+        for record, key, future, value in buffered:
+            if future is not None:
+                future.cancel()
+
+    if name is not None and cache is not None:
+        report(name, counts[0], counts[1])
+    flush_cache(due_only=True)
+
+
+"""A lookup under way: (record, cache key, future, result)
+"""
+def start(record, pending, cursor, pool, cache, counts):
+    if pending is None:
+        return record, None, None, None
+    key = None
+    if cache is not None:
+        key = cache.key(pending)
+        value = cache.get(key)
+        if value is not MISSING:
+            counts[0] = counts[0] + 1
+            return record, None, None, value
+        counts[1] = counts[1] + 1
+    if pool is None:
+        return record, key, None, pending(cursor)
+    return record, key, pool.submit(pending), None
+
+
+def finish(entry, cache):
+    record, key, future, value = entry
+    if future is not None:
+        value = future.result()
+    if key is not None:
+        cache.put(key, value)
+    return record, value
+
+
+"""Result of one lookup, from the cache if it is there, else run on cursor
+"""
+def cached(lookup, cursor):
+    cache = shared_cache()
+    if cache is None:
+        return lookup(cursor)
+    key = cache.key(lookup)
+    value = cache.get(key)
+    if value is MISSING:
+        value = lookup(cursor)
+        cache.put(key, value)
+    return value
+
+
+"""Lookup that runs sql and gives all its rows
+"""
+def fetch_all(sql):
+    def lookup(cursor):
+        cursor.execute(sql)
+        return cursor.fetchall()
+    lookup.key = 'all\0' + sql
+    return lookup
+
+
+"""Lookup that gives the first row of sql
+"""
+def fetch_one(sql):
+    def lookup(cursor):
+        cursor.execute(sql)
+        return cursor.fetchone()
+    lookup.key = 'one\0' + sql
+    return lookup
+
+
+"""Lookup that runs each of sqls until one has rows, and gives those (the
+rows of the last when none has)
+"""
+def first_with_rows(sqls):
+    def lookup(cursor):
+        rows = []
+        for sql in sqls:
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+            if (len(rows) > 0):
+                break
+        return rows
+    lookup.key = 'first\0' + '\0'.join(sqls)
+    return lookup
+
+
+"""Results of lookups (see fetch_all) against one reference version, kept
+in memory and in a file on local disk so a process started later on the
+instance begins with them
+Lookups are keyed by a digest of what they run; at most max_entries are
+kept, the least recently used dropped first. The file holds a compressed
+pickle of the entries and is written at most every save_interval seconds,
+when a stage is done (see pipelined), and when the process exits.
+Processes writing the same file merge their entries with those already in
+it.
+"""
+class LookupCache(object):
+    def __init__(self, path, max_entries, save_interval=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Entries put since the last save
+        self.added = 0
+        self.saved = time.time()
+        # (mtime, size) of the file as last read or written
+        self.stamp = None
+
+    def key(self, lookup):
+        return hashlib.blake2b(lookup.key.encode('utf-8'),
+            digest_size=16).digest()
+
+    def get(self, key):
+        value = self.entries.get(key, MISSING)
+        if value is MISSING:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.added = self.added + 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    """Reads the entries of the file, if any; returns how many there are
+    """
+    def load(self):
+        began = time.time()
+        entries = self.read()
+        if entries is None:
+            print(f"Lookup cache {self.path}: starting cold")
+            return 0
+        for key, value in entries:
+            self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        print(f"Lookup cache {self.path}: {len(self.entries)} lookups "
+            f"loaded in {time.time() - began:.2f}s")
+        return len(self.entries)
+
+    def read(self):
+        try:
+            with open(self.path, 'rb') as fh:
+                stat = os.fstat(fh.fileno())
+                data = fh.read()
+        except FileNotFoundError:
+            return None
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+        header = len(CACHE_MAGIC) + 4
+        if data[:len(CACHE_MAGIC)] != CACHE_MAGIC or struct.unpack('<I',
+            data[len(CACHE_MAGIC):header])[0] != CACHE_FORMAT_VERSION:
+            print(f"Lookup cache {self.path}: unknown format, ignored")
+            return None
+        try:
+            return pickle.loads(zlib.decompress(data[header:]))
+        except Exception as e:
+            print(f"Lookup cache {self.path}: unreadable, ignored:", str(e))
+            return None
+
+    """Writes the entries to the file, merged with those other processes
+    wrote to it since it was last read
+    """
+    def save(self):
+        began = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+            exist_ok=True)
+        with open(self.path + '.lock', 'w') as fh_lock:
+            fcntl.flock(fh_lock, fcntl.LOCK_EX)
+            try:
+                stat = os.stat(self.path)
+                if self.stamp != (stat.st_mtime_ns, stat.st_size):
+                    # Entries of this process count as the more recent
+                    merged = collections.OrderedDict(self.read() or [])
+                    merged.update(self.entries)
+                    for key in self.entries:
+                        merged.move_to_end(key)
+                    self.entries = merged
+                    while len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+            except FileNotFoundError:
+                pass
+
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as fh:
+                fh.write(CACHE_MAGIC + struct.pack('<I', CACHE_FORMAT_VERSION))
+                fh.write(zlib.compress(pickle.dumps(list(self.entries.items()),
+                    protocol=pickle.HIGHEST_PROTOCOL), 1))
+            os.replace(tmp, self.path)
+            stat = os.stat(self.path)
+            self.stamp = (stat.st_mtime_ns, stat.st_size)
+        self.added = 0
+        self.saved = time.time()
+        print(f"Lookup cache {self.path}: {len(self.entries)} lookups "
+            f"({stat.st_size} bytes) saved in {time.time() - began:.2f}s")
+
+    """Saves if there is anything new and the last save is save_interval
+    seconds old
+    """
+    def save_due(self):
+        if self.added > 0 and time.time() - self.saved >= self.save_interval:
+            self.save()
+
+
+"""Path of the lookup cache file of the reference version in use, if any
+ANN_LOOKUP_CACHE points at it (see reference.py)
+"""
+def cache_path():
+    return os.environ.get('ANN_LOOKUP_CACHE') or None
+
+
+"""The lookup cache of this process for the reference version in use (or
+path), loaded from its file when first needed, or None when lookups are
+not cached (or inside sequential)
+ANN_LOOKUP_CACHE_ENTRIES and ANN_LOOKUP_CACHE_INTERVAL size it and pace its
+saves (annotator.py takes them from ann_config.ini); no entries disables
+it. The cache of another version is saved and replaced.
+"""
+def shared_cache(path=None):
+    if sequential.depth > 0:
+        return None
+    max_entries = int(os.environ.get('ANN_LOOKUP_CACHE_ENTRIES', 0))
+    if max_entries <= 0:
+        path = None
+    elif path is None:
+        path = cache_path()
+    cache = shared_cache.cache
+    if cache is not None and cache.path != path:
+        flush_cache()
+        shared_cache.cache = cache = None
+    if cache is None and path is not None:
+        cache = LookupCache(path, max_entries,
+            int(os.environ.get('ANN_LOOKUP_CACHE_INTERVAL', 300)))
+        cache.load()
+        shared_cache.cache = cache
+    return cache
+
+shared_cache.cache = None
+
+
+"""Saves the shared cache if it has anything new (only when due, with
+due_only); called when the process exits
+"""
+def flush_cache(due_only=False):
+    cache = shared_cache.cache
+    if cache is None or cache.added == 0:
+        return
+    try:
+        if due_only:
+            cache.save_due()
+        else:
+            cache.save()
+    except OSError as e:
+        print(f"Failed to save lookup cache {cache.path}:", str(e))
+
+atexit.register(flush_cache)
+
+
+"""Drops the shared cache, unsaved, if it is the one at path (e.g. of a
+reference version being released)
+"""
+def discard_cache(path):
+    if shared_cache.cache is not None and shared_cache.cache.path == path:
+        shared_cache.cache = None
+
+
+"""Prints the cache hit rate of a stage, next to its other progress output
+"""
+def report(name, hits, misses):
+    if hits + misses > 0:
+        print(f"Lookup cache {name}: {hits} hits, {misses} misses "
+            f"({100.0 * hits / (hits + misses):.1f}% hit)")
+
+### EOF
@@ -17,23 +17,15 @@ import file_utils as fu
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
 ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
                 "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
+ACCEPTED = frozenset(ACCEPTED_CHR)
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
+"""Reads that support ALT: the depth less the reads matching the reference
+('.' and ',') and deletions ('*')
+"""
 def count_alt(depth, bases):
-    bases = bases.upper()
-    lst = list(bases)
-    ast = 0
-    match_sum = 0
-
-    for l in lst:
-        l = str(l)
-
-        if ((str(l) == '.') or (str(l) == ',')):
-            match_sum = match_sum + 1
-        elif (l == '*'):
-            ast = ast + 1
-
-    return (int(depth) - (match_sum + ast))
+    return int(depth) - (bases.count('.') + bases.count(',') +
+        bases.count('*'))
 
 
 def vcfheader(pileup):
@@ -58,7 +50,7 @@ def vcfheader(pileup):
 
 def hetero2homo(ref, alt):
     """ Converts heterozygous symbols from Samtools pileup to A, G, T, C """
-    if not fu.isOnTheList(HETERO.keys(), alt):
+    if alt not in HETERO:
         return alt
     else:
         alt_x = HETERO[alt]
@@ -83,7 +75,7 @@ def varpileup_line2vcf_line(pileupfields):
     alt_count = str(count_alt(depth, pileupfields[8]))
 
     GT = '1/1'
-    if fu.isOnTheList(HETERO.keys(), alt):
+    if alt in HETERO:
         GT = '0/1'
         alt = hetero2homo(ref,alt)
 
@@ -92,32 +84,42 @@ def varpileup_line2vcf_line(pileupfields):
         consqual + ':' + depth + ':' + alt_count
 
 
+"""Converts the lines of a variant pileup to VCF lines (without '\n') as
+they are read: the header first (see vcfheader; pileup names the file),
+then a record per variant on chromosomes 1 - 22, X, Y and MT with ALT
+other than REF. Blank lines are skipped; a line too short to be pileup
+raises ValueError naming it, rather than losing its variant unnoticed.
+"""
+def pileup2vcf_lines(lines, pileup='pileup', chr_col=0, ref_col=2,
+    alt_col=3, sep='\t'):
+    yield from vcfheader(pileup).split('\n')
+    for number, line in enumerate(lines, 1):
+        fields = line.strip().split(sep, 9)
+        if len(fields) < 9:
+            if not line.strip():
+                continue
+            raise ValueError(f"{os.path.basename(pileup)}, line {number}: " +
+                f"{len(fields)} fields, a pileup line has at least 9")
+        if fields[alt_col] != fields[ref_col] and \
+            fields[chr_col].strip() in ACCEPTED:
+            yield varpileup_line2vcf_line(fields)
+
+
 def filter_pileup(pileup, outfile=None, chr_col=0, 
     ref_col=2, alt_col=3, sep='\t'):
-    
-    fh = open(pileup, "r")
     if (outfile is None):
         outfile = pileup + '.vcf'
 
     fu.delete(outfile)
-    fh_out = open(outfile, "w")
-    fh_out.write(vcfheader(pileup) + '\n')
-
-
-    for line in fh:
-        line = line.strip()
-        fields = line.split(sep)
-
-        chr = str(fields[chr_col])
-        ref = str(fields[ref_col])
-        alt = str(fields[alt_col])
-
-        if ((alt != ref) and \
-            (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-            fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
+    with open(pileup, "r") as fh, open(outfile, "w") as fh_out:
+        for line in pileup2vcf_lines(fh, pileup, chr_col=chr_col,
+            ref_col=ref_col, alt_col=alt_col, sep=sep):
+            fh_out.write(line + '\n')
 
 
 """Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT
+The pipeline filters as its first stage instead (see
+annotate.filterRecordsLines); this rewrites a whole file.
 """
 def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3, 
     alt_col=4, sep='\t'):
@@ -141,8 +143,7 @@ def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3,
                 ref = str(fields[ref_col])
                 alt = str(fields[alt_col])
 
-                if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
+                if (alt != ref) and (chr.strip() in ACCEPTED):
                     fh_out.write(str(line) + '\n')
 
 ### EOF
\ No newline at end of file
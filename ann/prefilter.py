@@ -0,0 +1,274 @@
+# prefilter.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Bloom filters over the positions of the exact-position reference tables,
+# so that lookups that cannot match are skipped
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import os
+import sys
+import json
+import math
+import mmap
+import struct
+import argparse
+
+import contigs
+
+MAGIC = b'ANNBLOOM'
+FORMAT_VERSION = 1
+DEFAULT_FP_RATE = 0.01
+MASK64 = (1 << 64) - 1
+
+# Tables looked up by exact position: table -> (contig column, position column)
+PREFILTERED_TABLES = {
+    'dbSNP': ('CHR', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start'),
+    'gwasCatalog': ('chrom', 'chromEnd'),
+}
+
+"""Bloom filter over packed position keys (see contigs.pack)
+Sized for its number of keys and false positive rate: 0.01 takes about
+1.2 bytes per key, 0.001 about 1.8. Keeps counts of the lookups it lets
+through (hits) and the ones it rules out (skips). data may be a read-only
+view, as it is for filters mapped by load_prefilters.
+"""
+class BloomFilter(object):
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray((bits + 7) // 8) if data is None else data
+        self.hits = 0
+        self.skips = 0
+
+    @classmethod
+    def for_keys(cls, keys, fp_rate=DEFAULT_FP_RATE):
+        keys = max(1, keys)
+        bits = max(64, int(math.ceil(-keys * math.log(fp_rate) /
+            (math.log(2) ** 2))))
+        hashes = max(1, int(round(bits / keys * math.log(2))))
+        return cls(bits, hashes)
+
+    def positions(self, key):
+        # splitmix64 finalizer, then double hashing
+        h = (key + 0x9E3779B97F4A7C15) & MASK64
+        h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+        h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & MASK64
+        h = h ^ (h >> 31)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def add(self, key):
+        data = self.data
+        for bit in self.positions(key):
+            data[bit >> 3] |= 1 << (bit & 7)
+
+    def __contains__(self, key):
+        data = self.data
+        for bit in self.positions(key):
+            if not data[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    """Whether the table may have a row at contig:pos, counting the answer
+    Ids of non-canonical contigs are not stable between processes, so
+    those are never filtered.
+    """
+    def may_contain(self, contig, pos):
+        if contig > len(contigs.CANONICAL) or \
+            contigs.pack(contig, pos) in self:
+            self.hits = self.hits + 1
+            return True
+        self.skips = self.skips + 1
+        return False
+
+
+"""Cursor that streams a large result instead of buffering all of it
+"""
+def streaming_cursor(conn):
+    if type(conn).__module__.startswith('pymysql'):
+        import pymysql.cursors
+        return conn.cursor(pymysql.cursors.SSCursor)
+    return conn.cursor()
+
+
+"""Builds one filter per prefiltered table from the reference database
+Rows on non-canonical contigs are left out (see BloomFilter.may_contain),
+without registering their names, so a build may run beside jobs in the
+same process.
+"""
+def build_prefilters(conn, fp_rate=DEFAULT_FP_RATE,
+    tables=PREFILTERED_TABLES):
+    filters = {}
+    for table, (chrom_column, pos_column) in tables.items():
+        cursor = conn.cursor()
+        cursor.execute(f"select count(*) from {table}")
+        count = cursor.fetchone()[0]
+        cursor.close()
+
+        bloom = BloomFilter.for_keys(count, fp_rate)
+        cursor = streaming_cursor(conn)
+        cursor.execute(f"select {chrom_column}, {pos_column} from {table}")
+        rows = cursor.fetchmany(10000)
+        while rows:
+            for chrom, pos in rows:
+                contig = contigs.CONTIG_IDS.get(str(chrom))
+                if contig is not None and contig <= len(contigs.CANONICAL):
+                    bloom.add(contigs.pack(contig, int(pos)))
+            rows = cursor.fetchmany(10000)
+        cursor.close()
+        filters[table] = bloom
+    return filters
+
+
+"""Writes filters to one file: magic, header length, JSON header, bit arrays
+"""
+def save_prefilters(filters, path, fp_rate=DEFAULT_FP_RATE):
+    header = {'version': FORMAT_VERSION, 'fp_rate': fp_rate, 'tables': {}}
+    offset = 0
+    for table, bloom in filters.items():
+        header['tables'][table] = {'bits': bloom.bits,
+            'hashes': bloom.hashes, 'offset': offset,
+            'length': len(bloom.data)}
+        offset = offset + len(bloom.data)
+    encoded = json.dumps(header).encode('utf-8')
+
+    with open(path + '.tmp', 'wb') as fh:
+        fh.write(MAGIC + struct.pack('<I', len(encoded)) + encoded)
+        for bloom in filters.values():
+            fh.write(bloom.data)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+"""Maps filters written by save_prefilters read-only, so the workers on an
+instance share one copy of them in the page cache
+"""
+def load_prefilters(path):
+    with open(path, 'rb') as fh:
+        mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapping[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a prefilter file")
+    length = struct.unpack('<I', mapping[len(MAGIC):len(MAGIC) + 4])[0]
+    offset = len(MAGIC) + 4
+    header = json.loads(mapping[offset:offset + length].decode('utf-8'))
+    data = memoryview(mapping)[offset + length:]
+
+    filters = {}
+    for table, spec in header['tables'].items():
+        filters[table] = BloomFilter(spec['bits'], spec['hashes'],
+            data[spec['offset']:spec['offset'] + spec['length']])
+    return filters
+
+
+"""Path of the filters for the reference in use, if there are any
+ANN_PREFILTERS names the file; with a local reference (ANN_REFERENCE_DB)
+the filters persisted next to it are used.
+"""
+def default_path():
+    if 'ANN_PREFILTERS' in os.environ:
+        return os.environ['ANN_PREFILTERS']
+    if 'ANN_REFERENCE_DB' in os.environ:
+        path = os.environ['ANN_REFERENCE_DB'] + '.prefilter'
+        if os.path.exists(path):
+            return path
+    return None
+
+
+"""Filter for a table, or None when lookups cannot be prefiltered
+Filters are loaded once per process and per file.
+"""
+def table_filter(table):
+    path = default_path()
+    if path is None:
+        return None
+    if path not in table_filter.loaded:
+        table_filter.loaded[path] = load_prefilters(path)
+    return table_filter.loaded[path].get(table)
+
+table_filter.loaded = {}
+
+
+"""Hits and skips of every loaded filter so far, by table
+"""
+def counters():
+    counts = {}
+    for filters in table_filter.loaded.values():
+        for table, bloom in filters.items():
+            counts[table] = {'hits': bloom.hits, 'skips': bloom.skips}
+    return counts
+
+
+"""A filter's (hits, skips) so far, for report
+"""
+def snapshot(bloom):
+    return (bloom.hits, bloom.skips) if bloom is not None else (0, 0)
+
+
+"""Prints what a filter did during a stage, next to its other progress
+output; before is the snapshot taken when the stage started
+"""
+def report(table, bloom, before):
+    if bloom is not None:
+        print(f"Prefilter {table}: {bloom.skips - before[1]} lookups "
+            f"skipped, {bloom.hits - before[0]} passed")
+
+
+"""Key of the filters of a reference version (by default the configured
+one) in the results bucket, where annotator.py fetches them from
+"""
+def prefilter_key(config, version=None):
+    return f"{config['prefilter']['Prefix']}/" + \
+        f"{version or config['cache']['ReferenceVersion']}.bloom"
+
+
+def main(argv=None):
+    from configparser import ConfigParser
+    config = ConfigParser(os.environ)
+    config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+        'ann_config.ini'))
+
+    parser = argparse.ArgumentParser(
+        description='Build the prefilters of the reference database; run '
+                    'whenever a new reference snapshot is loaded')
+    parser.add_argument('output', help='file to write the filters to')
+    parser.add_argument('--fp-rate', type=float,
+        default=float(config['prefilter']['FalsePositiveRate']),
+        help='false positive rate (default: from ann_config.ini)')
+    parser.add_argument('--upload', action='store_true',
+        help='store the filters in the results bucket for annotator.py')
+    parser.add_argument('--version',
+        help='reference version the filters are stored for (default: '
+             '[cache] ReferenceVersion), as published with reference.py')
+    parser.add_argument('--database',
+        help='reference database to build from (default: that of the '
+             'current version, see utils.db_connect)')
+    args = parser.parse_args(argv)
+
+    import utils
+    conn = utils.db_connect(args.database)
+    filters = build_prefilters(conn, fp_rate=args.fp_rate)
+    conn.close()
+    save_prefilters(filters, args.output, fp_rate=args.fp_rate)
+    for table, bloom in filters.items():
+        print(f"{table}: {len(bloom.data)} bytes, {bloom.hashes} hashes",
+            file=sys.stderr)
+
+    if args.upload:
+        import boto3
+        s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+        s3.upload_file(args.output, config['gas']['ResultsBucket'],
+            prefilter_key(config, args.version))
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,285 @@
+# reference.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Versions of the reference data, and switching a running annotator from
+# one to the next without a restart
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+
+from botocore.exceptions import ClientError
+
+import prefilter
+import intervals
+
+"""Version of the reference data a job runs against
+annotator.py sets ANN_REFERENCE_VERSION for every job it starts; without
+it (e.g. run.py started by hand) the configured version is used.
+"""
+def job_version(config):
+    return os.environ.get('ANN_REFERENCE_VERSION',
+        config['cache']['ReferenceVersion'])
+
+
+"""Key of the object in the results bucket naming the current version
+"""
+def pointer_key(config):
+    return f"{config['reference']['Prefix']}/current.json"
+
+
+"""The current version as published, or None if nothing was published
+The pointer holds {"version": ..., "database": ...}.
+"""
+def read_pointer(s3, config):
+    try:
+        response = s3.get_object(Bucket=config['gas']['ResultsBucket'],
+            Key=pointer_key(config))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+"""One version of the reference data on this instance: the database that
+holds it and the local files derived from it (prefilters, interval index
+snapshots, cached lookups)
+The lookup cache is kept in lookup_directory, by default under
+job_directory.
+"""
+class ReferenceVersion(object):
+    def __init__(self, version, database, job_directory,
+        lookup_directory=None):
+        self.version = version
+        self.database = database
+        self.prefilter_file = os.path.join(job_directory, version + '.bloom')
+        self.snapshot_directory = os.path.join(job_directory, 'indexes',
+            version)
+        self.lookup_cache_file = os.path.join(lookup_directory or
+            os.path.join(job_directory, 'lookups'), version + '.lookups')
+        self.jobs = 0
+
+    """Gets everything ready that the first jobs on the version would
+    otherwise build: its prefilters (fetched as published, or else built
+    from the database) and the interval index snapshots of its overlap
+    stages
+    """
+    def prepare(self, s3, config):
+        # Fail here rather than in the first job if the database is missing
+        import utils
+        conn = utils.db_connect(self.database)
+        try:
+            if not os.path.exists(self.prefilter_file):
+                self.fetch_prefilters(s3, config, conn)
+            self.build_snapshots(conn)
+        finally:
+            conn.close()
+
+    def fetch_prefilters(self, s3, config, conn):
+        try:
+            s3.download_file(config['gas']['ResultsBucket'],
+                prefilter.prefilter_key(config, self.version),
+                self.prefilter_file + '.tmp')
+            os.replace(self.prefilter_file + '.tmp', self.prefilter_file)
+            return
+        except ClientError as e:
+            print(f"No prefilters published for reference {self.version}, "
+                "building them:", str(e))
+        fp_rate = float(config['prefilter']['FalsePositiveRate'])
+        prefilter.save_prefilters(prefilter.build_prefilters(conn,
+            fp_rate=fp_rate), self.prefilter_file, fp_rate=fp_rate)
+
+    """Writes the interval index snapshots of every canonical contig for
+    the overlap stages (see annotate.addOverlapWithSourceLines), unless
+    the stages look up per variant (batch size 0)
+    """
+    def build_snapshots(self, conn):
+        if not intervals.default_batch_size():
+            return
+        import driver
+        import sources
+        import contigs
+        import annotate
+        cursor = conn.cursor()
+        for name, stage, kwargs in driver.STAGES:
+            if stage is not annotate.addOverlapWithSourceLines:
+                continue
+            source = sources.source(kwargs['source'], kwargs.get('table'))
+            table = intervals.IntervalTable(cursor, source.select,
+                start_column=source.start_column,
+                end_column=source.end_column,
+                snapshots=self.snapshot_directory)
+            for contig in range(1, len(contigs.CANONICAL) + 1):
+                table.index(contig)
+        cursor.close()
+
+    """A copy of the environment base that points the stages at this version
+    """
+    def environment(self, base):
+        env = dict(base)
+        env.update({'ANN_REFERENCE_VERSION': self.version,
+                    'ANN_REFERENCE_DATABASE': self.database,
+                    'ANN_INDEX_SNAPSHOTS': self.snapshot_directory,
+                    'ANN_LOOKUP_CACHE': self.lookup_cache_file})
+        if os.path.exists(self.prefilter_file):
+            env['ANN_PREFILTERS'] = self.prefilter_file
+        else:
+            env.pop('ANN_PREFILTERS', None)
+        return env
+
+    """Points the stages run by this process at this version
+    """
+    def activate(self):
+        env = self.environment(os.environ)
+        os.environ.pop('ANN_PREFILTERS', None)
+        os.environ.update(env)
+
+    """Drops the version's local files and whatever this process still has
+    loaded from them
+    """
+    def release(self):
+        prefilter.table_filter.loaded.pop(self.prefilter_file, None)
+        for path in list(intervals.load_snapshot.loaded):
+            if os.path.dirname(path) == self.snapshot_directory:
+                del intervals.load_snapshot.loaded[path]
+        import lookups
+        lookups.discard_cache(self.lookup_cache_file)
+        if os.path.exists(self.prefilter_file):
+            os.remove(self.prefilter_file)
+        for path in (self.lookup_cache_file, self.lookup_cache_file + '.lock'):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(self.snapshot_directory, ignore_errors=True)
+
+
+"""Keeps track of the reference version new jobs get
+A newly published version is prepared in a background thread while jobs
+keep running on the current one. Once it is ready, new jobs switch to it
+at once, and the version it replaces is released when its last job is
+done.
+"""
+class ReferenceManager(object):
+    def __init__(self, s3, config, job_directory):
+        self.s3 = s3
+        self.config = config
+        self.job_directory = job_directory
+        self.check_interval = int(config['reference']['CheckInterval'])
+        self.lookup_directory = config['lookupcache']['Directory'] or None
+        self.lock = threading.Lock()
+        self.current = ReferenceVersion(config['cache']['ReferenceVersion'],
+            config['reference']['Database'], job_directory,
+            self.lookup_directory)
+        self.retired = []
+        self.loading = None
+        self.checked = 0
+
+        pointer = self.read_pointer()
+        if pointer is not None:
+            self.current = ReferenceVersion(pointer['version'],
+                pointer['database'], job_directory, self.lookup_directory)
+        try:
+            self.current.prepare(s3, config)
+        except Exception as e:
+            print(f"Failed to load reference {self.current.version}:", str(e))
+        self.checked = time.time()
+        print(f"Annotating against reference {self.current.version}")
+
+    def read_pointer(self):
+        try:
+            return read_pointer(self.s3, self.config)
+        except ClientError as e:
+            print("Failed to read the current reference version:", str(e))
+            return None
+
+    """Looks for a new version, at most once every check interval, and
+    releases retired versions whose jobs are all done
+    """
+    def poll(self):
+        self.release_retired()
+        if self.loading is not None or \
+            time.time() - self.checked < self.check_interval:
+            return
+        self.checked = time.time()
+
+        pointer = self.read_pointer()
+        if pointer is None or pointer['version'] == self.current.version:
+            return
+        print(f"Loading reference {pointer['version']}")
+        self.loading = threading.Thread(target=self.load,
+            args=(ReferenceVersion(pointer['version'], pointer['database'],
+                self.job_directory, self.lookup_directory),), daemon=True)
+        self.loading.start()
+
+    def load(self, version):
+        try:
+            version.prepare(self.s3, self.config)
+        except Exception as e:
+            # Jobs stay on the current version; tried again next interval
+            print(f"Failed to load reference {version.version}:", str(e))
+            self.loading = None
+            return
+        with self.lock:
+            self.retired.append(self.current)
+            self.current = version
+        print(f"Switched to reference {version.version}")
+        self.loading = None
+
+    """The version for a new job; give it back with release once the job
+    is done
+    """
+    def acquire(self):
+        with self.lock:
+            self.current.jobs = self.current.jobs + 1
+            return self.current
+
+    def release(self, version):
+        with self.lock:
+            version.jobs = version.jobs - 1
+
+    def release_retired(self):
+        with self.lock:
+            done = [version for version in self.retired if version.jobs == 0]
+            self.retired = [version for version in self.retired
+                if version.jobs > 0]
+        for version in done:
+            version.release()
+            print(f"Released reference {version.version}")
+
+
+def main(argv=None):
+    from configparser import ConfigParser
+    config = ConfigParser(os.environ)
+    config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)),
+        'ann_config.ini'))
+
+    parser = argparse.ArgumentParser(
+        description='Publish a reference version; running annotators switch '
+                    'new jobs to it')
+    parser.add_argument('version', help='version id, e.g. anntools-2020')
+    parser.add_argument('database',
+        help='reference database holding the version')
+    args = parser.parse_args(argv)
+
+    import boto3
+    s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+    s3.put_object(Bucket=config['gas']['ResultsBucket'],
+        Key=pointer_key(config),
+        Body=json.dumps({'version': args.version,
+            'database': args.database}).encode('utf-8'))
+    print(f"Published reference {args.version}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,263 @@
+# reference_fixture.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Small deterministic stand-in for the AnnTools reference database
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import os
+import sys
+import glob
+import random
+import sqlite3
+
+import contigs
+import prefilter
+
+DATA_DIRECTORY = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+    'data')
+
+# GRCh37 contig lengths
+CONTIG_LENGTHS = {'1': 249250621, '2': 243199373, '3': 198022430,
+    '4': 191154276, '5': 180915260, '6': 171115067, '7': 159138663,
+    '8': 146364022, '9': 141213431, '10': 135534747, '11': 135006516,
+    '12': 133851895, '13': 115169878, '14': 107349540, '15': 102531392,
+    '16': 90354753, '17': 81195210, '18': 78077248, '19': 59128983,
+    '20': 63025520, '21': 48129895, '22': 51304566, 'X': 155270560,
+    'Y': 59373566, 'MT': 16569}
+
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+# bigRefGene columns after id, CHR, start, end (see annotate.collapseRefSeq)
+BIG_REF_GENE_COLUMNS = ['haplotypeReference', 'haplotypeAlternate', 'name',
+    'name2', 'transcriptStrand', 'positionType', 'frame', 'mrnaCoord',
+    'codonCoord', 'spliceDist', 'referenceCodon', 'referenceAA',
+    'variantCodon', 'variantAA', 'changesAA', 'functionalClass',
+    'codingCoordStr', 'proteinCoordStr', 'inCodingRegion', 'spliceInfo',
+    'uorfChange']
+
+# Column order matters: the stages read rows by position
+SCHEMA = {
+    'dbSNP': ['CHR', 'POS', 'VID', 'RSID', 'REF', 'ALT', 'QUAL', 'GMAF',
+        'INFO'],
+    'chrom_pos_equal_base': ['id', 'CHR', 'start', 'end'] +
+        BIG_REF_GENE_COLUMNS,
+    'chrom_pos_equal_nobase': ['id', 'CHR', 'start', 'end'] +
+        BIG_REF_GENE_COLUMNS,
+    'chrom_pos_unequal': ['id', 'CHR', 'start', 'end'] +
+        BIG_REF_GENE_COLUMNS,
+    'refGene': ['bin', 'name', 'chrom', 'strand', 'txStart', 'txEnd',
+        'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
+        'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames'],
+    'cpgIslandExt': ['chrom', 'chromStart', 'chromEnd', 'name'],
+    'cytoBand': ['chrom', 'chromStart', 'chromEnd', 'name', 'gieStain'],
+    'gadAll': ['chromosome', 'chromStart', 'chromEnd', 'geneSymbol'],
+    'gwasCatalog': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name',
+        'pubMedID', 'author', 'pubDate', 'journal', 'title', 'trait'],
+    'targetScanS': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name',
+        'score', 'strand'],
+    'hugo': ['bin', 'chrom', 'chromStart', 'chromEnd', 'hgncId', 'symbol',
+        'name'],
+    'genomicSuperDups': ['bin', 'chrom', 'chromStart', 'chromEnd', 'name',
+        'score', 'strand', 'otherChrom', 'otherStart', 'otherEnd'],
+}
+for cnv_table in CNV_TABLES:
+    SCHEMA[cnv_table] = ['chrom', 'chromStart', 'chromEnd', 'name']
+for chrom in CONTIG_LENGTHS:
+    if chrom != 'MT':
+        SCHEMA['tfbsConsSites' + chrom] = ['chrom', 'chromStart', 'chromEnd',
+            'name']
+
+COMPLEMENT = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
+
+
+"""How the UCSC tables name a contig (chrM for MT)
+"""
+def ucsc_name(chrom):
+    return contigs.ucsc_name(contigs.contig_id(chrom))
+
+
+"""(chrom, pos, ref, alt) of every record in the bundled sample files
+"""
+def sample_variants(data_directory=DATA_DIRECTORY):
+    variants = []
+    for vcf in sorted(glob.glob(os.path.join(data_directory, '*.vcf'))):
+        fh = open(vcf)
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            chrom = contigs.ensembl_name(contigs.contig_id(fields[0]))
+            variants.append((chrom, int(fields[1]), fields[3], fields[4]))
+        fh.close()
+    return variants
+
+
+"""Inserts one row, in SCHEMA column order
+"""
+def insert(cursor, table, row):
+    cursor.execute(f"insert into {table} values "
+        f"({','.join('?' * len(SCHEMA[table]))})", row)
+
+
+"""Point annotations: dbSNP, bigRefGene and gwasCatalog rows placed on
+(a share of) the sample variants, so the exact-match stages get hits
+"""
+def add_point_annotations(cursor, rnd, variants):
+    snp_id = 0
+    for chrom, pos, ref, alt in variants:
+        if rnd.random() < 0.3:
+            for i in range(rnd.choice([1, 1, 2])):
+                snp_id = snp_id + 1
+                insert(cursor, 'dbSNP', (chrom, pos, snp_id, f"rs{snp_id}",
+                    rnd.choice([ref, COMPLEMENT.get(ref, ref)]), alt, 0,
+                    rnd.choice(['.', f"0.{rnd.randint(1, 49):02d}"]), 'SNV'))
+
+        details = [rnd.choice(['', f"NM_{rnd.randint(1, 999)}"]),
+            f"G{rnd.randint(1, 50)}", rnd.choice(['+', '-']),
+            rnd.choice(['CDS', 'intron', 'utr3', 'utr5']), rnd.randint(0, 2)]
+        details = details + [rnd.choice(['0', '', str(rnd.randint(1, 900))])
+            for i in range(len(BIG_REF_GENE_COLUMNS) - 2 - len(details))]
+        draw = rnd.random()
+        if draw < 0.15:
+            insert(cursor, 'chrom_pos_equal_base',
+                [snp_id, chrom, pos, pos, ref, alt] + details)
+        elif draw < 0.25:
+            insert(cursor, 'chrom_pos_equal_nobase',
+                [snp_id, chrom, pos, pos, ref, 'N'] + details)
+        elif draw < 0.35:
+            insert(cursor, 'chrom_pos_unequal',
+                [snp_id, chrom, pos - rnd.randint(0, 5),
+                 pos + rnd.randint(0, 5), ref, alt] + details)
+
+        if rnd.random() < 0.05:
+            insert(cursor, 'gwasCatalog', (0, ucsc_name(chrom), pos - 1, pos,
+                'rs', rnd.randint(1000, 9999), 'a', 'd', 'j', 't',
+                f"trait {rnd.randint(1, 30)}"))
+
+
+"""Genes with exons, CDS bounds and a CpG island ahead of each, tiled
+along the contig
+"""
+def add_genes(cursor, rnd, chrom, length):
+    ucsc = ucsc_name(chrom)
+    gene = 0
+    start = rnd.randint(0, 2000)
+    while start < length:
+        span = rnd.randint(200, max(400, min(length // 10, 400000)))
+        end = start + span
+        exon_count = rnd.randint(1, 8)
+        if end - start > exon_count * 4:
+            cuts = sorted(rnd.sample(range(start + 1, end), exon_count * 2))
+        else:
+            cuts = [start + 1, end - 1] * exon_count
+        exon_starts = ','.join(str(cuts[2 * k]) for k in range(exon_count))
+        exon_ends = ','.join(str(cuts[2 * k + 1]) for k in range(exon_count))
+        if rnd.random() < 0.2:
+            # Non-coding
+            cds_start = cds_end = end
+        else:
+            cds_start = start + rnd.randint(0, span // 4)
+            cds_end = end - rnd.randint(0, span // 4)
+
+        gene = gene + 1
+        for isoform in range(rnd.choice([1, 1, 2])):
+            # Exon lists are blobs in RDS
+            insert(cursor, 'refGene', (0, f"NM_{chrom}_{gene}_{isoform}",
+                ucsc, rnd.choice(['+', '-']), start, end, cds_start,
+                cds_end, exon_count, (exon_starts + ',').encode(),
+                (exon_ends + ',').encode(), 0, f"GENE{chrom}_{gene}", 'cmpl',
+                'cmpl', b''))
+        insert(cursor, 'cpgIslandExt', (ucsc, start - 600,
+            start - 100, f"CpG: {rnd.randint(10, 99)}"))
+        start = end + rnd.randint(100, max(200, length // 40))
+
+
+"""Random intervals of up to max_span bases on a contig
+"""
+def intervals(rnd, length, count, max_span):
+    for i in range(count):
+        start = rnd.randint(0, length)
+        yield start, start + rnd.randint(10, max_span)
+
+
+"""Region annotations (bands, genes, CNVs, ...) for one contig
+"""
+def add_regions(cursor, rnd, chrom, length):
+    ucsc = ucsc_name(chrom)
+    step = max(length // 60, 300)
+    for i, start in enumerate(range(0, length, step)):
+        insert(cursor, 'cytoBand', (ucsc, start,
+            min(length, start + step), f"p{i}", 'gneg'))
+
+    add_genes(cursor, rnd, chrom, length)
+
+    for start, end in intervals(rnd, length, 40, max(100, length // 30)):
+        insert(cursor, 'gadAll', (chrom, start, end,
+            f"GAD{rnd.randint(1, 20)}"))
+    for start, end in intervals(rnd, length, 40, max(100, length // 30)):
+        insert(cursor, 'hugo', (0, ucsc, start, end, 'HGNC:1',
+            f"SYM{rnd.randint(1, 9)}", f"name; {rnd.randint(1, 9)}"))
+    for start, end in intervals(rnd, length, 60, max(50, length // 200)):
+        insert(cursor, 'targetScanS', (0, ucsc, start, end,
+            f"miR-{rnd.randint(1, 300)}", 50, '+'))
+    for table in CNV_TABLES:
+        for start, end in intervals(rnd, length, 30, max(100, length // 20)):
+            insert(cursor, table, (ucsc, start, end, 'cnv'))
+    for start, end in intervals(rnd, length, 30, max(100, length // 25)):
+        insert(cursor, 'genomicSuperDups', (0, ucsc, start, end,
+            'sd', 0, '+', ucsc_name(rnd.choice(list(CONTIG_LENGTHS))),
+            start + 5, end + 5))
+    if chrom != 'MT':
+        for start, end in intervals(rnd, length, 200, max(50, length // 300)):
+            insert(cursor, 'tfbsConsSites' + chrom, (ucsc, start,
+                end, f"V$TF{rnd.randint(1, 50)}"))
+
+
+"""Builds the fixture in a SQLite file (replacing any existing one), and
+its prefilters in <path>.prefilter
+The same seed always gives the same database, so annotated outputs and
+benchmark figures are comparable between runs and versions.
+"""
+def build_fixture(path, seed=7, data_directory=DATA_DIRECTORY):
+    if os.path.exists(path):
+        os.remove(path)
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+
+    for table, columns in SCHEMA.items():
+        cursor.execute(f"create table {table} ({', '.join(columns)})")
+
+    add_point_annotations(cursor, rnd, sample_variants(data_directory))
+    for chrom, length in CONTIG_LENGTHS.items():
+        add_regions(cursor, rnd, chrom, length)
+
+    # The stages look rows up by contig and position
+    for table, columns in SCHEMA.items():
+        chrom_column = next(c for c in columns
+            if c in ('CHR', 'chrom', 'chromosome'))
+        start_column = next(c for c in columns
+            if c in ('POS', 'start', 'txStart', 'chromStart'))
+        cursor.execute(f"create index {table}_position on {table} "
+            f"({chrom_column}, {start_column})")
+
+    conn.commit()
+    # Persisted with the reference, as for the real one (see prefilter.py)
+    prefilter.save_prefilters(prefilter.build_prefilters(conn),
+        path + '.prefilter')
+    conn.close()
+    return path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        print(build_fixture(sys.argv[1]))
+    else:
+        print("Usage: python reference_fixture.py <sqlite file>")
+
+### EOF
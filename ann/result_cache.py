@@ -0,0 +1,88 @@
+# result_cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Content-addressed cache of annotation results
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import json
+import hashlib
+from botocore.exceptions import ClientError
+
+MANIFEST = 'manifest.json'
+
+"""SHA-256 of a file, read in chunks so large inputs are never held in memory
+"""
+def hash_file(path, chunk_size=1048576):
+    sha = hashlib.sha256()
+    fh = open(path, 'rb')
+    for chunk in iter(lambda: fh.read(chunk_size), b''):
+        sha.update(chunk)
+    fh.close()
+    return sha.hexdigest()
+
+
+"""SHA-256 of an input already held in memory
+"""
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+"""Cache key for a result: the same input annotated against the same
+reference snapshot by the same pipeline always gives the same output
+"""
+def cache_key(input_hash, reference_version, pipeline_version):
+    key = f"{input_hash}:{reference_version}:{pipeline_version}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+"""Prefix under which a cache entry is stored
+"""
+def entry_prefix(root, key):
+    return f"{root}/{key[:2]}/{key}"
+
+
+"""Looks a cache entry up. Returns the manifest (file role -> S3 key) or None
+The manifest is written last, so an entry without one is incomplete
+"""
+def lookup(s3, bucket, root, key):
+    try:
+        response = s3.get_object(Bucket=bucket,
+            Key=f"{entry_prefix(root, key)}/{MANIFEST}")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise e
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+"""Copies the files of a cache entry to the keys of a job, server-side
+targets maps file role (result, log, index) to the job's S3 key; roles the
+entry has no file for are left out
+"""
+def fetch(s3, bucket, manifest, targets):
+    for role, target_key in targets.items():
+        if role not in manifest:
+            continue
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy.html
+        s3.copy({'Bucket': bucket, 'Key': manifest[role]}, bucket, target_key)
+
+
+"""Adds the files of a completed job to the cache, server-side
+sources maps file role (result, log, index) to the job's S3 key
+"""
+def store(s3, bucket, root, key, sources):
+    prefix = entry_prefix(root, key)
+    manifest = {}
+    for role, source_key in sources.items():
+        manifest[role] = f"{prefix}/{role}"
+        s3.copy({'Bucket': bucket, 'Key': source_key}, bucket, manifest[role])
+
+    s3.put_object(Bucket=bucket, Key=f"{prefix}/{MANIFEST}",
+        Body=json.dumps(manifest).encode('utf-8'))
+    return manifest
+
+### EOF
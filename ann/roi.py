@@ -0,0 +1,132 @@
+# roi.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Regions of interest: variants outside the regions (BED) a job comes with
+# are pruned before any reference lookup
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import os
+import hashlib
+
+import annotate
+import intervals as iv
+import vcf_record as vr
+
+"""Regions of interest of a job, and what happens to the variants outside
+them: with keep_pruned they are written out as they came in, without any
+annotation; otherwise they are left out of the results
+"""
+class RegionFilter(object):
+    def __init__(self, regions, keep_pruned=True):
+        self.regions = regions
+        self.keep_pruned = keep_pruned
+
+    @classmethod
+    def from_bed(cls, lines, keep_pruned=True):
+        return cls(iv.read_bed(lines), keep_pruned)
+
+    """Identifies the regions and the handling of pruned variants, for the
+    result cache key
+    """
+    def digest(self):
+        h = hashlib.sha1(b'keep' if self.keep_pruned else b'drop')
+        for contig in sorted(self.regions.regions):
+            h.update(f";{contig}:".encode('utf-8'))
+            h.update(','.join(f"{start}-{end}" for start, end in
+                self.regions.regions[contig]).encode('utf-8'))
+        return h.hexdigest()
+
+    """Whether a record is annotated: header lines always are, records if
+    the reference bases they span touch a region
+    """
+    def keeps(self, record, format='vcf'):
+        if type(record) is str:
+            return True
+        start, end = annotate.getSpan(record, format=format)
+        return self.regions.touches(record.contig, start, end)
+
+    """Whether a line of input is annotated (see keeps)
+    """
+    def keeps_line(self, line, format='vcf'):
+        return self.keeps(parse_line(line), format=format)
+
+    def log_line(self, pruned, total):
+        return f"Outside regions of interest: {str(pruned)} of " + \
+            f"{str(total)} variants\n"
+
+    """The records to annotate; the place of every record is noted in
+    order: None for one passed on, the record itself for one pruned and
+    kept. The pruned count goes to fh_log once records runs out.
+    """
+    def prune(self, records, order, fh_log, format='vcf'):
+        pruned = 0
+        total = 0
+        for record in records:
+            if type(record) is not str:
+                total = total + 1
+            if self.keeps(record, format=format):
+                order.append(None)
+                yield record
+                continue
+            pruned = pruned + 1
+            if self.keep_pruned:
+                order.append(record)
+        fh_log.write(self.log_line(pruned, total))
+
+    """Puts the pruned records that are kept back in their places among the
+    annotated ones (see prune)
+    """
+    def restore(self, annotated, order):
+        for record in annotated:
+            while order[0] is not None:
+                yield order.popleft()
+            order.popleft()
+            yield record
+        while order:
+            yield order.popleft()
+
+    """Moves infile aside to <infile>.full and writes the lines to annotate
+    in its place. Returns the count log line.
+    """
+    def split_file(self, infile, format='vcf'):
+        os.replace(infile, infile + '.full')
+        pruned = 0
+        total = 0
+        with open(infile + '.full') as fh_in, open(infile, 'w') as fh_out:
+            for line in fh_in:
+                record = parse_line(line)
+                if type(record) is not str:
+                    total = total + 1
+                    if not self.keeps(record, format=format):
+                        pruned = pruned + 1
+                        continue
+                fh_out.write(line)
+        return self.log_line(pruned, total)
+
+    """Merges the lines annotated from a split infile (see split_file) with
+    the pruned ones that are kept, and puts infile back
+    """
+    def merge_file(self, infile, annotated_path, format='vcf'):
+        with open(infile + '.full') as fh_in, \
+            open(annotated_path) as fh_annotated, \
+            open(annotated_path + '.tmp', 'w') as fh_out:
+            for line in fh_in:
+                record = parse_line(line)
+                if self.keeps(record, format=format):
+                    fh_out.write(fh_annotated.readline())
+                elif self.keep_pruned:
+                    fh_out.write(vr.format_record(record) + '\n')
+        os.replace(annotated_path + '.tmp', annotated_path)
+        os.replace(infile + '.full', infile)
+
+
+"""A line of input as the stages get it (see vcf_record.read_records)
+"""
+def parse_line(line):
+    return next(vr.read_records([line]))
+
+### EOF
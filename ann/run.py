@@ -8,99 +8,31 @@
 ##
 __author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
 
+import os
 import sys
-import time
 import driver
-import boto3
-import json
+import vcf_index
+import checkpoint
+import result_cache
+import reference
 from botocore.exceptions import ClientError
 import logging
-import os
-
-# Get configuration
-from configparser import SafeConfigParser
-config = SafeConfigParser(os.environ)
-config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
-
-
-# Connect to s3 Client
-try:
-    s3 = boto3.client('s3', region_name='us-east-1')
-except Exception as e:
-    print("Error has occured accessing the s3 client:", str(e))
-    sys.exit(1)
-
-# Connect to the dynamoDB client
-try:
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table('yoshidah_annotations')
-except Exception as e:
-    print("Error has occured accessing the dynamoDB client:", str(e))
-    sys.exit(1)
-    
-# Connect to the sns client
-try:
-    sns = boto3.client('sns')
-    # https://stackoverflow.com/questions/36721014/aws-sns-how-to-get-topic-arn-by-topic-name
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/create_topic.html
-    # This should just get the topic_arn since we already create the sns topic
-    results_topic_arn_info = sns.create_topic(
-        Name=config['gas']['SNSResultsTopicName']
-    )
-    results_topic_arn = results_topic_arn_info['TopicArn']
-except Exception as e:
-    print("Error has occured accessing the sns topic:", str(e))
-    sys.exit(1)
-    
-try: 
-    glacier_archive_topic_arn_info = sns.create_topic(
-        Name=config['gas']['SNSGlacierArchiveTopicName']
-    )
-    glacier_archive_topic_arn = glacier_archive_topic_arn_info['TopicArn']
-except Exception as e:
-    print("Error has occured accessing the sns topic:", str(e))
-    sys.exit(1)
-    
-results_bucket = config['gas']['ResultsBucket']
-
-"""A rudimentary timer for coarse-grained profiling
-"""
-class Timer(object):
-  def __init__(self, verbose=True):
-    self.verbose = verbose
-
-  def __enter__(self):
-    self.start = time.time()
-    return self
-
-  def __exit__(self, *args):
-    self.end = time.time()
-    self.secs = self.end - self.start
-    if self.verbose:
-      print(f"Approximate runtime: {self.secs:.2f} seconds")
-
-# Delete all files within a directory
-def delete_all_files_in_directory(directory_path):
-    try:
-        files = os.listdir(directory_path)
-        for file in files:
-            file_path = os.path.join(directory_path, file)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-    except OSError:
-        print("Error occured while deleting files")
+from jobs import (config, aws, results_bucket, Timer, JobHeartbeat,
+    StageCheckpointer, delete_all_files_in_directory, job_object_prefix,
+    result_file_names, result_object_names, reuse_cached_results,
+    store_cached_results, job_stages, job_regions, job_sorter, complete_job,
+    delete_request_message, notify_job_complete, INPUT_ERRORS, reject_input)
 
 if __name__ == '__main__':
     # Call the AnnTools pipeline
     if len(sys.argv) > 1:
-        if len(sys.argv) > 6:
-            with Timer():
-                driver.run(sys.argv[1], 'vcf')
-                
-            # Add code to save results and log files to S3 results bucket
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-            
+        if len(sys.argv) > 12:
             # Read input arguments
+            input_file_path = sys.argv[1]
+            # VCF, or a pileup converted as it is read; stage files and
+            # checkpoints are named as for VCF
+            input_format = driver.input_format(input_file_path)
+            stage_input = driver.stage_input(input_file_path, input_format)
             file_name_without_extension = sys.argv[2]
             job_id_directory = sys.argv[3]
             user_id = sys.argv[4]
@@ -108,96 +40,158 @@ if __name__ == '__main__':
             name = sys.argv[6]
             email = sys.argv[7]
             role = sys.argv[8]
-            
-            
+            request_queue_url = sys.argv[9]
+            receipt_handle = sys.argv[10]
+            lease_token = sys.argv[11]
+            input_hash = sys.argv[12]
+            # Annotation profile the job asked for, if any
+            profile = sys.argv[13] if len(sys.argv) > 13 else None
+            stages = job_stages(profile)
+            # BED file of the regions of interest, '' if the job has none
+            regions = None
+            if len(sys.argv) > 14 and sys.argv[14]:
+                try:
+                    with open(sys.argv[14]) as fh:
+                        regions = job_regions(fh)
+                except INPUT_ERRORS as e:
+                    delete_all_files_in_directory(job_id_directory)
+                    reject_input(job_id, lease_token, request_queue_url,
+                        receipt_handle, e)
+                    sys.exit(0)
+            # Order the results are asked for in, '' for the default
+            sorter = job_sorter(sys.argv[15] if len(sys.argv) > 15 else None)
+            job_prefix = job_object_prefix(user_id, job_id)
+
+            heartbeat = JobHeartbeat(job_id, lease_token, request_queue_url,
+                receipt_handle, int(config['code']['MessageVisibilityTimeout']),
+                int(config['code']['JobLeaseSeconds']))
+            heartbeat.start()
+
             # Prepare result file processing
-            annotated_file = f'{file_name_without_extension}.annot.vcf'
-            log_file = f'{file_name_without_extension}.vcf.count.log'
+            annotated_file, log_file, index_file = result_file_names(
+                file_name_without_extension)
             annotated_file_path = job_id_directory + annotated_file
             log_file_path = job_id_directory + log_file
-            annotated_file_object_name = f"{config['gas']['OwnerName']}/{user_id}/{job_id}/{annotated_file}"
-            log_file_object_name = f"{config['gas']['OwnerName']}/{user_id}/{job_id}/{log_file}"
-            
-            # 1. Upload the results file
-            try:
-                response = s3.upload_file(annotated_file_path, results_bucket, annotated_file_object_name)
-            except ClientError as e:
-                print("Failed to upload annotated result file")
-                logging.error(e)
-                
-            # 2. Upload the log file
+            index_file_path = job_id_directory + index_file
+            job_objects = result_object_names(job_prefix,
+                file_name_without_extension)
+
+            item = {}
             try:
-                response = s3.upload_file(log_file_path, results_bucket, log_file_object_name)
+                item = aws.table.get_item(Key={'job_id': job_id}).get('Item', {})
             except ClientError as e:
-                print("Failed to upload annotated result file")
+                print(f"Failed to read item from table with job id: {job_id}")
                 logging.error(e)
-                
-            # 3. Clean up (delete) local job files
+            pipeline = driver.pipeline_version(stages, regions, sorter,
+                driver.filter_contigs(config))
+            checkpointer = StageCheckpointer(job_id, stage_input,
+                job_prefix, int(config['code']['CheckpointInterval']),
+                heartbeat, stages,
+                last_stage=int(item.get('checkpoint_stage', 0)),
+                reference_version=reference.job_version(config),
+                pipeline=pipeline)
+
+            # Reuse the results of an earlier job on identical input, annotated
+            # against the same reference snapshot by the same pipeline and
+            # stages, filtered and pruned the same way and in the same order
+            cache_key = result_cache.cache_key(input_hash,
+                reference.job_version(config), pipeline)
+            cached = reuse_cached_results(cache_key, job_objects)
+
+            if cached is None:
+                # Resume from the last checkpoint if an earlier attempt died
+                # on the same reference version and pipeline
+                start_stage = checkpoint.load_checkpoint(aws.s3, results_bucket,
+                    item, stage_input,
+                    stage_names=[name for name, stage, kwargs in stages],
+                    reference_version=reference.job_version(config),
+                    pipeline=pipeline)
+                if start_stage > 0:
+                    print(f"Resuming job {job_id} after stage {start_stage}")
+
+                try:
+                    with Timer():
+                        driver.run(input_file_path, input_format,
+                            start_stage=start_stage,
+                            on_stage_complete=checkpointer,
+                            reference_version=reference.job_version(config),
+                            stages=stages, regions=regions, sorter=sorter,
+                            allowed_contigs=driver.filter_contigs(config))
+                except INPUT_ERRORS as e:
+                    # No retry would get further; the job ends here
+                    heartbeat.stop()
+                    delete_all_files_in_directory(job_id_directory)
+                    reject_input(job_id, lease_token, request_queue_url,
+                        receipt_handle, e)
+                    sys.exit(0)
+
+                # Add code to save results and log files to S3 results bucket
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+
+                # Build the block coordinate index used for region queries;
+                # without it the job completes with no index recorded
+                try:
+                    vcf_index.index_vcf(annotated_file_path, index_file_path,
+                        block_size=int(config['code']['IndexBlockSize']))
+                except OSError as e:
+                    print("Failed to build the coordinate index for the annotated file")
+                    logging.error(e)
+                    del job_objects['index']
+
+                # 1. Upload the results file
+                try:
+                    response = aws.s3.upload_file(annotated_file_path, results_bucket, job_objects['result'])
+                except ClientError as e:
+                    print("Failed to upload annotated result file")
+                    logging.error(e)
+
+                # 2. Upload the log file
+                try:
+                    response = aws.s3.upload_file(log_file_path, results_bucket, job_objects['log'])
+                except ClientError as e:
+                    print("Failed to upload annotated result file")
+                    logging.error(e)
+
+                # 3. Upload the coordinate index next to the results file
+                if 'index' in job_objects:
+                    try:
+                        response = aws.s3.upload_file(index_file_path, results_bucket, job_objects['index'])
+                    except (ClientError, OSError) as e:
+                        print("Failed to upload coordinate index file")
+                        logging.error(e)
+                        del job_objects['index']
+
+                # 4. Add the results to the cache for identical inputs
+                store_cached_results(cache_key, job_objects)
+
+            # 5. Clean up (delete) local job files
             # https://www.tutorialspoint.com/How-to-delete-all-files-in-a-directory-with-Python
             delete_all_files_in_directory(job_id_directory)
-                
-            timestamp = int(time.time())
-            
+
             try:
-                print("Update table item")
-                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/update_item.html
-                table.update_item(
-                    Key={'job_id': job_id},
-                    UpdateExpression='SET job_status = :complete, s3_results_bucket = :s3_results_bucket, s3_key_result_file = :s3_key_result_file, s3_key_log_file = :s3_key_log_file, complete_time = :complete_time',
-                    ConditionExpression= 'job_status = :running',
-                    ExpressionAttributeValues={":running": "RUNNING",
-                                               ":complete": "COMPLETED", 
-                                               ":s3_results_bucket":results_bucket, 
-                                               ":s3_key_result_file":annotated_file_object_name,
-                                               ":s3_key_log_file":log_file_object_name,
-                                               ":complete_time":timestamp
-                                               }
-                )
-            except e:
+                timestamp = complete_job(job_id, lease_token, job_objects,
+                    cache_key, cached is not None, stages)
+            except ClientError as e:
+                # Also fails when another worker took over the job's lease
                 print(f"Failed to update item from table with job id: {job_id}")
                 logging.error(e)
-            
-            # Publish a notification message to the SNS topics
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-            try:
-                print("Sending Message to Results Topic")
-                # Send to Results topic
-                data = {
-                    "job_id": job_id,
-                    "name": name,
-                    "email": email,
-                    "role": role,
-                    "status": "completed",
-                    "message": f"Job {job_id} has been completed successfully. Annotated results and log files are available in S3."
-                }
-                sns.publish(
-                    TopicArn=results_topic_arn,
-                    Message=json.dumps(data)
-                )
-            except Exception as e:
-                print(f"Error publishing notification message to Results SNS topic: {str(e)}")
-                logging.error(e)
-                
-            if role == 'free_user':
-                try:
-                    print("Sending Message to Glacier Topic")
-                    # Send to Glacier Archive topic
-                    data = {
-                        "job_id": job_id,
-                        "complete_time": timestamp,
-                    }
-                    sns.publish(
-                        TopicArn=glacier_archive_topic_arn,
-                        Message=json.dumps(data)
-                    )
-                except Exception as e:
-                    print(f"Error publishing notification message to Glacier Archive SNS topic: {str(e)}")
-                    logging.error(e)
-                    
+                sys.exit(1)
+
+            # The checkpoint is no longer needed once the job is complete
+            if checkpointer.last_stage > 0:
+                checkpoint.delete_checkpoint(aws.s3, results_bucket, job_prefix,
+                    os.path.basename(stage_input), checkpointer.last_stage)
+
+            # Only now is the job request done with
+            heartbeat.stop()
+            delete_request_message(request_queue_url, receipt_handle)
+
+            notify_job_complete(job_id, name, email, role, timestamp)
+
         else:
-            print("Input: filepath, file_name_without_extension, job_id_directory, user_id, user_profile is required.")
+            print("Input: filepath, file_name_without_extension, job_id_directory, user_id, job_id, user_profile, request_queue_url, receipt_handle, lease_token, input_hash is required (then optionally annotation_profile).")
         
     else:
-        print("A valid .vcf file must be provided as input to this program.")
+        print("A valid .vcf or .pileup file must be provided as input to this program.")
 
 ### EOF
@@ -0,0 +1,217 @@
+# sources.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Registry of the reference tables that annotate by overlap: each source
+# declares its table, how a variant matches a row and what it adds to INFO;
+# annotate.addOverlapWithSourceLines does the lookups for all of them
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import copy
+
+import utils as u
+import contigs
+
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+"""A reference table annotated from, and how
+table is looked up by chrom_column, named in 'ucsc' (chr1) or 'ensembl'
+(1) style; a per_contig table is split into one table per nuclear contig
+(table + ensembl name) instead. A variant matches a row by
+  'interval'  start_column <= POS <= end_column
+  'position'  start_column = POS
+  'span'      the row overlaps the reference bases of the variant (see
+              annotate.getSpan)
+Only start_column, end_column and columns are selected, and rows reach
+annotation as (start, end, *columns). annotation(source, rows, start, end)
+gives the INFO text of a variant with matches. With first_row, a variant
+counts once however many rows match and a single-base lookup fetches one
+row. label names the source in the count log (by default its table).
+"""
+class AnnotationSource(object):
+    def __init__(self, table, annotation, columns=(), match='interval',
+        chrom_column='chrom', chrom_style='ucsc', start_column='chromStart',
+        end_column='chromEnd', per_contig=False, first_row=False, label=None,
+        always_separate=False, record_sep=None):
+        self.table = table
+        self.annotation = annotation
+        self.columns = tuple(columns)
+        self.match = match
+        self.chrom_column = chrom_column
+        self.chrom_style = chrom_style
+        self.start_column = start_column
+        self.end_column = end_column
+        self.per_contig = per_contig
+        self.first_row = first_row
+        self.label = label
+        # Output quirks of the stages this replaced: INFO text always
+        # preceded by ';', and a field separator set on matched records
+        self.always_separate = always_separate
+        self.record_sep = record_sep
+
+    @property
+    def name(self):
+        return self.label if self.label is not None else self.table
+
+    """The same source read from another table with the same layout
+    """
+    def with_table(self, table):
+        if table is None or table == self.table:
+            return self
+        source = copy.copy(self)
+        source.table = table
+        return source
+
+    def table_name(self, contig):
+        if not self.per_contig:
+            return self.table
+        if contig > contigs.NUCLEAR_CONTIGS:
+            return None
+        return self.table + contigs.ensembl_name(contig)
+
+    def contig_name(self, contig):
+        if self.chrom_style == 'ensembl':
+            return contigs.ensembl_name(contig)
+        return contigs.ucsc_name(contig)
+
+    """SQL selecting the rows of a contig that meet condition (all of them
+    without one), or None if the source has no table for the contig
+    """
+    def select(self, contig, condition=None):
+        table = self.table_name(contig)
+        if table is None:
+            return None
+        conditions = []
+        if not self.per_contig:
+            conditions.append(self.chrom_column + '="' +
+                self.contig_name(contig) + '"')
+        if condition is not None:
+            conditions.append(condition)
+        sql = 'select ' + ', '.join((self.start_column, self.end_column) +
+            self.columns) + ' from ' + table
+        if conditions:
+            sql = sql + ' where ' + ' AND '.join(conditions)
+        return sql
+
+    """SQL of the rows matching a variant at start..end of a contig
+    """
+    def lookup(self, contig, start, end):
+        if self.match == 'position':
+            condition = self.start_column + ' = ' + str(start)
+        else:
+            condition = '(' + self.start_column + ' <= ' + str(end) + \
+                ' AND ' + str(start) + ' <= ' + self.end_column + ')'
+        sql = self.select(contig, condition)
+        if sql is None:
+            return None
+        if self.first_row and start == end:
+            sql = sql + ' limit 1'
+        return sql + ';'
+
+
+"""Registered sources by name
+"""
+SOURCES = {}
+
+def register(name, source):
+    SOURCES[name] = source
+    return source
+
+
+"""A registered source, optionally read from another table
+"""
+def source(name, table=None):
+    return SOURCES[name].with_table(table)
+
+
+"""<table>=<column> of every row, without repeats, as one entry
+"""
+def table_values(source, rows, start, end):
+    return source.table + '=' + ';'.join(u.dedup([str(row[2])
+        for row in rows]))
+
+
+"""<table>=<column> per distinct value
+"""
+def table_entries(source, rows, start, end):
+    return ';'.join(source.table + '=' + value
+        for value in u.dedup([str(row[2]) for row in rows]))
+
+
+"""<table>=True
+"""
+def overlap_flag(source, rows, start, end):
+    return source.table + '=True'
+
+
+def gwas_entries(source, rows, start, end):
+    return ';'.join(source.table + '=pubMedID=' + str(row[2]) +
+        ',trait=' + str(row[3]) for row in rows)
+
+
+def hgnc_entries(source, rows, start, end):
+    return ','.join('HGNC_GeneAnnotation=' + value for value in
+        u.dedup([(str(row[2]) + ',' + str(row[3])).strip()
+        for row in rows])).replace(';', ',')
+
+
+def gene_entries(source, rows, start, end):
+    return ';'.join('name2=' + str(row[3]) + ';name=' + str(row[2])
+        for row in rows)
+
+
+def mirna_site(source, rows, start, end):
+    row = rows[0]
+    return 'miRNAsites=' + (str(row[2]) + ',' + str(row[3]) + '_' +
+        str(row[0]) + '_' + str(row[1])).strip()
+
+
+def tfbs_entries(source, rows, start, end):
+    return ';'.join('tfbsRegion=' + (str(row[2]) + '.' + str(row[3]) + '.' +
+        str(row[0]) + '.' + str(row[1])).strip() for row in rows)
+
+
+"""The first segdup and its paralog; variants spanning more than one base
+also get how many of their bases the segdups cover and what percentage
+"""
+def segdup_entries(source, rows, start, end):
+    row = rows[0]
+    text = source.table + '=True;otherChrom=' + str(row[2]) + \
+        ';otherStart=' + str(row[3]) + ';otherEnd=' + str(row[4])
+    if start != end:
+        regions = [(int(row[0]), int(row[1])) for row in rows]
+        text = text + ';' + source.table + 'Overlap=' + \
+            str(u.coveredLength(start, end, regions)) + ';' + source.table + \
+            'PctOverlap=' + str(u.proportionCovered(start, end, regions))
+    return text
+
+
+register('cytoBand', AnnotationSource('cytoBand', table_values,
+    columns=('name',)))
+# For some reason this table has no "chr" preceeding number
+register('gadAll', AnnotationSource('gadAll', table_entries,
+    columns=('geneSymbol',), chrom_column='chromosome',
+    chrom_style='ensembl', record_sep='\t '))
+register('gwasCatalog', AnnotationSource('gwasCatalog', gwas_entries,
+    columns=('pubMedID', 'trait'), match='position',
+    start_column='chromEnd'))
+register('targetScanS', AnnotationSource('targetScanS', mirna_site,
+    columns=('name', 'chrom'), first_row=True, label='miRNAsites'))
+register('hugo', AnnotationSource('hugo', hgnc_entries,
+    columns=('symbol', 'name')))
+register('refGene', AnnotationSource('refGene', gene_entries,
+    columns=('name', 'name2'), start_column='txStart', end_column='txEnd'))
+register('genomicSuperDups', AnnotationSource('genomicSuperDups',
+    segdup_entries, columns=('otherChrom', 'otherStart', 'otherEnd'),
+    match='span', first_row=True, always_separate=True))
+register('tfbsConsSites', AnnotationSource('tfbsConsSites', tfbs_entries,
+    columns=('name', 'chrom'), per_contig=True))
+for cnv_table in CNV_TABLES:
+    register(cnv_table, AnnotationSource(cnv_table, overlap_flag,
+        first_row=True))
+
+### EOF
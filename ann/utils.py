@@ -13,13 +13,21 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import sqlite3
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
 """Get connection to reference database
+Setting ANN_REFERENCE_DB to the path of a SQLite file (see
+reference_fixture.py) uses that local stand-in instead of RDS.
+database defaults to ANN_REFERENCE_DATABASE, which annotator.py sets to
+the database of the reference version a job runs against (see reference.py)
 """
-def db_connect():
+def db_connect(database=None):
+    if 'ANN_REFERENCE_DB' in os.environ:
+        return sqlite3.connect(os.environ['ANN_REFERENCE_DB'])
+
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
@@ -37,7 +45,8 @@ def db_connect():
     mysql_port = rds_secret['port']
     username = rds_secret['username']
     password = rds_secret['password']
-    database_name = 'annotator'
+    database_name = database or \
+        os.environ.get('ANN_REFERENCE_DATABASE', 'annotator')
 
     # Return a connection to the database
     return pymysql.connect(
@@ -89,6 +98,28 @@ def proportionOverlap(testStart, testEnd, refStart, refEnd):
     return round(pctover, 2)
 
 
+"""Number of bases of a segment covered by any of the regions
+Regions may overlap each other; every base is counted once
+"""
+def coveredLength(testStart, testEnd, regions):
+    covered = 0
+    last = testStart - 1
+    for refStart, refEnd in sorted(regions):
+        covered = covered + getOverlap(testStart, testEnd,
+            max(refStart, last + 1), refEnd)
+        last = max(last, refEnd)
+    return covered
+
+
+"""Helper method to calculate proportion of a segment covered by several
+regions, as proportionOverlap does for one
+"""
+def proportionCovered(testStart, testEnd, regions):
+    length = (testEnd - testStart) + 1
+    pctover = (float(coveredLength(testStart, testEnd, regions))/length) * 100
+    return round(pctover, 2)
+
+
 """Helper method to determine if the location is within the region
 """
 def isBetween(testStart, refStart, refEnd):
@@ -0,0 +1,125 @@
+# vcf_index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Block coordinate index for annotated result files
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import gzip
+import json
+
+import contigs
+
+INDEX_VERSION = 2
+GENE_KEY = 'name2'
+
+"""Collects gene symbols (name2=...) from an INFO field
+"""
+def genes_in_info(info):
+    genes = set()
+    for entry in info.split(';'):
+        key, sep, value = entry.strip().partition('=')
+        if sep and key == GENE_KEY and value:
+            genes.add(value)
+    return genes
+
+
+"""Builds a block index over a VCF file
+Records are grouped into blocks of roughly block_size bytes that never span
+two contigs. Each block keeps its contig id, the smallest and largest packed
+position key (see contigs.pack) it contains and its byte range, so a region
+query only has to read the blocks that can overlap it. contigs maps the ids
+used to the contig names in the file. Genes map to the blocks that mention
+them.
+lines is any iterable of raw (bytes) lines, e.g. a file opened 'rb'.
+"""
+def index_lines(lines, block_size=65536):
+    blocks = []
+    genes = {}
+    names = {}
+    header_length = 0
+    block = None
+    offset = 0
+
+    for raw in lines:
+        length = len(raw)
+        if raw.startswith(b'#'):
+            if block is None and not blocks:
+                header_length = offset + length
+            offset = offset + length
+            continue
+
+        fields = raw.decode('utf-8').split('\t', 8)
+        chrom = fields[0].strip()
+        try:
+            pos = int(fields[1])
+        except (IndexError, ValueError):
+            offset = offset + length
+            continue
+        contig = contigs.contig_id(chrom)
+        names.setdefault(contig, chrom)
+        key = contigs.pack(contig, pos)
+
+        if (block is None or block[0] != contig or block[4] >= block_size):
+            if block is not None:
+                blocks.append(block)
+            block = [contig, key, key, offset, 0]
+        block[1] = min(block[1], key)
+        block[2] = max(block[2], key)
+        block[4] = block[4] + length
+
+        if len(fields) > 7:
+            for gene in genes_in_info(fields[7]):
+                ids = genes.setdefault(gene, [])
+                if not ids or ids[-1] != len(blocks):
+                    ids.append(len(blocks))
+        offset = offset + length
+
+    if block is not None:
+        blocks.append(block)
+
+    return {
+        'version': INDEX_VERSION,
+        'block_size': block_size,
+        'header_length': header_length,
+        'file_size': offset,
+        'contigs': {str(contig): name for contig, name in names.items()},
+        'blocks': blocks,
+        'genes': genes
+    }
+
+
+"""Builds a block index over a VCF file
+"""
+def build_index(vcf, block_size=65536):
+    fh = open(vcf, 'rb')
+    index = index_lines(fh, block_size=block_size)
+    fh.close()
+    return index
+
+
+"""Serializes the index as gzipped JSON
+"""
+def encode_index(index):
+    return gzip.compress(json.dumps(index, separators=(',', ':')).encode('utf-8'))
+
+
+"""Writes the index as gzipped JSON
+"""
+def write_index(index, index_file):
+    with open(index_file, 'wb') as fh:
+        fh.write(encode_index(index))
+
+
+"""Builds and writes the index for an annotated file in one go
+"""
+def index_vcf(vcf, index_file=None, block_size=65536):
+    if index_file is None:
+        index_file = vcf + '.idx'
+    write_index(build_index(vcf, block_size=block_size), index_file)
+    return index_file
+
+### EOF
@@ -0,0 +1,150 @@
+# vcf_record.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Compact VCF record, parsed once per line and written once
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import sys
+import collections
+
+import contigs
+
+"""INFO column as the stages build it up
+Appended text is kept in parts and joined only when the column is read or
+written, rather than copying the whole column on every append.
+"""
+class InfoBuilder(object):
+    __slots__ = ('parts',)
+
+    def __init__(self, text):
+        self.parts = [text]
+
+    def append(self, text):
+        self.parts.append(text)
+
+    def set(self, text):
+        self.parts = [text]
+
+    def startswith(self, prefix):
+        first = self.parts[0]
+        if len(self.parts) == 1 or len(first) >= len(prefix):
+            return first.startswith(prefix)
+        return str(self).startswith(prefix)
+
+    def endswith(self, suffix):
+        last = self.parts[-1]
+        if len(self.parts) == 1 or len(last) >= len(suffix):
+            return last.endswith(suffix)
+        return str(self).endswith(suffix)
+
+    def __str__(self):
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+
+"""One VCF data line
+The eight fixed columns are held separately: CHROM interned and as a
+contig id (see contigs), POS as an int. FORMAT and the sample columns stay
+as the one untouched string tail, which is never split. sep is what the
+columns are joined with on output.
+"""
+class VcfRecord(object):
+    __slots__ = ('chrom', 'contig', 'pos', 'pos_text', 'id', 'ref', 'alt',
+        'qual', 'filter', 'info', 'tail', 'sep')
+
+    def __init__(self, chrom, pos, id, ref, alt, qual, filter, info,
+        tail=None, pos_text=None, sep='\t'):
+        self.chrom = chrom
+        self.contig = contigs.contig_id(chrom)
+        self.pos = pos
+        # Original POS text, kept only when str(pos) would not give it back
+        self.pos_text = pos_text
+        self.id = id
+        self.ref = ref
+        self.alt = alt
+        self.qual = qual
+        self.filter = filter
+        self.info = info
+        self.tail = tail
+        self.sep = sep
+
+    def key(self):
+        return contigs.pack(self.contig, self.pos)
+
+
+"""Records handed to a stage one at a time
+A stage that gives back one record for every record it takes can be
+driven by appending a record and then taking the next one from the stage.
+Once the feed is empty the stage sees the end of its input.
+"""
+class RecordFeed(object):
+    __slots__ = ('pending',)
+
+    def __init__(self):
+        self.pending = collections.deque()
+
+    def append(self, record):
+        self.pending.append(record)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            raise StopIteration
+        return self.pending.popleft()
+
+
+"""Parses a stripped data line into a VcfRecord
+Lines that are not records (fewer than eight columns, or a POS that is
+not a number) are returned unchanged.
+"""
+def parse_record(line, sep='\t'):
+    fields = line.split(sep, 8)
+    if len(fields) < 8:
+        return line
+    try:
+        pos = int(fields[1])
+    except ValueError:
+        return line
+    pos_text = None if str(pos) == fields[1] else fields[1]
+    return VcfRecord(sys.intern(fields[0]), pos, fields[2], fields[3],
+        fields[4], fields[5], fields[6], InfoBuilder(fields[7]),
+        fields[8] if len(fields) > 8 else None, pos_text)
+
+
+"""Reads lines into records
+Header lines (and anything else that is not a record) come through as
+stripped strings.
+"""
+def read_records(lines, sep='\t'):
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#') or line.startswith('CHROM'):
+            yield line
+        else:
+            yield parse_record(line, sep)
+
+
+"""Writes a record (or a header line) back out as a line, without '\n'
+"""
+def format_record(record):
+    if type(record) is str:
+        return record
+    sep = record.sep
+    line = sep.join((record.chrom,
+        str(record.pos) if record.pos_text is None else record.pos_text,
+        record.id, record.ref, record.alt, record.qual, record.filter,
+        str(record.info)))
+    if record.tail is None:
+        return line
+    if sep != '\t':
+        return line + sep + record.tail.replace('\t', sep)
+    return line + sep + record.tail
+
+### EOF
@@ -0,0 +1,241 @@
+# vcf_sort.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# External-memory sort of VCF inputs into coordinate order, and back into
+# input order once annotated
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import os
+import array
+import heapq
+import tempfile
+
+import contigs
+
+# Bytes a buffered line takes beyond its text (the line, its key and the
+# tuple holding them)
+LINE_OVERHEAD = 250
+# Most runs merged at once; more are merged in several passes
+MERGE_WIDTH = 64
+# Ordinals read from an order file at a time
+ORDER_BLOCK = 65536
+
+# Contigs outside the canonical set sort after it, by name
+OTHER_CONTIGS = len(contigs.CANONICAL) + 1
+HEADER_KEY = (-2, '', 0)
+OTHER_KEY = (-1, '', 0)
+
+
+"""Sort key of a line (stripped, as vcf_record.read_records sees it)
+Header lines come first, then lines that are not records, then records by
+packed key (see contigs.pack); records on contigs outside the canonical
+set follow, by contig name and position.
+"""
+def line_key(line):
+    if line.startswith('#') or line.startswith('CHROM'):
+        return HEADER_KEY
+    fields = line.split('\t', 8)
+    if len(fields) < 8:
+        return OTHER_KEY
+    try:
+        pos = int(fields[1])
+    except ValueError:
+        return OTHER_KEY
+    return record_key(fields[0], pos)
+
+
+def record_key(chrom, pos):
+    bare = chrom[3:] if chrom.startswith('chr') else chrom
+    contig = contigs.CONTIG_IDS.get(chrom)
+    if contig is None:
+        contig = contigs.CONTIG_IDS.get(bare)
+    # Ids of other contigs follow the order they were first seen in
+    if contig is None or contig >= OTHER_CONTIGS:
+        return (contigs.pack(OTHER_CONTIGS, 0), bare, pos)
+    return (contigs.pack(contig, pos), '', 0)
+
+
+"""Sort key of a line or record as the stages get it
+"""
+def item_key(record):
+    if type(record) is str:
+        return line_key(record)
+    return record_key(record.chrom, record.pos)
+
+
+"""Sorts (key, ordinal, line) items by key and then ordinal, holding at
+most about memory_bytes of lines at a time; the rest waits in sorted runs
+in directory. Lines must end with '\n'. Yields the items in order.
+"""
+def external_sort(items, memory_bytes, directory=None):
+    runs = []
+    try:
+        buffered = []
+        size = 0
+        for item in items:
+            buffered.append(item)
+            size = size + len(item[2]) + LINE_OVERHEAD
+            if size >= memory_bytes:
+                runs.append(write_run(sorted(buffered), directory))
+                buffered = []
+                size = 0
+        buffered.sort()
+        if not runs:
+            yield from buffered
+            return
+        if buffered:
+            runs.append(write_run(buffered, directory))
+        buffered = None
+
+        while len(runs) > MERGE_WIDTH:
+            merged = []
+            for i in range(0, len(runs), MERGE_WIDTH):
+                group = runs[i:i + MERGE_WIDTH]
+                merged.append(write_run(merge_runs(group), directory))
+                for path in group:
+                    os.remove(path)
+            runs = merged
+        yield from merge_runs(runs)
+    finally:
+        for path in runs:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def write_run(items, directory=None):
+    fd, path = tempfile.mkstemp(prefix='ann-sort-', suffix='.run',
+        dir=directory)
+    with os.fdopen(fd, 'w') as fh:
+        for (packed, name, pos), ordinal, line in items:
+            fh.write(f"{packed}\t{name}\t{pos}\t{ordinal}\t{line}")
+    return path
+
+
+def read_run(path):
+    with open(path) as fh:
+        for line in fh:
+            packed, name, pos, ordinal, line = line.split('\t', 4)
+            yield (int(packed), name, int(pos)), int(ordinal), line
+
+
+"""Items of sorted runs in order; equal items keep the order of the runs
+"""
+def merge_runs(paths):
+    return heapq.merge(*[read_run(path) for path in paths])
+
+
+"""Ordinals stored in an order file, in order
+"""
+def read_order(path):
+    with open(path, 'rb') as fh:
+        while True:
+            block = array.array('q')
+            try:
+                block.fromfile(fh, ORDER_BLOCK)
+            except EOFError:
+                pass
+            if not block:
+                return
+            yield from block
+
+
+"""Whether the lines of a file are in sort order already
+"""
+def is_sorted(path):
+    last = HEADER_KEY
+    with open(path) as fh:
+        for line in fh:
+            key = line_key(line.strip())
+            if key < last:
+                return False
+            last = key
+    return True
+
+
+"""Sorts inputs into coordinate order before the stages, at most
+memory_bytes of lines held at a time and the rest in temporary runs in
+directory (by default the directory of the input). The input order is
+recorded so results can be put back into it: with restore_order they are.
+"""
+class VcfSorter(object):
+    def __init__(self, memory_bytes, directory=None, restore_order=False):
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self.restore_order = restore_order
+
+    """Moves infile aside to <infile>.unsorted and writes it in sort order
+    in its place, with the input line of every line written in
+    <infile>.order. Inputs in sort order already are left alone. Returns
+    whether infile was sorted.
+    """
+    def sort_file(self, infile):
+        if is_sorted(infile):
+            return False
+        os.replace(infile, infile + '.unsorted')
+        directory = self.directory or os.path.dirname(os.path.abspath(infile))
+        with open(infile + '.unsorted') as fh_in:
+            items = ((line_key(line.strip()), ordinal,
+                line if line.endswith('\n') else line + '\n')
+                for ordinal, line in enumerate(fh_in))
+            with open(infile, 'w') as fh_out, \
+                open(infile + '.order', 'wb') as fh_order:
+                order = array.array('q')
+                for key, ordinal, line in external_sort(items,
+                    self.memory_bytes, directory):
+                    fh_out.write(line)
+                    order.append(ordinal)
+                    if len(order) >= ORDER_BLOCK:
+                        order.tofile(fh_order)
+                        order = array.array('q')
+                order.tofile(fh_order)
+        return True
+
+    """Puts the lines annotated from a sorted infile (see sort_file) back
+    into input order if restore_order, and puts infile back. keeps, if
+    given, tells the lines of the sorted infile that made it into the
+    annotated file from those left out of it.
+    """
+    def restore_file(self, infile, annotated_path, keeps=None):
+        if not os.path.exists(infile + '.unsorted'):
+            return
+        if self.restore_order:
+            directory = self.directory or \
+                os.path.dirname(os.path.abspath(annotated_path))
+            with open(infile) as fh_sorted, open(annotated_path) as fh_in, \
+                open(annotated_path + '.tmp', 'w') as fh_out:
+                order = read_order(infile + '.order')
+                if keeps is not None:
+                    order = (ordinal for ordinal, line in zip(order, fh_sorted)
+                        if keeps(line))
+                items = (((ordinal, '', 0), ordinal, line)
+                    for ordinal, line in zip(order, fh_in))
+                for key, ordinal, line in external_sort(items,
+                    self.memory_bytes, directory):
+                    fh_out.write(line)
+            os.replace(annotated_path + '.tmp', annotated_path)
+        os.remove(infile + '.order')
+        os.replace(infile + '.unsorted', infile)
+
+    """Records in sort order, and the input place of each (in memory)
+    """
+    def sort(self, records):
+        keyed = sorted((item_key(record), ordinal, record)
+            for ordinal, record in enumerate(records))
+        return [record for key, ordinal, record in keyed], \
+            [ordinal for key, ordinal, record in keyed]
+
+    """Records annotated from sorted ones in input order if restore_order;
+    order holds the input place of each (see sort)
+    """
+    def restore(self, records, order):
+        if not self.restore_order:
+            return records
+        places = sorted(zip(order, range(len(order))))
+        annotated = list(records)
+        return (annotated[i] for ordinal, i in places)
+
+### EOF
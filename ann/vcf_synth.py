@@ -0,0 +1,339 @@
+# vcf_synth.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Synthetic VCF inputs calibrated on the bundled sample files
+#
+##
+__author__ = 'Haruki Yoshida <yoshida@uchicago.edu>'
+
+import io
+import os
+import glob
+import gzip
+import json
+import random
+import argparse
+import tempfile
+
+import contigs
+import reference_fixture
+
+PROFILE_VERSION = 1
+# Observed values kept per distribution (reservoir sampled)
+POOL_SIZE = 5000
+# Records per bucket when shuffling, which bounds the memory used
+SHUFFLE_BUCKET = 1000000
+BASES = 'ACGT'
+
+
+"""Adds value to a fixed-size uniform sample of everything seen so far
+"""
+def reservoir_add(pool, seen, value, rnd, size=POOL_SIZE):
+    if len(pool) < size:
+        pool.append(value)
+    else:
+        i = rnd.randrange(seen)
+        if i < size:
+            pool[i] = value
+
+
+"""Learns what the records of some VCF files look like: contig mix,
+spacing between neighbouring positions, multi-allelic and indel rates,
+ID/QUAL/FILTER values, INFO keys and width, and sample columns.
+Files are read once, line by line.
+"""
+def calibrate(paths, seed=0):
+    rnd = random.Random(seed)
+    contigs = {}
+    max_positions = {}
+    gaps = []
+    seen = {'gaps': 0, 'quals': 0, 'indels': 0, 'info_widths': 0}
+    quals = []
+    indels = []
+    info_widths = []
+    info_keys = {}
+    info_headers = {}
+    filters = {}
+    genotypes = {}
+    sample_columns = {}
+    records = multiallelic = with_id = 0
+
+    for path in paths:
+        previous = None
+        fh = open(path)
+        for line in fh:
+            if line.startswith('##INFO=<ID='):
+                key = line[len('##INFO=<ID='):].split(',', 1)[0]
+                info_headers.setdefault(key, line.rstrip('\n'))
+                continue
+            if line.startswith('#') or not line.strip():
+                continue
+
+            fields = line.rstrip('\n').split('\t')
+            chrom, pos, ref, alt = fields[0], int(fields[1]), fields[3], fields[4]
+            records = records + 1
+            contigs[chrom] = contigs.get(chrom, 0) + 1
+            max_positions[chrom] = max(max_positions.get(chrom, 0), pos)
+            if previous is not None and previous[0] == chrom and pos >= previous[1]:
+                seen['gaps'] = seen['gaps'] + 1
+                reservoir_add(gaps, seen['gaps'], pos - previous[1], rnd)
+            previous = (chrom, pos)
+
+            alts = alt.split(',')
+            if len(alts) > 1:
+                multiallelic = multiallelic + 1
+            if len(ref) != 1 or any(len(a) != 1 for a in alts):
+                seen['indels'] = seen['indels'] + 1
+                reservoir_add(indels, seen['indels'], (ref, alt), rnd)
+            if fields[2] != '.':
+                with_id = with_id + 1
+            seen['quals'] = seen['quals'] + 1
+            reservoir_add(quals, seen['quals'], fields[5], rnd)
+            filters[fields[6]] = filters.get(fields[6], 0) + 1
+
+            entries = [] if fields[7] == '.' else fields[7].split(';')
+            seen['info_widths'] = seen['info_widths'] + 1
+            reservoir_add(info_widths, seen['info_widths'], len(entries), rnd)
+            for order, entry in enumerate(entries):
+                key, sep, value = entry.partition('=')
+                if key not in info_keys:
+                    info_keys[key] = {'count': 0, 'order': order,
+                        'flag': not sep, 'values': []}
+                stats = info_keys[key]
+                stats['count'] = stats['count'] + 1
+                if sep:
+                    reservoir_add(stats['values'], stats['count'], value,
+                        rnd, size=50)
+
+            samples = max(0, len(fields) - 9)
+            sample_columns[samples] = sample_columns.get(samples, 0) + 1
+            for sample in fields[9:]:
+                gt = sample.split(':', 1)[0]
+                genotypes[gt] = genotypes.get(gt, 0) + 1
+        fh.close()
+
+    return {
+        'version': PROFILE_VERSION,
+        'records': records,
+        'contigs': contigs,
+        'max_positions': max_positions,
+        'gaps': sorted(gaps),
+        'multiallelic_rate': multiallelic / records if records else 0,
+        'indel_rate': seen['indels'] / records if records else 0,
+        'indels': indels,
+        'id_rate': with_id / records if records else 0,
+        'quals': quals,
+        'filters': filters,
+        'info_widths': info_widths,
+        'info_keys': info_keys,
+        'info_headers': info_headers,
+        'sample_columns': sample_columns,
+        'genotypes': genotypes
+    }
+
+
+"""Profile of the bundled sample files
+"""
+def default_profile():
+    return calibrate(sorted(glob.glob(
+        os.path.join(reference_fixture.DATA_DIRECTORY, '*.vcf'))))
+
+
+"""Splits n records over the contigs in proportion to the profile's mix
+"""
+def contig_counts(profile, n):
+    total = sum(profile['contigs'].values())
+    shares = [(chrom, n * count / total)
+        for chrom, count in profile['contigs'].items()]
+    counts = {chrom: int(share) for chrom, share in shares}
+    remainder = n - sum(counts.values())
+    shares.sort(key=lambda share: share[1] - int(share[1]), reverse=True)
+    for chrom, share in shares[:remainder]:
+        counts[chrom] = counts[chrom] + 1
+    return counts
+
+
+"""Contig order of the output: karyotype order, then anything else
+"""
+def contig_order(names):
+    def rank(chrom):
+        contig = contigs.contig_id(chrom)
+        if contig <= len(contigs.CANONICAL):
+            return (contig, '')
+        return (len(contigs.CANONICAL) + 1, chrom)
+    return sorted(names, key=rank)
+
+
+"""Generates the records of one contig in position order
+Gaps are drawn from the learnt spacing, scaled down when count records
+would not otherwise fit on the contig.
+"""
+def contig_records(profile, chrom, count, rnd, samples, info_keys):
+    gaps = profile['gaps'] or [1000]
+    length = reference_fixture.CONTIG_LENGTHS.get(
+        contigs.ensembl_name(contigs.contig_id(chrom)),
+        profile['max_positions'].get(chrom, 1000000))
+    mean_gap = sum(gaps) / len(gaps)
+    scale = min(1.0, 0.95 * length / (count * mean_gap)) if count else 1.0
+
+    genotypes = list(profile['genotypes']) or ['0/1']
+    genotype_weights = list(profile['genotypes'].values()) or [1]
+    filters = list(profile['filters'])
+    filter_weights = list(profile['filters'].values())
+    widths = profile['info_widths'] or [0]
+
+    pos = 0
+    for i in range(count):
+        pos = pos + max(1, int(rnd.choice(gaps) * scale))
+
+        if profile['indels'] and rnd.random() < profile['indel_rate']:
+            ref, alt = rnd.choice(profile['indels'])
+        else:
+            ref = rnd.choice(BASES)
+            alt = rnd.choice([b for b in BASES if b != ref])
+            if rnd.random() < profile['multiallelic_rate']:
+                alt = alt + ',' + rnd.choice([b for b in BASES
+                    if b != ref and b != alt])
+
+        vid = f"rs{rnd.randrange(1, 1000000000)}" \
+            if rnd.random() < profile['id_rate'] else '.'
+        qual = rnd.choice(profile['quals']) if profile['quals'] else '.'
+        filter_value = rnd.choices(filters, filter_weights)[0] \
+            if filters else '.'
+
+        # Pick width keys, favouring common ones, in their usual order
+        width = min(rnd.choice(widths), len(info_keys))
+        keys = sorted(info_keys, key=lambda key: rnd.random() **
+            (1.0 / info_keys[key]['count']), reverse=True)[:width]
+        keys.sort(key=lambda key: info_keys[key]['order'])
+        info = []
+        for key in keys:
+            stats = info_keys[key]
+            if stats['flag'] or not stats['values']:
+                info.append(key)
+            else:
+                info.append(key + '=' + rnd.choice(stats['values']))
+
+        fields = [chrom, str(pos), vid, ref, alt, qual, filter_value,
+            ';'.join(info) or '.']
+        if samples:
+            fields.append('GT:DP')
+            for gt in rnd.choices(genotypes, genotype_weights, k=samples):
+                fields.append(f"{gt}:{rnd.randint(0, 30)}")
+        yield '\t'.join(fields) + '\n'
+
+
+"""Header lines for a generated file
+"""
+def header_lines(profile, samples):
+    lines = ['##fileformat=VCFv4.1\n', '##source=vcf_synth\n']
+    for key in profile['info_keys']:
+        if key in profile['info_headers']:
+            lines.append(profile['info_headers'][key] + '\n')
+    columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+    if samples:
+        lines.append('##FORMAT=<ID=GT,Number=1,Type=String,'
+            'Description="Genotype">\n')
+        lines.append('##FORMAT=<ID=DP,Number=1,Type=Integer,'
+            'Description="Read Depth">\n')
+        columns = columns + ['FORMAT'] + [f"S{i + 1}" for i in range(samples)]
+    lines.append('\t'.join(columns) + '\n')
+    return lines
+
+
+"""Opens the output for writing text, gzipped when asked (or when the name
+ends in .gz). Gzip output carries no timestamp so that it is reproducible.
+"""
+def open_output(path, compress=None):
+    if compress is None:
+        compress = path.endswith('.gz')
+    if not compress:
+        return open(path, 'w')
+    raw = open(path, 'wb')
+    return io.TextIOWrapper(gzip.GzipFile(filename='', mode='wb', fileobj=raw,
+        mtime=0))
+
+
+"""Writes a VCF of n records drawn from profile
+The same profile, n and seed always give the same file. Records are sorted
+by contig and position unless shuffle is set, in which case the same
+records come out in a random order. Shuffling goes through
+temporary buckets of SHUFFLE_BUCKET records so memory stays bounded for
+any n. samples defaults to the most common sample column count.
+"""
+def generate(profile, n, path, seed=0, shuffle=False, compress=None,
+    samples=None):
+    rnd = random.Random(seed)
+    if samples is None:
+        counts = profile['sample_columns'] or {0: 1}
+        samples = int(max(counts, key=lambda k: counts[k]))
+    info_keys = {key: stats for key, stats in profile['info_keys'].items()}
+
+    counts = contig_counts(profile, n)
+    records = (record for chrom in contig_order(counts)
+        for record in contig_records(profile, chrom, counts[chrom], rnd,
+            samples, info_keys))
+
+    out = open_output(path, compress)
+    out.writelines(header_lines(profile, samples))
+    if not shuffle:
+        out.writelines(records)
+    else:
+        # Its own stream, so shuffling leaves the records themselves as they are
+        shuffle_rnd = random.Random(f"{seed}:shuffle")
+        directory = tempfile.mkdtemp(prefix='vcf-synth-')
+        buckets = [open(os.path.join(directory, str(i)), 'w+')
+            for i in range(max(1, -(-n // SHUFFLE_BUCKET)))]
+        for record in records:
+            buckets[shuffle_rnd.randrange(len(buckets))].write(record)
+        for bucket in buckets:
+            bucket.seek(0)
+            lines = bucket.readlines()
+            shuffle_rnd.shuffle(lines)
+            out.writelines(lines)
+            bucket.close()
+            os.remove(bucket.name)
+        os.rmdir(directory)
+    out.close()
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate VCF inputs that look like the sample files')
+    parser.add_argument('records', type=int, help='number of records')
+    parser.add_argument('output', help='VCF to write (.gz is gzipped)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shuffle', action='store_true',
+        help='write records in random order instead of sorted')
+    parser.add_argument('--gzip', action='store_true', default=None,
+        help='gzip the output whatever its name')
+    parser.add_argument('--samples', type=int,
+        help='sample columns (default: most common in the calibration files)')
+    parser.add_argument('--calibrate', nargs='+', metavar='VCF',
+        help='learn from these files instead of the bundled samples')
+    parser.add_argument('--profile', help='load a profile saved earlier')
+    parser.add_argument('--save-profile', help='save the learnt profile')
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        with open(args.profile) as fh:
+            profile = json.load(fh)
+    elif args.calibrate:
+        profile = calibrate(args.calibrate)
+    else:
+        profile = default_profile()
+    if args.save_profile:
+        with open(args.save_profile, 'w') as fh:
+            json.dump(profile, fh)
+
+    generate(profile, args.records, args.output, seed=args.seed,
+        shuffle=args.shuffle, compress=args.gzip, samples=args.samples)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -107,6 +107,26 @@ class Config(object):
   # Time before free user results are archived (in seconds)
   FREE_USER_DATA_RETENTION = 300
 
+  # Annotation profiles offered on the upload form, as (name, description);
+  # the stages of each are set in [profiles] of ann/ann_config.ini
+  ANNOTATION_PROFILES = [
+    ("default", "All annotations"),
+    ("basic", "dbSNP and gene context"),
+    ("clinical", "Gene context, cytoband, GWAS Catalog and HGNC"),
+  ]
+  DEFAULT_ANNOTATION_PROFILE = "default"
+
+  # Orders results can come in, as (name, description); inputs are sorted
+  # only if [sort] is enabled in ann/ann_config.ini
+  OUTPUT_ORDERS = [
+    ("sorted", "Sorted by position"),
+    ("input", "As in the input file"),
+  ]
+  DEFAULT_OUTPUT_ORDER = "sorted"
+
+  # Largest BED file of regions of interest a job may come with (in bytes)
+  MAX_REGIONS_FILE_BYTES = 10 * 1024 * 1024
+
 class DevelopmentConfig(Config):
   DEBUG = True
   GAS_LOG_LEVEL = 'DEBUG'
@@ -9,11 +9,14 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import re
+import gzip
 import json
+from functools import lru_cache
 
 from flask import request, render_template
 from threading import Lock
 
+import boto3
 import globus_sdk
 
 try:
@@ -87,4 +90,135 @@ def get_portal_tokens(scopes=None):
 get_portal_tokens.lock = Lock()
 get_portal_tokens.access_tokens = None
 
+"""Fetch the coordinate index written next to an annotated results file
+Result files never change once written, so recently used indexes are
+kept in memory
+"""
+@lru_cache(maxsize=32)
+def load_result_index(bucket, key):
+  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  response = s3.get_object(Bucket=bucket, Key=key)
+  return json.loads(gzip.decompress(response['Body'].read()))
+
+"""Normalize contig names so that 1, chr1 and CHR1 (and MT, M and chrM)
+compare equal
+"""
+def normalize_chrom(chrom):
+  chrom = str(chrom).strip()
+  if chrom.lower().startswith('chr'):
+    chrom = chrom[3:]
+  chrom = chrom.upper()
+  return 'MT' if chrom == 'M' else chrom
+
+# Index blocks from version 2 on hold packed (contig << 32 | pos) keys
+POS_BITS = 32
+POS_MASK = (1 << POS_BITS) - 1
+
+"""Parse a tabix-style region string (chr, chr:pos or chr:start-end)
+Returns (chrom, start, end) with open ends set to None, or None if invalid
+"""
+def parse_region(region):
+  match = re.match(r'^([^:\s]+)(?::([\d,]+)(?:-([\d,]+))?)?$', region.strip())
+  if not match:
+    return None
+  chrom, start, end = match.groups()
+  start = int(start.replace(',', '')) if start else None
+  end = int(end.replace(',', '')) if end else start
+  if start is not None and end < start:
+    return None
+  return (chrom, start, end)
+
+"""Select the index blocks that can hold records for a region or a gene
+"""
+def select_index_blocks(index, region=None, gene=None):
+  blocks = index['blocks']
+  if gene is not None:
+    return [blocks[i] for i in index['genes'].get(gene, [])]
+
+  chrom, start, end = region
+  chrom = normalize_chrom(chrom)
+  if index['version'] < 2:
+    selected = []
+    for block in blocks:
+      if normalize_chrom(block[0]) != chrom:
+        continue
+      if start is not None and (block[2] < start or block[1] > end):
+        continue
+      selected.append(block)
+    return selected
+
+  # Blocks carry a contig id and packed keys, so matching is integer work
+  contigs = set(int(contig) for contig, name in index['contigs'].items()
+    if normalize_chrom(name) == chrom)
+  selected = []
+  for block in blocks:
+    if block[0] not in contigs:
+      continue
+    if start is not None:
+      first = (block[0] << POS_BITS) | start
+      last = (block[0] << POS_BITS) | min(end, POS_MASK)
+      if block[2] < first or block[1] > last:
+        continue
+    selected.append(block)
+  return selected
+
+"""Collapse selected blocks into as few contiguous byte ranges as possible
+"""
+def block_byte_ranges(blocks):
+  ranges = []
+  for block in sorted(blocks, key=lambda b: b[3]):
+    first, last = block[3], block[3] + block[4] - 1
+    if ranges and ranges[-1][1] + 1 == first:
+      ranges[-1][1] = last
+    else:
+      ranges.append([first, last])
+  return ranges
+
+"""Check whether a VCF record belongs to the requested region or gene
+"""
+def record_matches(line, region=None, gene=None):
+  fields = line.split('\t', 8)
+  if len(fields) < 2:
+    return False
+  if gene is not None:
+    if len(fields) < 8:
+      return False
+    for entry in fields[7].split(';'):
+      if entry.strip() == 'name2=' + gene:
+        return True
+    return False
+
+  chrom, start, end = region
+  if normalize_chrom(fields[0]) != normalize_chrom(chrom):
+    return False
+  if start is None:
+    return True
+  try:
+    pos = int(fields[1])
+  except ValueError:
+    return False
+  return start <= pos <= end
+
+"""Read the header and the records for a region or gene from an annotated
+results file in S3, using byte-range GETs on the blocks from its index
+"""
+def query_result_region(bucket, key, index, region=None, gene=None):
+  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  lines = []
+
+  if index['header_length'] > 0:
+    response = s3.get_object(Bucket=bucket, Key=key,
+      Range=f"bytes=0-{index['header_length'] - 1}")
+    lines.extend(response['Body'].read().decode('utf-8').splitlines())
+
+  for first, last in block_byte_ranges(
+      select_index_blocks(index, region=region, gene=gene)):
+    response = s3.get_object(Bucket=bucket, Key=key,
+      Range=f"bytes={first}-{last}")
+    for line in response['Body'].read().decode('utf-8').splitlines():
+      if record_matches(line, region=region, gene=gene):
+        lines.append(line)
+
+  return lines
+
 ### EOF
@@ -19,11 +19,12 @@ from botocore.client import Config
 from botocore.exceptions import ClientError
 
 from flask import (abort, flash, redirect, render_template,
-  request, session, url_for, jsonify)
+  request, session, url_for, jsonify, Response)
 
 from gas import app, db
 from decorators import authenticated, is_premium
 from auth import get_profile, update_profile
+from helpers import load_result_index, parse_region, query_result_region
 
 
 """Start annotation request
@@ -49,7 +50,7 @@ def annotate():
     str(uuid.uuid4()) + '~${filename}'
 
   # Create the redirect URL
-  redirect_url = str(request.url) + '/job'
+  redirect_url = str(request.base_url) + '/job'
 
   # Define policy fields/conditions
   encryption = app.config['AWS_S3_ENCRYPTION']
@@ -62,8 +63,21 @@ def annotate():
   conditions = [
     ["starts-with", "$success_action_redirect", redirect_url],
     {"x-amz-server-side-encryption": encryption},
-    {"acl": acl}
+    {"acl": acl},
+    # Annotation profile picked on the form, stored with the input
+    ["starts-with", "$x-amz-meta-annotation-profile", ""],
+    # Order the results are asked for in
+    ["starts-with", "$x-amz-meta-output-order", ""]
   ]
+
+  # Regions of interest uploaded beforehand (see annotate_regions), stored
+  # with the input so the job is pruned to them
+  regions_key = request.args.get('regions')
+  if regions_key and not regions_key.startswith(regions_key_prefix(user_id)):
+    regions_key = None
+  if regions_key:
+    fields["x-amz-meta-regions-file"] = regions_key
+    conditions.append({"x-amz-meta-regions-file": regions_key})
   
 
   # Generate the presigned POST call
@@ -79,7 +93,48 @@ def annotate():
     return abort(500)
     
   # Render the upload form which will parse/submit the presigned POST
-  return render_template('annotate.html', s3_post=presigned_post)
+  return render_template('annotate.html', s3_post=presigned_post,
+    profiles=app.config['ANNOTATION_PROFILES'],
+    default_profile=app.config['DEFAULT_ANNOTATION_PROFILE'],
+    output_orders=app.config['OUTPUT_ORDERS'],
+    default_output_order=app.config['DEFAULT_OUTPUT_ORDER'],
+    regions_file=regions_key.split('~', maxsplit=1)[1] if regions_key else None)
+
+
+"""Key prefix of the regions of interest files a user uploads
+"""
+def regions_key_prefix(user_id):
+  return app.config['AWS_S3_KEY_PREFIX'] + user_id + '/regions/'
+
+
+"""Upload a BED file of regions of interest
+A presigned POST uploads a single file, so the regions go to the inputs
+bucket first, through here, and the upload form then carries their key.
+"""
+@app.route('/annotate/regions', methods=['POST'])
+@authenticated
+def annotate_regions():
+  regions_file = request.files.get('regions')
+  if regions_file is None or not regions_file.filename:
+    flash("Select a BED file of regions of interest.")
+    return redirect(url_for('annotate'))
+  body = regions_file.read(app.config['MAX_REGIONS_FILE_BYTES'] + 1)
+  if not body or len(body) > app.config['MAX_REGIONS_FILE_BYTES']:
+    flash("The regions file is empty or too large.")
+    return redirect(url_for('annotate'))
+
+  user_id = session['primary_identity']
+  key_name = regions_key_prefix(user_id) + str(uuid.uuid4()) + '~' + \
+    regions_file.filename.replace('/', '_')
+  try:
+    s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+    s3.put_object(Bucket=app.config['AWS_S3_INPUTS_BUCKET'], Key=key_name,
+      Body=body, ServerSideEncryption=app.config['AWS_S3_ENCRYPTION'])
+  except ClientError as e:
+    app.logger.error(f"Unable to upload the regions file: {e}")
+    return abort(500)
+
+  return redirect(url_for('annotate', regions=key_name))
 
 
 """Fires off an annotation job
@@ -113,6 +168,24 @@ def create_annotation_job_request():
   object_name = s3_path[2]
   job_id = object_name.split("~")[0]
   filename = object_name.split("~")[1]
+
+  # Annotation profile picked on the upload form: a profile name or a list
+  # of stages, resolved by the annotator
+  annotation_profile = app.config['DEFAULT_ANNOTATION_PROFILE']
+  output_order = app.config['DEFAULT_OUTPUT_ORDER']
+  try:
+    s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+    metadata = s3.head_object(Bucket=bucket_name, Key=s3_key)['Metadata']
+    annotation_profile = metadata.get('annotation-profile') or \
+      annotation_profile
+    regions_key = metadata.get('regions-file')
+    output_order = metadata.get('output-order') or output_order
+  except ClientError as e:
+    app.logger.error(f"Unable to read the annotation profile of the input: {e}")
+    regions_key = None
+  # Only regions this user uploaded
+  if regions_key and not regions_key.startswith(regions_key_prefix(user_id)):
+    regions_key = None
   
 
   # Persist job to database
@@ -124,8 +197,12 @@ def create_annotation_job_request():
       "s3_inputs_bucket": bucket_name,
       "s3_key_input_file": s3_key,
       "submit_time": timestamp,
+      "annotation_profile": annotation_profile,
+      "output_order": output_order,
       "job_status": "PENDING"
   }
+  if regions_key:
+    data["s3_key_regions_file"] = regions_key
 
   # Connect to the dynamoDB client
   try:
@@ -254,7 +331,13 @@ def annotation_details(id):
     'input_file_name': item['input_file_name'],
     'input_file_url': inputs_download_url,
     'job_status': item['job_status'],
-    'complete_time': complete_time
+    'failure_message': item.get('failure_message'),
+    'complete_time': complete_time,
+    'annotation_profile': item.get('annotation_profile',
+      app.config['DEFAULT_ANNOTATION_PROFILE']),
+    'annotation_stages': ', '.join(item.get('annotation_stages', [])),
+    'regions_file': item['s3_key_regions_file'].split('~', maxsplit=1)[1]
+      if 's3_key_regions_file' in item else None
   }
   
   # For free users, if five minutes have passed, then they cannot download the object
@@ -282,6 +365,7 @@ def annotation_details(id):
       app.logger.errer(f"Error Creating Presigned URL from s3 client")
       abort(500)
     annotation['result_file_url'] = results_download_url
+    annotation['has_index'] = 's3_key_index_file' in item
     
   # Render the annotation_details template with job details
   return render_template('annotation_details.html', annotation=annotation, free_access_expired=free_access_expired)
@@ -324,6 +408,64 @@ def annotation_log(id):
   return render_template('view_log.html', job_id=id, log_file_contents=log_file_contents)
 
 
+"""Serve the records of an annotated results file for a region or gene
+Accepts either ?region=chr:start-end (tabix style) or ?gene=SYMBOL and
+reads only the index blocks that can match with byte-range GETs on S3
+"""
+@app.route('/annotations/<id>/region', methods=['GET'])
+@authenticated
+def annotation_region(id):
+  user_id = session.get('primary_identity')
+  profile = get_profile(identity_id=user_id)
+  is_free_user = True if profile.role == "free_user" else False
+
+  region_arg = request.args.get('region')
+  gene = request.args.get('gene')
+  if bool(region_arg) == bool(gene):
+    abort(400)
+  region = None
+  if region_arg:
+    region = parse_region(region_arg)
+    if region is None:
+      abort(400)
+
+  # Fetch Job Details from the Dynamo DB
+  try:
+      dynamodb = boto3.resource('dynamodb')
+      table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+      response = table.get_item(Key={'job_id': id})
+      item = response.get('Item')
+      if not item or item.get('user_id') != user_id:
+          app.logger.error(f"User: {user_id} attempting to access unauthorized job: {id}")
+          abort(403)
+  except ClientError as e:
+      app.logger.error(f"Error retrieving job details from DynamoDB: {e}")
+      return abort(500)
+
+  if item['job_status'] != "COMPLETED" or 's3_key_index_file' not in item:
+    abort(404)
+  # Same access rules as downloading the whole results file
+  if is_free_user:
+    time_diff = datetime.utcnow() - datetime.utcfromtimestamp(item['complete_time'])
+    if time_diff > timedelta(minutes=5):
+      return redirect(url_for('subscribe'))
+  if 'results_file_archive_id' in item:
+    abort(404)
+
+  try:
+    index = load_result_index(item['s3_results_bucket'], item['s3_key_index_file'])
+    lines = query_result_region(item['s3_results_bucket'],
+      item['s3_key_result_file'], index, region=region, gene=gene)
+  except ClientError as e:
+    # Results or index missing from the bucket
+    if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+      abort(404)
+    app.logger.error(f"Error reading region from results file for job {id}: {e}")
+    return abort(500)
+
+  return Response('\n'.join(lines) + '\n', mimetype='text/plain')
+
+
 """Subscription management handler
 """
 @app.route('/subscribe', methods=['GET', 'POST'])